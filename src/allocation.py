@@ -0,0 +1,186 @@
+'''
+This file contains the allocators that decide which of a month's available loans portfolio.ArrayPortfolio buys and how
+much it invests in each one.
+
+TopKAllocator reproduces the original behavior: buy the loans with the highest predicted ROI until we run out of cash.
+It uses np.argpartition to find the top loans instead of sorting every available loan.
+
+ConstrainedAllocator adds diversification caps, such as no more than 20% of the portfolio in grade E loans or 5% in any
+one state, and can invest a different amount in each loan.
+'''
+
+import numpy as np
+import pandas as pd
+
+def get_top_k(predicted_rois, k):
+    '''
+    Get the positions of the k largest predicted ROIs, ordered from highest to lowest, without sorting every value.
+
+    Args:
+        predicted_rois (array of floats): Predicted ROI of each available loan.
+        k (int): Number of loans to select.
+
+    Returns:
+        array: Returns the positions of the top k loans.
+    '''
+    k = min(max(k, 0), len(predicted_rois))
+    if k == 0:
+        return np.empty(0, dtype='int64')
+    if k < len(predicted_rois):
+        top = np.argpartition(-predicted_rois, k - 1)[:k]
+    else:
+        top = np.arange(len(predicted_rois))
+    return top[np.argsort(-predicted_rois[top], kind='stable')]
+
+def get_group_cumsum(values, groups):
+    '''
+    Cumulative sum of values within each group, keeping the original order of the values.
+
+    Args:
+        values (array of floats): Values to sum.
+        groups (array of ints): Group of each value.
+
+    Returns:
+        array: Returns the running total of each value's group up to and including that value.
+    '''
+    order = np.argsort(groups, kind='stable')
+    sorted_values = values[order]
+    sorted_groups = groups[order]
+    totals = np.cumsum(sorted_values)
+    group_starts = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]
+    start_positions = np.maximum.accumulate(np.where(group_starts, np.arange(len(values)), 0))
+    group_totals = np.empty(len(values))
+    group_totals[order] = totals - totals[start_positions] + sorted_values[start_positions]
+    return group_totals
+
+class TopKAllocator:
+    '''
+    Buy as many loans as we can afford, starting with the highest predicted ROI.
+
+    Args:
+        amount_function (function or None): Optional function taking (predicted_rois, loan_amounts, investment_per_loan)
+            and returning the amount we want to invest in each loan. If None we invest investment_per_loan in every loan.
+    '''
+    def __init__(self, amount_function=None):
+        self.amount_function = amount_function
+
+    def get_bucket_codes(self, loans_df, loan_index):
+        # Plain top-k doesn't need any bucket information.
+        return {}
+
+    def get_requested_amounts(self, predicted_rois, loan_amounts, investment_per_loan):
+        if self.amount_function is None:
+            return np.full(len(predicted_rois), float(investment_per_loan))
+        return np.asarray(self.amount_function(predicted_rois, loan_amounts, investment_per_loan), dtype='float64')
+
+    def allocate(self, portfolio, predicted_rois, loan_amounts, loan_positions):
+        '''
+        Choose the loans to buy this month.
+
+        Args:
+            portfolio (ArrayPortfolio): The portfolio that is buying loans.
+            predicted_rois (array of floats): Predicted ROI of each available loan meeting the portfolio's minimum ROI.
+            loan_amounts (array of floats): Size of each available loan.
+            loan_positions (array of ints): Position of each available loan in the portfolio's loan_ids.
+
+        Returns:
+            tuple: Returns the positions (within the available loans) of the loans to buy and the amount to invest in each.
+        '''
+        if self.amount_function is None:
+            # Same as Portfolio.get_top_loans_to_buy: the number of loans we can afford at investment_per_loan each.
+            chosen = get_top_k(predicted_rois, int(portfolio.cash_balance // portfolio.investment_per_loan))
+            return chosen, np.minimum(portfolio.investment_per_loan, loan_amounts[chosen])
+
+        requested = self.get_requested_amounts(predicted_rois, loan_amounts, portfolio.investment_per_loan)
+        # We can't afford more loans than the cash divided by the smallest amount requested.
+        smallest_request = requested.min() if len(requested) > 0 else 1.0
+        candidates = get_top_k(predicted_rois, int(portfolio.cash_balance // max(smallest_request, 1e-9)))
+        affordable = np.cumsum(requested[candidates]) <= portfolio.cash_balance
+        chosen = candidates[affordable]
+        return chosen, np.minimum(requested[chosen], loan_amounts[chosen])
+
+class ConstrainedAllocator(TopKAllocator):
+    '''
+    Buy loans from the highest predicted ROI down while keeping the portfolio diversified. max_exposure limits the share
+    of the portfolio's total balance held in any one value of a column, for example {'grade': 0.2, 'addr_state': 0.05}.
+    The columns must be in the predictions dataframe given to the portfolio.
+
+    Loans are bought greedily in order of predicted ROI. A loan that would push any of its buckets over its cap, or that
+    costs more than the cash left, is skipped, and the loans after it are still considered, so a cheaper lower ranked
+    loan that fits under every cap is bought. The greedy pass is solved in rounds instead of one loan at a time:
+        1. Loans that no longer fit on their own, under the cash or their bucket's room, are dropped for good, since the
+           cash and the room only go down. Once a bucket is full this drops all of its loans at once.
+        2. get_top_k ranks only as many of the rest as the cash could buy at the smallest amount requested.
+        3. Running totals of the ranked loans, overall and within each bucket, find the first loan that doesn't fit.
+           Every loan ranked above it fits with all the loans before it, so they're bought, and that loan is skipped.
+        4. The cash and the rooms are reduced and the next round starts from the loans that are left.
+    The number of rounds is the number of loans skipped before the month's cash runs out, usually a few per capped
+    bucket that fills up, rather than the number of available loans.
+
+    Args:
+        max_exposure (dict): Dictionary where the key is a column name and the value is the largest fraction of the
+            total balance allowed in any single value of that column.
+        amount_function (function or None): See TopKAllocator.
+    '''
+    def __init__(self, max_exposure, amount_function=None):
+        super().__init__(amount_function)
+        self.max_exposure = max_exposure
+
+    def get_bucket_codes(self, loans_df, loan_index):
+        '''
+        Convert each capped column to integer codes, stored by loan position so they can be looked up for both available
+        loans and loans already held.
+
+        Returns:
+            dict: Dictionary where the key is the column name and the value is a tuple of the code of every loan position
+            and the number of codes. Loans missing from loans_df or with a missing value get the last code.
+        '''
+        positions = loan_index.get_indexer(loans_df['id'])
+        bucket_codes = {}
+        for col in self.max_exposure:
+            codes, uniques = pd.factorize(loans_df[col])
+            num_codes = len(uniques) + 1
+            codes = np.where(codes < 0, num_codes - 1, codes)
+            codes_by_position = np.full(len(loan_index), num_codes - 1, dtype='int64')
+            codes_by_position[positions] = codes
+            bucket_codes[col] = (codes_by_position, num_codes)
+        return bucket_codes
+
+    def allocate(self, portfolio, predicted_rois, loan_amounts, loan_positions):
+        requested = np.minimum(self.get_requested_amounts(predicted_rois, loan_amounts, portfolio.investment_per_loan),
+                               loan_amounts)
+        total_balance = portfolio.cash_balance + portfolio.principal_balances.sum()
+
+        # Room left under each cap, per bucket, and the bucket of each available loan.
+        rooms = []
+        for col, max_fraction in self.max_exposure.items():
+            codes_by_position, num_codes = portfolio.bucket_codes[col]
+            exposure = np.bincount(codes_by_position[portfolio.loan_positions], weights=portfolio.principal_balances,
+                                   minlength=num_codes)
+            rooms.append((codes_by_position[loan_positions], max_fraction * total_balance - exposure))
+
+        cash = portfolio.cash_balance
+        remaining = np.arange(len(requested))
+        chosen = []
+        while True:
+            fits = requested[remaining] <= cash
+            for codes, room in rooms:
+                fits &= requested[remaining] <= room[codes[remaining]]
+            remaining = remaining[fits]
+            if len(remaining) == 0:
+                break
+            ranked = remaining[get_top_k(predicted_rois[remaining], int(cash // requested[remaining].min()))]
+            amounts = requested[ranked]
+            too_much = np.cumsum(amounts) > cash
+            for codes, room in rooms:
+                too_much |= get_group_cumsum(amounts, codes[ranked]) > room[codes[ranked]]
+            num_bought = int(np.argmax(too_much)) if too_much.any() else len(ranked)
+            bought = ranked[:num_bought]
+            chosen.append(bought)
+            cash -= requested[bought].sum()
+            for codes, room in rooms:
+                room -= np.bincount(codes[bought], weights=requested[bought], minlength=len(room))
+            # The loans bought and the first one that didn't fit are done with.
+            remaining = np.setdiff1d(remaining, ranked[:num_bought + 1], assume_unique=True)
+        chosen = np.concatenate(chosen) if chosen else np.empty(0, dtype='int64')
+        return chosen, requested[chosen]
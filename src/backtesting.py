@@ -0,0 +1,159 @@
+'''
+This file contains a walk-forward (rolling origin) backtest of the modeling and simulation pipeline. For every split
+date the model is trained on loans issued up to that date, predicts the ROI of the loans issued over the following
+months, and those predictions are run through the portfolio simulation. Comparing the ROI across split dates shows how
+stable the model is over time instead of relying on the single 2016-04-01 split.
+
+The loans are sorted by issue date once. Each split is then a pair of row ranges found with a binary search, and the
+training and testing loans are taken as positional slices of the sorted dataframe instead of boolean masked copies.
+'''
+
+import multiprocessing as mp
+import time
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
+from src.modeling import create_dataframe_for_simulation, get_predictions, split_data_into_labels_and_target, train_model
+from src.portfolio import simulate_loan_investment_portfolio
+
+# These are set by run_walk_forward_backtest before the process pool is created. The worker processes are forked, so
+# they inherit the loans, payments and model factory without them being pickled and copied to every worker.
+backtest_loans = None
+backtest_payments = None
+backtest_model_factory = None
+
+def sort_loans_by_issue_date(df):
+    '''
+    Sort the loans by issue date so every training and testing period is a range of rows.
+
+    Args:
+        df (dataframe): Our loan dataframe that has been cleaned and prepared for modeling.
+
+    Returns:
+        DataFrame: Returns the loans sorted by issue_d. Loans issued on the same date keep their original order.
+    '''
+    return df.iloc[np.argsort(df['issue_d'].to_numpy(), kind='stable')]
+
+def get_walk_forward_splits(issue_dates, split_dates, test_months=12, train_months=None):
+    '''
+    Find the rows of the training and testing loans for each split date.
+
+    Args:
+        issue_dates (array of datetime64): Sorted issue dates of the loans, from sort_loans_by_issue_date.
+        split_dates (list of strings): The final month to include in the training data for each split. For example,
+            April 2016 would be '2016-04-01'.
+        test_months (int): Number of months after the split date whose loans are used for testing.
+        train_months (int or None): Number of months up to the split date used for training. None trains on every
+            loan issued up to the split date.
+
+    Returns:
+        list: List of (split_date, (train_start, train_end), (test_start, test_end)) tuples, where the training loans
+        are rows train_start:train_end and the testing loans are rows test_start:test_end.
+    '''
+    issue_dates = np.asarray(issue_dates, dtype='datetime64[ns]')
+    splits = []
+    for split_date in split_dates:
+        split_date = pd.Timestamp(split_date)
+        train_end = np.searchsorted(issue_dates, np.datetime64(split_date), side='right')
+        if train_months is None:
+            train_start = 0
+        else:
+            train_start = np.searchsorted(issue_dates, np.datetime64(split_date - pd.DateOffset(months=train_months)),
+                                          side='right')
+        test_end = np.searchsorted(issue_dates, np.datetime64(split_date + pd.DateOffset(months=test_months)), side='right')
+        splits.append((split_date, (train_start, train_end), (train_end, test_end)))
+    return splits
+
+def iterate_walk_forward_splits(df, split_dates, test_months=12, train_months=None):
+    '''
+    Yield the training and testing loans for each split date as views of the sorted loans.
+
+    Args:
+        df (dataframe): Loans sorted by issue date, from sort_loans_by_issue_date.
+        split_dates (list of strings): See get_walk_forward_splits.
+        test_months (int): See get_walk_forward_splits.
+        train_months (int or None): See get_walk_forward_splits.
+
+    Yields:
+        tuple: The split date, the training loans and the testing loans.
+    '''
+    for split_date, (train_start, train_end), (test_start, test_end) in get_walk_forward_splits(df['issue_d'], split_dates,
+                                                                                                 test_months, train_months):
+        yield split_date, df.iloc[train_start:train_end], df.iloc[test_start:test_end]
+
+def backtest_split(task):
+    '''
+    Train, predict and simulate one split of the backtest. This is the function mapped over the process pool, so it
+    reads the loans, payments and model factory from the module level variables set up by run_walk_forward_backtest.
+
+    Args:
+        task (tuple): Tuple of (split_date, training rows, testing rows, simulation_months, starting_balance,
+            investment_per_loan, min_roi).
+
+    Returns:
+        dict: Returns one row of the backtest results table.
+    '''
+    split_date, (train_start, train_end), (test_start, test_end), simulation_months, starting_balance, \
+        investment_per_loan, min_roi = task
+    training_loans = backtest_loans.iloc[train_start:train_end]
+    testing_loans = backtest_loans.iloc[test_start:test_end]
+
+    start = time.perf_counter()
+    X_train, y_train = split_data_into_labels_and_target(training_loans)
+    fit_model = train_model(backtest_model_factory(), X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+
+    X_test, y_test = split_data_into_labels_and_target(testing_loans)
+    model_predictions = create_dataframe_for_simulation(testing_loans, get_predictions(fit_model, X_test))
+    start_date = (split_date + relativedelta(months=1)).date()
+    end_date = start_date + relativedelta(months=simulation_months)
+    dates, balances, roi = simulate_loan_investment_portfolio(backtest_payments, model_predictions, start_date, end_date,
+                                                              starting_balance, investment_per_loan, min_roi)
+    return {'split_date': split_date, 'training_loans': len(training_loans), 'testing_loans': len(testing_loans),
+            'start_date': start_date, 'end_date': end_date, 'fit_seconds': fit_seconds, 'final_balance': balances[-1],
+            'roi': roi}
+
+def run_walk_forward_backtest(loans_df, all_payments, model_factory, split_dates, test_months=12, train_months=None,
+                              simulation_months=None, starting_balance=50000, investment_per_loan=100, min_roi=10.0,
+                              processes=1):
+    '''
+    Run a walk-forward backtest of a model over several split dates.
+
+    Args:
+        loans_df (dataframe): Our loan dataframe that has been cleaned and prepared for modeling, indexed by loan id.
+        all_payments (dataframe): Payments for the loans with a multi-level index of payment date and loan ID.
+        model_factory (function): Function taking no arguments that returns a new, untrained model. For example
+            lambda: xgb.XGBRegressor(n_estimators=200).
+        split_dates (list of strings): The final month to include in the training data for each split. For example,
+            April 2016 would be '2016-04-01'.
+        test_months (int): Number of months after each split date whose loans are predicted and can be bought.
+        train_months (int or None): Number of months up to the split date used for training. None trains on every
+            loan issued up to the split date.
+        simulation_months (int or None): Number of months to simulate starting the month after the split date. None
+            simulates test_months months.
+        starting_balance (float): Starting cash balance of each portfolio.
+        investment_per_loan (float): Amount to invest in each loan.
+        min_roi (float): Minimum predicted ROI a loan needs for us to buy it.
+        processes (int or None): Number of worker processes. None uses every CPU, 1 runs the splits in this process.
+            Each split trains its own model, so reduce the model's own thread count when running splits in parallel.
+
+    Returns:
+        DataFrame: Returns a dataframe indexed by split date with the number of training and testing loans, the
+        simulated dates, the time taken to train the model, the final balance and the annualized ROI of each split.
+    '''
+    global backtest_loans, backtest_payments, backtest_model_factory
+    backtest_loans = sort_loans_by_issue_date(loans_df)
+    backtest_payments = all_payments
+    backtest_model_factory = model_factory
+
+    if simulation_months is None:
+        simulation_months = test_months
+    tasks = [(split_date, train_rows, test_rows, simulation_months, starting_balance, investment_per_loan, min_roi)
+             for split_date, train_rows, test_rows in get_walk_forward_splits(backtest_loans['issue_d'], split_dates,
+                                                                              test_months, train_months)]
+    if processes == 1:
+        results = [backtest_split(task) for task in tasks]
+    else:
+        with mp.get_context('fork').Pool(processes=processes) as pool:
+            results = pool.map(backtest_split, tasks)
+    return pd.DataFrame(results).set_index('split_date')
@@ -0,0 +1,244 @@
+'''
+This file contains an end-to-end benchmark of the pipeline, so we can tell whether a change makes it faster or slower.
+For each data size a synthetic data set is generated with synthetic_data.py (once, and reused by later runs), and every
+stage is run on it in the order the notebooks run them:
+    load        data_cleaning.load_loan_data_from_local_machine on the LoanStats files
+    dummies     feature_engineering.create_dummy_cols on the loaded loans
+    clean       data_cleaning.clean_and_prepare_raw_data_for_model
+    payments    Reading the PMTHIST file and payments.get_cleaned_payment_history_data
+    rois        payments.get_rois_for_loans on a sample of loans, since it loops over loans one at a time
+    train       modeling.train_model
+    predict     modeling.get_predictions
+    simulate    portfolio.simulate_loan_investment_portfolio on the testing loans
+
+Each stage records its wall time, the rows it processed per second, and the process's resident memory before it started
+and at its peak while it ran. Peak memory is sampled by a background thread, since the operating system only keeps the
+peak of the whole process. Results are saved as JSON, and compare_to_baseline lines a run up with a saved baseline and
+flags every stage that got slower or used more memory than the tolerance allows.
+'''
+
+import json
+import os
+import platform
+import time
+import numpy as np
+import pandas as pd
+from src.memory_sampling import PeakMemorySampler
+from src.synthetic_data import generate_synthetic_data
+
+BENCHMARK_DIRECTORY = 'data/benchmarks'
+
+def measure_stage(stage_results, name, function, rows):
+    '''
+    Run one stage of the pipeline and record how long it took and how much memory it used.
+
+    Args:
+        stage_results (dict): Dictionary the stage's measurements are added to under name.
+        name (string): Name of the stage.
+        function (function): Function taking no arguments that runs the stage.
+        rows (int or function): Number of rows the stage processes, or a function taking the stage's result and
+            returning it, for stages whose input size isn't known until they've run.
+
+    Returns:
+        varies: Returns whatever function returns.
+    '''
+    with PeakMemorySampler() as memory:
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+    rows = rows(result) if callable(rows) else rows
+    stage_results[name] = {'seconds': seconds, 'rows': int(rows),
+                           'rows_per_second': rows / seconds if seconds > 0 else None,
+                           'start_rss_mb': memory.start_mb, 'peak_rss_mb': memory.peak_mb,
+                           'rss_growth_mb': memory.peak_mb - memory.start_mb}
+    return result
+
+def get_fixture(num_loans, seed=91, directory=BENCHMARK_DIRECTORY):
+    '''
+    Get the synthetic data set for one data size, generating it the first time it's needed.
+
+    Returns:
+        dict: Returns the dictionary from synthetic_data.generate_synthetic_data, with the folder the files are in.
+    '''
+    fixture_directory = os.path.join(directory, f'{num_loans}_loans_seed_{seed}')
+    manifest_path = os.path.join(fixture_directory, 'fixture.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    fixture = generate_synthetic_data(fixture_directory, num_loans=num_loans, seed=seed)
+    fixture['directory'] = fixture_directory
+    # The manifest is written last, so an interrupted generation is never reused.
+    with open(manifest_path, 'w') as f:
+        json.dump(fixture, f)
+    return fixture
+
+def get_default_model():
+    from xgboost import XGBRegressor
+    return XGBRegressor(n_estimators=100, max_depth=6, learning_rate=0.1, tree_method='hist', random_state=91,
+                        n_jobs=-1)
+
+def get_total_return_target(loans_df, payments_df):
+    '''
+    Get a quick stand in for each loan's ROI to train on: the total it paid investors over the amount invested, as a
+    percentage. Timing training doesn't need the real ROI, and computing it for every loan would take far longer than
+    everything else.
+    '''
+    received = payments_df.groupby('LOAN_ID')['RECEIVED_AMT_INVESTORS'].sum()
+    return 100 * (received.reindex(loans_df.index).fillna(0).to_numpy() / loans_df['loan_amnt'].to_numpy() - 1)
+
+def run_pipeline_benchmark(fixture, split_date='2016-12-01', roi_loans=2000, model_factory=get_default_model,
+                           starting_balance=50000, investment_per_loan=100, min_roi=5.0):
+    '''
+    Run every stage of the pipeline on one synthetic data set.
+
+    Args:
+        fixture (dict): A data set from get_fixture.
+        split_date (string): The last issue month of the training loans. Later loans are predicted and simulated.
+        roi_loans (int): Number of loans get_rois_for_loans is run on.
+        model_factory (function): Function taking no arguments that returns a new, untrained model.
+        starting_balance (float): Starting cash balance of the simulated portfolio.
+        investment_per_loan (float): Amount to invest in each loan.
+        min_roi (float): Minimum predicted ROI a loan needs for us to buy it.
+
+    Returns:
+        dict: Returns a dictionary where the key is the stage name and the value is a dictionary of its measurements.
+    '''
+    from src.columns import columns_to_use
+    from src.data_cleaning import clean_and_prepare_raw_data_for_model, load_loan_data_from_local_machine
+    from src.feature_engineering import create_dummy_cols
+    from src.modeling import (create_dataframe_for_simulation, get_predictions, split_data_into_labels_and_target,
+                              split_training_and_testing_data, train_model)
+    from src.payments import (get_cleaned_payment_history_data, get_rois_for_loans, get_training_payments,
+                              set_and_sort_indices)
+    from src.portfolio import simulate_loan_investment_portfolio
+
+    stages = {}
+    # load_loan_data_from_local_machine reads from the data folder.
+    loan_files = [os.path.relpath(os.path.join(fixture['directory'], filename), 'data')
+                  for filename in fixture['loan_files']]
+    raw_loans = measure_stage(stages, 'load', lambda: load_loan_data_from_local_machine(loan_files, columns_to_use),
+                              len)
+    # Both stages change the dataframe they're given, so each gets its own copy, made before it's timed. The inputs are
+    # bound as default arguments so the lambdas don't refer to names deleted once the stage has run.
+    dummy_input = raw_loans.dropna(subset=['issue_d'])
+    measure_stage(stages, 'dummies', lambda df=dummy_input: create_dummy_cols(df), len(dummy_input))
+    del dummy_input
+    loans = measure_stage(stages, 'clean', lambda df=raw_loans: clean_and_prepare_raw_data_for_model(df.copy()),
+                          len(raw_loans))
+    del raw_loans
+    # The totals at the end of each file are in the id column, so pandas reads the ids as strings.
+    loans.index = loans.index.astype('int64')
+
+    payments_path = os.path.join(fixture['directory'], fixture['payments_file'])
+    payment_columns = ('LOAN_ID', 'RECEIVED_D', 'PBAL_END_PERIOD_INVESTORS', 'RECEIVED_AMT_INVESTORS', 'IssuedDate')
+    payments = measure_stage(stages, 'payments', lambda: get_cleaned_payment_history_data(
+        pd.read_csv(payments_path, low_memory=False, usecols=payment_columns)), len)
+
+    roi_sample = loans.index[np.linspace(0, len(loans) - 1, min(roi_loans, len(loans))).astype('int64')]
+    roi_payments = get_training_payments(payments, roi_sample)
+    loan_amounts = loans.loc[roi_sample, 'loan_amnt'].to_dict()
+    measure_stage(stages, 'rois', lambda roi_payments=roi_payments: get_rois_for_loans(loan_amounts, roi_payments),
+                  len(loan_amounts))
+    del roi_payments
+
+    loans['roi'] = get_total_return_target(loans, payments)
+    training_loans, testing_loans = split_training_and_testing_data(loans, split_date)
+    X_train, y_train = split_data_into_labels_and_target(training_loans)
+    X_test, y_test = split_data_into_labels_and_target(testing_loans)
+    fit_model = measure_stage(stages, 'train', lambda: train_model(model_factory(), X_train, y_train), len(X_train))
+    predictions = measure_stage(stages, 'predict', lambda: get_predictions(fit_model, X_test), len(X_test))
+
+    model_predictions = create_dataframe_for_simulation(testing_loans, predictions)
+    # The simulation takes the payments with the issue date column that get_cleaned_payment_history_data drops.
+    all_payments = set_and_sort_indices(payments.assign(IssuedDate=payments['LOAN_ID'].map(loans['issue_d'])))
+    start_date = testing_loans['issue_d'].min().date().replace(day=1)
+    end_date = all_payments.index.get_level_values('RECEIVED_D').max().date()
+    measure_stage(stages, 'simulate', lambda: simulate_loan_investment_portfolio(
+        all_payments, model_predictions, start_date, end_date, starting_balance, investment_per_loan, min_roi),
+                  len(model_predictions))
+    return stages
+
+def get_environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+def run_benchmarks(sizes=(10000, 50000, 200000), seed=91, directory=BENCHMARK_DIRECTORY, **kwargs):
+    '''
+    Run the pipeline benchmark at several data sizes.
+
+    Args:
+        sizes (list or tuple of ints): Numbers of loans to benchmark.
+        seed (int): Seed of the synthetic data sets.
+        directory (string): Folder the synthetic data sets are stored in.
+        **kwargs: Passed on to run_pipeline_benchmark.
+
+    Returns:
+        dict: Returns the results, with the environment they were measured in and the stages of each size.
+    '''
+    results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': get_environment(), 'sizes': {}}
+    for num_loans in sizes:
+        fixture = get_fixture(num_loans, seed, directory)
+        results['sizes'][str(num_loans)] = {'num_payments': fixture['num_payments'],
+                                            'stages': run_pipeline_benchmark(fixture, **kwargs)}
+    return results
+
+def save_results(results, filename):
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def load_results(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def get_results_dataframe(results):
+    '''
+    Flatten benchmark results into a dataframe indexed by data size and stage.
+    '''
+    rows = {(int(size), stage): measurements for size, size_results in results['sizes'].items()
+            for stage, measurements in size_results['stages'].items()}
+    df = pd.DataFrame.from_dict(rows, orient='index')
+    df.index.names = ['num_loans', 'stage']
+    return df
+
+def compare_to_baseline(results, baseline, time_tolerance=0.2, memory_tolerance=0.2, min_seconds=0.05):
+    '''
+    Compare benchmark results to a saved baseline and flag regressions.
+
+    Args:
+        results (dict): Results from run_benchmarks.
+        baseline (dict): Earlier results, for example from load_results.
+        time_tolerance (float): Share a stage may slow down before it's flagged, for example 0.2 for 20%.
+        memory_tolerance (float): Share a stage's memory growth may increase before it's flagged.
+        min_seconds (float): Stages must also slow down by at least this many seconds to be flagged, so very short
+            stages aren't flagged for timer noise.
+
+    Returns:
+        DataFrame: Returns a dataframe indexed by data size and stage with the seconds and memory growth of both runs,
+        their percentage changes, and whether each is a regression. Only sizes and stages in both runs are compared.
+    '''
+    current = get_results_dataframe(results)[['seconds', 'rss_growth_mb']]
+    previous = get_results_dataframe(baseline)[['seconds', 'rss_growth_mb']]
+    comparison = current.join(previous, how='inner', rsuffix='_baseline')
+    comparison['seconds_change_pct'] = 100 * (comparison['seconds'] / comparison['seconds_baseline'] - 1)
+    comparison['rss_growth_change_mb'] = comparison['rss_growth_mb'] - comparison['rss_growth_mb_baseline']
+    comparison['slower'] = ((comparison['seconds'] > comparison['seconds_baseline'] * (1 + time_tolerance)) &
+                            (comparison['seconds'] - comparison['seconds_baseline'] > min_seconds))
+    # Memory growth can be near 0, so it's compared with a floor of 1 MB.
+    comparison['more_memory'] = (comparison['rss_growth_mb'] >
+                                 np.maximum(comparison['rss_growth_mb_baseline'], 1) * (1 + memory_tolerance))
+    comparison['regression'] = comparison['slower'] | comparison['more_memory']
+    return comparison
+
+if __name__ == '__main__':
+    results = run_benchmarks()
+    results_path = os.path.join(BENCHMARK_DIRECTORY, 'results.json')
+    baseline_path = os.path.join(BENCHMARK_DIRECTORY, 'baseline.json')
+    save_results(results, results_path)
+    print(get_results_dataframe(results)[['seconds', 'rows_per_second', 'peak_rss_mb', 'rss_growth_mb']])
+    if os.path.exists(baseline_path):
+        comparison = compare_to_baseline(results, load_results(baseline_path))
+        print(comparison)
+        print('Regressions:', list(comparison.index[comparison['regression']]))
+    else:
+        save_results(results, baseline_path)
+        print(f'Saved {baseline_path} as the baseline')
@@ -0,0 +1,153 @@
+'''
+This file contains functions for loading only the raw CSV columns a trained model needs. columns.columns_to_use keeps
+every column that would be known when a loan is issued, so the loaders parse well over 100 columns even though many of
+the features made from them are never used by the model.
+
+The model's feature importances, or the mean |SHAP| values from shap_analysis.py, decide which features are kept. Each
+kept feature is mapped back to the raw columns it's made from (dummy columns to the categorical column, _missing
+columns to the column they flag, engineered columns to their inputs), and columns.pipeline_cols are always added because
+the cleaning pipeline reads them by name. The result is passed as the columns argument of
+load_loan_data_from_local_machine or load_loan_data_from_s3, which hand it to pandas as usecols, so the other columns are
+never parsed.
+
+Features that are dropped are filled with the same -99 that fill_nas uses by align_features. A tree model never
+splits on a feature with zero importance, so with the default of keeping every feature with nonzero importance the
+model's predictions are unchanged.
+'''
+
+import time
+import numpy as np
+import pandas as pd
+from src.columns import columns_to_use, dummy_prefixes, engineered_cols, pipeline_cols
+
+def get_feature_importances(fit_model, feature_columns=None):
+    '''
+    Get the importance of each feature of a trained model.
+
+    Args:
+        fit_model (varies): A trained model with a feature_importances_ attribute, for example an XGBRegressor.
+        feature_columns (list or None): The columns of the training features. If None the model's feature_names_in_
+            attribute is used, which is set when a model is trained on a dataframe.
+
+    Returns:
+        Series: Returns the importance of each feature, indexed by feature name.
+    '''
+    if feature_columns is None:
+        feature_columns = fit_model.feature_names_in_
+    return pd.Series(np.asarray(fit_model.feature_importances_, dtype='float64'), index=list(feature_columns))
+
+def select_important_features(importances, coverage=1.0):
+    '''
+    Choose the features to keep.
+
+    Args:
+        importances (series): Importance of each feature indexed by feature name, from get_feature_importances or
+            shap_analysis.ShapResults.get_mean_abs_shap.
+        coverage (float): Share of the total importance the kept features must account for. 1.0 keeps every feature
+            with nonzero importance, which leaves a tree model's predictions unchanged. Lower values keep fewer
+            features and change the predictions.
+
+    Returns:
+        list: Returns the names of the kept features, from the most to the least important.
+    '''
+    importances = importances[importances > 0].sort_values(ascending=False, kind='stable')
+    if coverage >= 1.0 or len(importances) == 0:
+        return list(importances.index)
+    cumulative_share = importances.cumsum() / importances.sum()
+    num_features = int(np.searchsorted(cumulative_share.to_numpy(), coverage, side='left')) + 1
+    return list(importances.index[:num_features])
+
+def get_raw_columns_for_feature(feature):
+    '''
+    Find the raw CSV columns a model feature is made from.
+
+    Args:
+        feature (string): Name of a column of the model's features, for example 'state_MI' or 'dti_missing'.
+
+    Returns:
+        tuple: Returns the names of the raw columns.
+    '''
+    if feature in engineered_cols:
+        return engineered_cols[feature]
+    if feature.endswith('_missing'):
+        return get_raw_columns_for_feature(feature[:-len('_missing')])
+    for prefix, col in dummy_prefixes.items():
+        if feature.startswith(prefix):
+            return (col,)
+    return (feature,)
+
+def get_pruned_columns(importances, coverage=1.0):
+    '''
+    Get the smallest set of raw columns needed to rebuild a model's important features.
+
+    Args:
+        importances (series): Importance of each feature indexed by feature name.
+        coverage (float): See select_important_features.
+
+    Returns:
+        list: Returns the raw columns to load, in the order of columns.columns_to_use.
+    '''
+    needed = set(pipeline_cols)
+    for feature in select_important_features(importances, coverage):
+        needed.update(get_raw_columns_for_feature(feature))
+    return [col for col in columns_to_use if col in needed]
+
+def align_features(X, feature_columns, fill_value=-99):
+    '''
+    Put features built from pruned columns in the order the model was trained with. Features that weren't built
+    because their raw columns weren't loaded are filled with fill_value.
+
+    Args:
+        X (dataframe): Dataframe of features built from the pruned columns.
+        feature_columns (list): The columns the model was trained on.
+        fill_value (int or float): Value used for the missing features, the same value fill_nas uses.
+
+    Returns:
+        DataFrame: Returns the features with exactly the model's columns.
+    '''
+    return X.reindex(columns=list(feature_columns), fill_value=fill_value)
+
+def compare_column_pruning(csv_files, pruned_columns, columns=columns_to_use, number_of_rows=None):
+    '''
+    Measure how long loading the CSV files takes and how much memory the loans use with all and with pruned columns.
+
+    Args:
+        csv_files (list or tuple): List of CSV files in the data folder. See load_loan_data_from_local_machine.
+        pruned_columns (list): The raw columns from get_pruned_columns.
+        columns (list): The raw columns loaded without pruning.
+        number_of_rows (int or None): The number of rows to load from each CSV file.
+
+    Returns:
+        DataFrame: Returns a dataframe indexed by 'all' and 'pruned' with the number of columns, seconds to parse the
+        files and memory used by the loans in MB, and the savings of pruning in the last row.
+    '''
+    from src.data_cleaning import load_loan_data_from_local_machine
+    results = {}
+    for name, cols in (('all', columns), ('pruned', pruned_columns)):
+        start = time.perf_counter()
+        loans = load_loan_data_from_local_machine(csv_files, cols, number_of_rows)
+        parse_seconds = time.perf_counter() - start
+        results[name] = {'columns': len(cols), 'parse_seconds': parse_seconds,
+                         'memory_mb': loans.memory_usage(deep=True).sum() / 2**20}
+        del loans
+    results = pd.DataFrame(results).T
+    results.loc['savings_pct'] = 100 * (1 - results.loc['pruned'] / results.loc['all'])
+    return results
+
+if __name__ == '__main__':
+    import pickle
+    from src.data_cleaning import clean_and_prepare_raw_data_for_model, load_loan_data_from_local_machine
+    csv_files = ('LoanStats_securev1_2016Q1.csv', 'LoanStats_securev1_2016Q2.csv')
+    with open('data/model_xgb.pickle', 'rb') as f:
+        fit_model = pickle.load(f)
+    feature_columns = list(fit_model.feature_names_in_)
+    pruned_columns = get_pruned_columns(get_feature_importances(fit_model))
+    print(f'Loading {len(pruned_columns)} of {len(columns_to_use)} columns')
+    print(compare_column_pruning(csv_files, pruned_columns))
+
+    # Check the model's predictions are the same from the pruned columns.
+    full = clean_and_prepare_raw_data_for_model(load_loan_data_from_local_machine(csv_files, columns_to_use))
+    pruned = clean_and_prepare_raw_data_for_model(load_loan_data_from_local_machine(csv_files, pruned_columns))
+    difference = fit_model.predict(align_features(full, feature_columns)) - \
+        fit_model.predict(align_features(pruned, feature_columns))
+    print('Largest prediction difference:', np.abs(difference).max())
@@ -40,5 +40,20 @@ all_cols = ('id', 'member_id', 'loan_amnt', 'funded_amnt', 'funded_amnt_inv', 't
 
 columns_to_use = [col for col in all_cols if col not in ignore_cols]
 
+# Columns data_cleaning.clean_and_prepare_raw_data_for_model reads or drops by name, so they're always loaded even when
+# the model doesn't use them. See column_pruning.py.
+pipeline_cols = ('id', 'loan_amnt', 'term', 'int_rate', 'grade', 'emp_length', 'home_ownership', 'verification_status',
+                 'issue_d', 'loan_status', 'purpose', 'zip_code', 'addr_state', 'delinq_2yrs', 'earliest_cr_line',
+                 'inq_last_6mths', 'open_acc', 'pub_rec', 'revol_util', 'total_acc', 'total_pymnt_inv', 'total_rec_prncp',
+                 'total_rec_int', 'last_pymnt_d', 'collections_12_mths_ex_med', 'application_type', 'acc_now_delinq',
+                 'chargeoff_within_12_mths', 'pub_rec_bankruptcies', 'tax_liens')
+
+# Model features made from a raw column under a different name, and the raw columns each one is made from.
+dummy_prefixes = {'state_': 'addr_state', 'is_': 'verification_status', 'grade_': 'grade', 'home_': 'home_ownership',
+                  'purpose_': 'purpose'}
+engineered_cols = {'expected_inflation': ('issue_d',), 'us_mortgage_rate': ('issue_d',), 'prime_rate': ('issue_d',),
+                   'int_minus_inflation': ('int_rate', 'issue_d'), 'int_minus_mortgage': ('int_rate', 'issue_d'),
+                   'int_minus_prime': ('int_rate', 'issue_d'), 'mths_since_earliest_cr': ('issue_d', 'earliest_cr_line')}
+
 uint8_cols = []
 categorical_cols = []
\ No newline at end of file
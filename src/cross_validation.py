@@ -0,0 +1,245 @@
+'''
+This file contains a time-ordered k-fold cross-validation of the models. The loans' issue months are split into
+num_folds + 1 consecutive blocks, and fold k trains on the loans issued in the first k + 1 blocks and validates on the
+loans issued in the block after them, so a model is never trained on loans issued after the ones it's scored on.
+
+The loans are sorted by issue date and converted to one float32 feature matrix once. Each fold is stored as arrays of
+row numbers into that matrix, and because the rows are sorted every fold is a range of rows, so the training and
+validation features are views of the matrix instead of masked copies of the dataframe. XGBoost models are trained with
+xgboost.train on DMatrix slices that are built once per fold and shared by every XGBoost model, and the validation
+payments are bucketed by month once per fold and shared by every model's simulation.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
+from src.backtesting import sort_loans_by_issue_date
+from src.model_zoo import get_cpu_budget
+from src.modeling import create_dataframe_for_simulation, split_data_into_labels_and_target
+from src.portfolio import ArrayPortfolio, bucket_loans_by_month, bucket_payments_by_month, run_portfolio_simulation
+
+def get_time_ordered_folds(issue_dates, num_folds=5, gap_months=0, train_months=None):
+    '''
+    Split sorted loans into time-ordered folds by issue month.
+
+    Args:
+        issue_dates (array of datetime64): Sorted issue dates of the loans, from backtesting.sort_loans_by_issue_date.
+        num_folds (int): Number of folds. The months are split into num_folds + 1 blocks, and the first block is only
+            ever used for training.
+        gap_months (int): Number of months before each validation block left out of its training data. A loan's ROI
+            isn't known until it has been paid off or charged off, so a gap keeps the most recent loans out of training.
+        train_months (int or None): Number of months of training data in each fold. None trains on every month before
+            the gap.
+
+    Returns:
+        list: List of (training rows, validation rows) tuples, where each is an array of row numbers.
+    '''
+    issue_dates = pd.DatetimeIndex(issue_dates)
+    months = np.asarray(12 * issue_dates.year + issue_dates.month - 1, dtype='int64')
+    blocks = np.array_split(np.unique(months), num_folds + 1)
+
+    folds = []
+    for block in blocks[1:]:
+        valid_start = np.searchsorted(months, block[0], side='left')
+        valid_end = np.searchsorted(months, block[-1], side='right')
+        train_end = np.searchsorted(months, block[0] - gap_months, side='left')
+        train_start = 0 if train_months is None else np.searchsorted(months, block[0] - gap_months - train_months,
+                                                                     side='left')
+        folds.append((np.arange(train_start, train_end), np.arange(valid_start, valid_end)))
+    return folds
+
+def get_rows(array, rows):
+    '''
+    Select rows of an array. A range of rows is returned as a view of the array instead of a copy.
+
+    Args:
+        array (array): The array to select rows from.
+        rows (array of ints): Sorted row numbers.
+
+    Returns:
+        array: Returns the selected rows.
+    '''
+    if len(rows) > 0 and rows[-1] - rows[0] + 1 == len(rows):
+        return array[rows[0]:rows[-1] + 1]
+    return array[rows]
+
+class FoldData:
+    '''
+    Everything the folds share, built once by build_fold_data and reused by every call to run_cross_validation. The
+    features are a single float32 matrix of the loans sorted by issue date, and each fold is a pair of arrays of row
+    numbers into it. DMatrix slices and bucketed payments are created for a fold the first time they're needed.
+    '''
+    def __init__(self, loans, features, target, folds, all_payments):
+        self.loans = loans
+        self.features = features
+        self.target = target
+        self.folds = folds
+        self.all_payments = all_payments
+        self.dmatrix = None
+        self.fold_dmatrices = {}
+        self.fold_payments = {}
+
+    def get_dmatrices(self, fold):
+        '''
+        Get the training and validation DMatrix of a fold. The full DMatrix is built once and each fold's are slices
+        of it.
+        '''
+        if fold not in self.fold_dmatrices:
+            import xgboost as xgb
+            if self.dmatrix is None:
+                self.dmatrix = xgb.DMatrix(self.features, label=self.target, nthread=-1)
+            train_rows, valid_rows = self.folds[fold]
+            self.fold_dmatrices[fold] = (self.dmatrix.slice(train_rows), self.dmatrix.slice(valid_rows))
+        return self.fold_dmatrices[fold]
+
+    def get_payments(self, fold):
+        '''
+        Get the payments of a fold's validation loans, bucketed by month.
+        '''
+        if fold not in self.fold_payments:
+            valid_rows = self.folds[fold][1]
+            self.fold_payments[fold] = bucket_payments_by_month(self.all_payments, self.loans.index.to_numpy()[valid_rows])
+        return self.fold_payments[fold]
+
+def build_fold_data(loans_df, all_payments, num_folds=5, gap_months=0, train_months=None):
+    '''
+    Sort the loans, convert their features and build the folds once.
+
+    Args:
+        loans_df (dataframe): Our loan dataframe that has been cleaned and prepared for modeling, indexed by loan id.
+        all_payments (dataframe): Payments for the loans with a multi-level index of payment date and loan ID.
+        num_folds (int): See get_time_ordered_folds.
+        gap_months (int): See get_time_ordered_folds.
+        train_months (int or None): See get_time_ordered_folds.
+
+    Returns:
+        FoldData: The sorted loans, feature matrix, target, folds and payments.
+    '''
+    loans = sort_loans_by_issue_date(loans_df)
+    X, y = split_data_into_labels_and_target(loans)
+    features = np.ascontiguousarray(X, dtype='float32')
+    target = y.to_numpy(dtype='float32')
+    folds = get_time_ordered_folds(loans['issue_d'], num_folds, gap_months, train_months)
+    return FoldData(loans[['issue_d', 'loan_amnt']], features, target, folds, all_payments)
+
+def get_fold_metrics(y_true, y_pred):
+    errors = np.asarray(y_pred, dtype='float64') - np.asarray(y_true, dtype='float64')
+    total = np.sum((y_true - np.mean(y_true)) ** 2)
+    return {'rmse': np.sqrt(np.mean(errors ** 2)), 'mae': np.mean(np.abs(errors)),
+            'r2': 1 - np.sum(errors ** 2) / total if total > 0 else np.nan}
+
+def fit_and_predict(fold_data, fold, spec, n_threads):
+    '''
+    Train one model on a fold's training rows and predict its validation rows.
+
+    Args:
+        fold_data (FoldData): The data built by build_fold_data.
+        fold (int): Number of the fold.
+        spec (function or dict): A factory taking the number of threads and returning a new, untrained model, or a
+            dictionary of xgboost.train arguments such as {'params': {...}, 'num_boost_round': 100}.
+        n_threads (int): Number of threads the model may use.
+
+    Returns:
+        tuple: Returns the predictions for the validation rows and the seconds taken to train the model.
+    '''
+    train_rows, valid_rows = fold_data.folds[fold]
+    if isinstance(spec, dict):
+        import xgboost as xgb
+        dtrain, dvalid = fold_data.get_dmatrices(fold)
+        params = dict(spec.get('params', {}), nthread=n_threads)
+        start = time.perf_counter()
+        booster = xgb.train(params, dtrain, num_boost_round=spec.get('num_boost_round', 100))
+        fit_seconds = time.perf_counter() - start
+        return booster.predict(dvalid), fit_seconds
+
+    model = spec(n_threads)
+    start = time.perf_counter()
+    fit_model = model.fit(get_rows(fold_data.features, train_rows), get_rows(fold_data.target, train_rows))
+    fit_seconds = time.perf_counter() - start
+    return fit_model.predict(get_rows(fold_data.features, valid_rows)), fit_seconds
+
+def simulate_fold(fold_data, fold, predictions, simulation_months, starting_balance, investment_per_loan, min_roi):
+    '''
+    Simulate a portfolio bought from a fold's validation loans, starting the month the first of them was issued.
+
+    Returns:
+        float: Returns the annualized ROI of the simulated portfolio.
+    '''
+    valid_rows = fold_data.folds[fold][1]
+    testing_loans = fold_data.loans.iloc[valid_rows[0]:valid_rows[-1] + 1]
+    monthly_loans = bucket_loans_by_month(create_dataframe_for_simulation(testing_loans, predictions))
+    start_date = testing_loans['issue_d'].iloc[0].date().replace(day=1)
+    end_date = start_date + relativedelta(months=simulation_months)
+    portfolio = ArrayPortfolio(starting_balance, investment_per_loan, start_date, monthly_loans,
+                               fold_data.get_payments(fold), min_roi)
+    dates, balances, roi = run_portfolio_simulation(portfolio, end_date)
+    return roi
+
+def run_cross_validation(fold_data, model_specs, simulation_months=36, starting_balance=50000, investment_per_loan=100,
+                         min_roi=10.0, cpus=None, workers=None):
+    '''
+    Train and score every model on every fold.
+
+    Args:
+        fold_data (FoldData): The data built by build_fold_data. It can be reused for any number of calls.
+        model_specs (list): List of (name, spec) tuples. A spec is either a factory that takes the number of threads
+            and returns a new, untrained model, such as those from model_zoo.get_model_specs, or a dictionary of
+            xgboost.train arguments, which trains on the fold's cached DMatrix slices.
+        simulation_months (int): Number of months to simulate, starting the month of the fold's first validation loan.
+        starting_balance (float): Starting cash balance of every portfolio.
+        investment_per_loan (float): Amount to invest in each loan.
+        min_roi (float): Minimum predicted ROI a loan needs for us to buy it.
+        cpus (int or None): Number of CPUs to use. None uses every CPU available.
+        workers (int or None): Number of folds trained at the same time. Folds run in threads, because the tree
+            libraries release the GIL while training and the threads share the feature matrix and DMatrix slices.
+
+    Returns:
+        DataFrame: Returns a dataframe indexed by model name and fold with the number of training and validation
+        loans, fit seconds, RMSE, MAE, R squared and the annualized ROI of the simulated portfolio.
+    '''
+    tasks = [(name, fold) for name, spec in model_specs for fold in range(len(fold_data.folds))]
+    workers, n_threads = get_cpu_budget(len(tasks), cpus, workers)
+    specs = dict(model_specs)
+
+    # The cached data is built before the threads start so no two threads build the same fold.
+    for fold in range(len(fold_data.folds)):
+        if any(isinstance(spec, dict) for spec in specs.values()):
+            fold_data.get_dmatrices(fold)
+        fold_data.get_payments(fold)
+
+    def run_task(task):
+        name, fold = task
+        train_rows, valid_rows = fold_data.folds[fold]
+        predictions, fit_seconds = fit_and_predict(fold_data, fold, specs[name], n_threads)
+        roi = simulate_fold(fold_data, fold, predictions, simulation_months, starting_balance, investment_per_loan,
+                            min_roi)
+        return {'model': name, 'fold': fold, 'training_loans': len(train_rows), 'validation_loans': len(valid_rows),
+                'fit_seconds': fit_seconds, **get_fold_metrics(get_rows(fold_data.target, valid_rows), predictions),
+                'roi': roi}
+
+    if workers == 1:
+        results = [run_task(task) for task in tasks]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run_task, tasks))
+    return pd.DataFrame(results).set_index(['model', 'fold'])
+
+if __name__ == '__main__':
+    import pickle
+    from src.model_zoo import get_model_specs
+    loans = pd.read_pickle('data/df_EDA.pkl.bz2', compression='bz2')
+    with open('data/loan_rois.pickle', 'rb') as handle:
+        loan_rois = pickle.load(handle)
+    loans['roi'] = pd.Series(loan_rois)
+    payments = pd.concat([pd.read_pickle('data/df_payments_training_loans.pkl.bz2', compression='bz2'),
+                          pd.read_pickle('data/df_payments_testing_loans.pkl.bz2', compression='bz2')]).sort_index()
+
+    fold_data = build_fold_data(loans, payments, num_folds=5)
+    model_specs = [('xgb_train', {'params': {'objective': 'reg:squarederror', 'tree_method': 'hist', 'seed': 91},
+                                  'num_boost_round': 100})]
+    model_specs += [spec for spec in get_model_specs() if spec[0] in ('xgb', 'lgbm')]
+    results = run_cross_validation(fold_data, model_specs)
+    print(results)
+    print(results.groupby('model')[['rmse', 'mae', 'r2', 'roi']].mean())
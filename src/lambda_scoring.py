@@ -0,0 +1,211 @@
+'''
+This file contains a slim scoring entry point for the planned AWS Lambda loan picker, where the time to start a new
+instance is part of the latency. Importing src.data_cleaning loads boto3, pandas and everything in feature_engineering,
+and unpickling a model loads the whole XGBoost runtime. This module only imports NumPy, the standard library,
+tree_inference and listing_features, which are NumPy only.
+
+A trained tree model is compiled ahead of time with tree_inference.compile_tree_model into one artifact file:
+    8 bytes          Length of the JSON header, little endian.
+    JSON header      Feature columns, fill value, the listing transform from listing_features.get_listing_transform_spec
+                     (dummy categories, _missing columns and the monthly FRED rates), base score, tree depth, feature
+                     precision, and the dtype, shape and offset of each array.
+    Arrays           The trees as flat node arrays, each starting on a 64 byte boundary.
+The artifact is memory mapped when it's loaded, so no array is copied or parsed, and pages are only read from disk
+when a prediction touches them.
+
+The artifact is loaded on the first call to handler and reused by later calls on the same instance. Run this file to
+benchmark the startup time and time to first prediction against loading the pickled model with the current modules.
+'''
+
+import json
+import mmap
+import os
+import numpy as np
+from src.listing_features import ListingTransform, get_listing_transform_spec
+from src.tree_inference import CompiledTrees
+
+ARTIFACT_FILE = 'data/model_xgb.artifact'
+MODEL_FILE = 'data/model_xgb.pickle'
+ALIGNMENT = 64
+
+# Set by get_scoring_artifact the first time it's called.
+loaded_artifact = None
+
+def write_scoring_artifact(fit_model, filename=ARTIFACT_FILE, feature_columns=None, fill_value=-99,
+                           rates_directory='data'):
+    '''
+    Compile a trained tree model and the transform from raw listings to its features into a memory mappable artifact.
+
+    Args:
+        fit_model (varies): A model that has been trained to predict loan ROI, of any type supported by
+            tree_inference.compile_tree_model.
+        filename (string): Path of the artifact to write.
+        feature_columns (list or None): The columns of the training features. If None the model's feature_names_in_
+            attribute is used, which is set when a model is trained on a dataframe, or for an XGBoost Booster its
+            feature_names.
+        fill_value (int or float): Value used for features missing from a listing, the same value fill_nas uses.
+        rates_directory (string): Folder holding the FRED rate files used in training.
+    '''
+    from src.tree_inference import compile_tree_model
+    compiled = compile_tree_model(fit_model)
+    arrays = compiled.arrays
+    if feature_columns is None:
+        if hasattr(fit_model, 'feature_names_in_'):
+            feature_columns = fit_model.feature_names_in_
+        else:
+            booster = fit_model.get_booster() if hasattr(fit_model, 'get_booster') else fit_model
+            feature_columns = getattr(booster, 'feature_names', None)
+        if feature_columns is None:
+            raise ValueError('The model has no feature names, so feature_columns must be passed.')
+    listing_transform = get_listing_transform_spec(feature_columns, fill_value, rates_directory)
+    header = {'feature_columns': listing_transform['feature_columns'], 'fill_value': fill_value,
+              'listing_transform': listing_transform, 'base_score': compiled.base_score, 'max_depth': compiled.max_depth,
+              'feature_dtype': compiled.feature_dtype, 'arrays': {}}
+
+    # The offsets depend on the header's length, so lay the arrays out relative to the end of the header first.
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    with open(filename, 'wb') as f:
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+
+class ScoringArtifact:
+    '''
+    A compiled model read from a memory mapped artifact written by write_scoring_artifact.
+
+    Args:
+        filename (string): Path of the artifact.
+    '''
+    def __init__(self, filename=ARTIFACT_FILE):
+        with open(filename, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_length = int.from_bytes(self.buffer[:8], 'little')
+        header = json.loads(self.buffer[8:8 + header_length])
+        data_start = -(-(8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+        self.feature_columns = header['feature_columns']
+        self.fill_value = header['fill_value']
+        arrays = {}
+        for name, layout in header['arrays'].items():
+            count = int(np.prod(layout['shape']))
+            array = np.frombuffer(self.buffer, dtype=layout['dtype'], count=count, offset=data_start + layout['offset'])
+            arrays[name] = array.reshape(layout['shape'])
+        self.compiled_trees = CompiledTrees(arrays, header['base_score'], header['max_depth'], header['feature_dtype'])
+        # Artifacts written before the transform was stored only pass the listing's feature columns through.
+        spec = header.get('listing_transform', {'feature_columns': self.feature_columns, 'fill_value': self.fill_value})
+        self.listing_transform = ListingTransform(spec, dtype=self.compiled_trees.feature_dtype)
+
+    def get_features(self, listings):
+        '''
+        Convert listings to a feature matrix without pandas. See ListingTransform.get_features.
+        '''
+        return self.listing_transform.get_features(listings)
+
+    def predict(self, listings):
+        return self.compiled_trees.predict(self.get_features(listings))
+
+def get_scoring_artifact(filename=ARTIFACT_FILE):
+    global loaded_artifact
+    if loaded_artifact is None:
+        loaded_artifact = ScoringArtifact(filename)
+    return loaded_artifact
+
+def handler(event, context=None):
+    '''
+    AWS Lambda entry point.
+
+    Args:
+        event (dict): {"loan": {...}} or {"loans": [{...}, ...]} where each loan maps raw LoanStats columns or feature
+            names to values.
+        context (LambdaContext or None): Unused.
+
+    Returns:
+        dict: Returns {"predicted_roi": [...]} with one prediction per loan, or {"statusCode": 400, "error": "..."} if
+        the event or one of its loans is malformed.
+    '''
+    try:
+        listings = [event['loan']] if 'loan' in event else event['loans']
+        if not isinstance(listings, list):
+            raise TypeError
+    except (KeyError, TypeError):
+        return {'statusCode': 400, 'error': 'The event must have a "loan" object or a "loans" list.'}
+    artifact = get_scoring_artifact(os.environ.get('SCORING_ARTIFACT', ARTIFACT_FILE))
+    try:
+        features = artifact.get_features(listings)
+    except ValueError as e:
+        return {'statusCode': 400, 'error': str(e)}
+    return {'predicted_roi': artifact.compiled_trees.predict(features).tolist()}
+
+# Each startup benchmark runs in a fresh interpreter so nothing is already imported. The script prints the seconds
+# spent importing and the seconds until the first prediction was returned.
+STARTUP_SCRIPTS = {
+    'lambda_scoring': '''
+import time
+start = time.perf_counter()
+from src.lambda_scoring import handler
+imported = time.perf_counter()
+handler({{'loan': {listing}}})
+print(imported - start, time.perf_counter() - start)
+''',
+    'current_modules': '''
+import time
+start = time.perf_counter()
+import pickle
+import pandas as pd
+from src.data_cleaning import *
+from src.modeling import get_predictions
+imported = time.perf_counter()
+with open({model_file!r}, 'rb') as f:
+    fit_model = pickle.load(f)
+get_predictions(fit_model, pd.DataFrame([{listing}]).reindex(columns=fit_model.feature_names_in_).fillna(-99))
+print(imported - start, time.perf_counter() - start)
+''',
+}
+
+def benchmark_startup(listing, artifact_file=ARTIFACT_FILE, model_file=MODEL_FILE, repeats=5):
+    '''
+    Measure the cold start of the slim entry point against the current modules.
+
+    Args:
+        listing (dict): A loan listing mapping feature names to values.
+        artifact_file (string): Path of the artifact written by write_scoring_artifact.
+        model_file (string): Path of the same model pickled.
+        repeats (int): Number of fresh interpreters started for each entry point.
+
+    Returns:
+        dict: Dictionary where the key is the entry point and the value is a dictionary of the median import time and
+        median time to first prediction in milliseconds.
+    '''
+    # Only the benchmark needs these, so they aren't imported when the module is loaded.
+    import subprocess
+    import sys
+    env = dict(os.environ, SCORING_ARTIFACT=artifact_file)
+    results = {}
+    for name, script in STARTUP_SCRIPTS.items():
+        script = script.format(listing=repr(listing), model_file=model_file)
+        timings = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True, env=env)
+            timings.append([float(seconds) for seconds in output.stdout.split()[-2:]])
+        timings = 1000 * np.median(np.array(timings), axis=0)
+        results[name] = {'import_ms': timings[0], 'first_prediction_ms': timings[1]}
+    return results
+
+if __name__ == '__main__':
+    import pickle
+    import pandas as pd
+    with open(MODEL_FILE, 'rb') as f:
+        fit_model = pickle.load(f)
+    write_scoring_artifact(fit_model, ARTIFACT_FILE)
+    X_test = pd.read_pickle('data/X_test.pkl.bz2', compression='bz2')
+    listing = X_test[list(fit_model.feature_names_in_)].iloc[0].to_dict()
+    print(benchmark_startup(listing))
@@ -0,0 +1,235 @@
+'''
+This file turns loan listings into the feature matrix a trained model expects, one listing at a time, for the scoring
+service and the Lambda entry point. Training runs every loan through data_cleaning.clean_and_prepare_raw_data_for_model,
+which needs pandas and the whole data set, so this file repeats the steps of that pipeline that only depend on the loan
+itself:
+    int_rate and revol_util         '16.37%' becomes 16.37.
+    emp_length                      '10+ years' becomes 10. '< 1 year' ends up missing, as it does in training.
+    Dummy columns                   grade, home_ownership, verification_status, purpose and addr_state become the
+                                    columns made by feature_engineering.create_dummy_cols.
+    _missing columns                1 when the column they flag is missing, like create_missing_data_boolean_columns.
+    Supplemental rates              The FRED rates of the issue month and the loan's interest rate minus each of them.
+    mths_since_earliest_cr          Months between earliest_cr_line and issue_d.
+Everything else is passed through as a number, and features that are still missing get the fill value, like fill_nas.
+
+A listing can hold raw LoanStats columns, the model's feature columns, or both. A feature the listing already holds is
+never recomputed, so rows of X_test keep scoring exactly as they did. Which steps apply is worked out once from the
+model's feature columns by get_listing_transform_spec, and the result is a plain dictionary, so it can be stored as JSON
+in the Lambda artifact. This file only imports NumPy and the standard library.
+'''
+
+import bisect
+import csv
+import datetime
+import math
+import os
+import re
+import numpy as np
+from src.columns import dummy_prefixes
+
+RATE_COLUMNS = ('int_rate', 'revol_util')
+# The FRED files read by feature_engineering.add_supplemental_rate_data, the rate column of each one, and the column
+# it becomes in the features.
+SUPPLEMENTAL_RATE_FILES = (('inflation_expectations.csv', 'MICH', 'expected_inflation'),
+                           ('MORTGAGE30US.csv', 'MORTGAGE30US', 'us_mortgage_rate'),
+                           ('MPRIME.csv', 'MPRIME', 'prime_rate'))
+RATE_DIFFERENCE_COLUMNS = {'int_minus_inflation': 'expected_inflation', 'int_minus_mortgage': 'us_mortgage_rate',
+                           'int_minus_prime': 'prime_rate'}
+# feature_engineering.create_months_since_earliest_cl_col divides by np.timedelta64(1, 'M'), which is this many days.
+DAYS_PER_MONTH = 30.436875
+
+def read_supplemental_rates(rates_directory='data'):
+    '''
+    Read the monthly FRED rates, keeping the months present in every file like the merges in add_supplemental_rate_data.
+
+    Args:
+        rates_directory (string): Folder holding the FRED files.
+
+    Returns:
+        dict: Dictionary containing 'columns', the feature name of each rate, 'months', sorted 'YYYY-MM' strings, and
+        'values', a list of rates for each month.
+    '''
+    rates_by_month = {}
+    for filename, rate_column, _ in SUPPLEMENTAL_RATE_FILES:
+        with open(os.path.join(rates_directory, filename), newline='') as f:
+            for row in csv.DictReader(f):
+                try:
+                    rate = float(row[rate_column])
+                except ValueError:
+                    # FRED writes '.' for months without a value.
+                    continue
+                rates_by_month.setdefault(row['DATE'][:7], []).append(rate)
+    months = sorted(month for month, rates in rates_by_month.items() if len(rates) == len(SUPPLEMENTAL_RATE_FILES))
+    return {'columns': [feature for _, _, feature in SUPPLEMENTAL_RATE_FILES], 'months': months,
+            'values': [rates_by_month[month] for month in months]}
+
+def get_listing_transform_spec(feature_columns, fill_value=-99, rates_directory='data'):
+    '''
+    Work out which steps of the training pipeline a model's features need.
+
+    Args:
+        feature_columns (list): The columns of the training features, in order.
+        fill_value (int or float): Value used for features that are missing, the same value fill_nas uses.
+        rates_directory (string): Folder holding the FRED files. They're only read if the features use the rates.
+
+    Returns:
+        dict: A JSON serializable description of the transform, passed to ListingTransform.
+    '''
+    feature_columns = [str(col) for col in feature_columns]
+    dummies = {}
+    for col in feature_columns:
+        if col.endswith('_missing'):
+            continue
+        for prefix, raw_col in dummy_prefixes.items():
+            if col.startswith(prefix):
+                dummies.setdefault(raw_col, [prefix, []])[1].append(col[len(prefix):])
+    rate_features = {feature for _, _, feature in SUPPLEMENTAL_RATE_FILES} | set(RATE_DIFFERENCE_COLUMNS)
+    uses_rates = any(col in rate_features for col in feature_columns)
+    return {'feature_columns': feature_columns, 'fill_value': fill_value, 'dummies': dummies,
+            'missing_columns': {col: col[:-len('_missing')] for col in feature_columns if col.endswith('_missing')},
+            'supplemental_rates': read_supplemental_rates(rates_directory) if uses_rates else None}
+
+def is_missing(value):
+    return value is None or value == '' or (isinstance(value, float) and math.isnan(value))
+
+def parse_rate(value):
+    if isinstance(value, str):
+        value = value.strip().rstrip('%')
+    return float(value)
+
+def parse_employment_length(value):
+    if isinstance(value, str):
+        # clean_employment_length swaps '< 1 year' for the number 0, which .str.extract then turns into NaN, so the
+        # model was trained with these loans missing.
+        if value.strip() == '< 1 year':
+            return None
+        digits = re.search(r'\d+', value)
+        return float(digits.group()) if digits else None
+    return float(value)
+
+def parse_month(value):
+    '''
+    Parse a LoanStats date such as 'Dec-2018', 'Dec-18' or '18-Dec', or an ISO date such as '2018-12-01', to the first
+    day of its month. Dates and datetimes are also accepted.
+    '''
+    if isinstance(value, datetime.date):
+        return datetime.date(value.year, value.month, 1)
+    value = str(value).strip()
+    if value[:1].isdigit() and '-' in value and value.split('-')[1].isalpha():
+        value = value.rjust(6, '0')
+    for date_format in ('%b-%Y', '%b-%y', '%y-%b', '%Y-%m-%d', '%Y-%m'):
+        try:
+            date = datetime.datetime.strptime(value[:10] if date_format == '%Y-%m-%d' else value, date_format)
+        except ValueError:
+            continue
+        return datetime.date(date.year, date.month, 1)
+    raise ValueError(f'{value!r} is not a date')
+
+class ListingTransform:
+    '''
+    Converts listings to a feature matrix using a spec from get_listing_transform_spec.
+
+    Args:
+        spec (dict): The spec, for example read back from the JSON header of a Lambda artifact. Only feature_columns is
+            required, and a spec with nothing else passes the listing's feature columns through.
+        dtype (string): Data type of the feature matrix.
+    '''
+    def __init__(self, spec, dtype='float32'):
+        self.spec = spec
+        self.feature_columns = list(spec['feature_columns'])
+        self.column_positions = {col: i for i, col in enumerate(self.feature_columns)}
+        self.fill_value = spec.get('fill_value', -99)
+        self.dummies = spec.get('dummies', {})
+        self.missing_columns = spec.get('missing_columns', {})
+        self.supplemental_rates = spec.get('supplemental_rates')
+        self.dtype = dtype
+
+    def get_rates(self, issue_month):
+        '''
+        Get the FRED rates of a loan's issue month. Listings for a month past the end of the files get the latest rates.
+        '''
+        rates = self.supplemental_rates
+        if issue_month is None:
+            position = len(rates['months']) - 1
+        else:
+            position = max(bisect.bisect_right(rates['months'], f'{issue_month.year}-{issue_month.month:02d}') - 1, 0)
+        return dict(zip(rates['columns'], rates['values'][position]))
+
+    def transform_listing(self, listing):
+        '''
+        Make the model's features from one listing.
+
+        Args:
+            listing (dict): Maps raw LoanStats columns or feature names to values.
+
+        Returns:
+            dict: Returns a dictionary mapping feature names to values. Features that couldn't be made are left out.
+        '''
+        cleaned = {}
+        for col in RATE_COLUMNS:
+            if col in listing and not is_missing(listing[col]):
+                cleaned[col] = parse_rate(listing[col])
+        if 'emp_length' in listing and not is_missing(listing['emp_length']):
+            cleaned['emp_length'] = parse_employment_length(listing['emp_length'])
+
+        # fill_nas runs before the dummies are made, so a missing category gets a 0 in every dummy column.
+        for raw_col, (prefix, categories) in self.dummies.items():
+            if raw_col in listing:
+                for category in categories:
+                    cleaned[prefix + category] = int(listing[raw_col] == category)
+
+        issue_month = parse_month(listing['issue_d']) if not is_missing(listing.get('issue_d')) else None
+        if self.supplemental_rates is not None:
+            cleaned.update(self.get_rates(issue_month))
+            int_rate = cleaned.get('int_rate', listing.get('int_rate'))
+            if not is_missing(int_rate):
+                for col, rate_col in RATE_DIFFERENCE_COLUMNS.items():
+                    cleaned[col] = float(int_rate) - cleaned[rate_col]
+        if issue_month is not None and not is_missing(listing.get('earliest_cr_line')):
+            days = (issue_month - parse_month(listing['earliest_cr_line'])).days
+            cleaned['mths_since_earliest_cr'] = round(days / DAYS_PER_MONTH)
+
+        for col, flagged_col in self.missing_columns.items():
+            cleaned[col] = int(is_missing(cleaned.get(flagged_col, listing.get(flagged_col))))
+
+        # Features the listing already holds win over the ones made from raw columns.
+        features = {col: value for col, value in cleaned.items() if col not in listing}
+        features.update(listing)
+        for col in RATE_COLUMNS + ('emp_length',):
+            if col in cleaned:
+                features[col] = cleaned[col]
+        return features
+
+    def get_features(self, listings):
+        '''
+        Convert listings to the feature matrix the model was trained on. Features that are missing or null get the fill
+        value.
+
+        Args:
+            listings (list of dicts): Each listing maps raw LoanStats columns or feature names to values. Extra keys are
+                ignored.
+
+        Returns:
+            array: Returns an array with one row per listing and one column per feature.
+
+        Raises:
+            ValueError: If a listing isn't an object, one of its dates can't be parsed, or one of its features isn't a
+                number.
+        '''
+        features = np.full((len(listings), len(self.feature_columns)), self.fill_value, dtype=self.dtype)
+        for row, listing in enumerate(listings):
+            if not isinstance(listing, dict):
+                raise ValueError(f'Loan {row} must be an object mapping feature names to values.')
+            try:
+                values = self.transform_listing(listing)
+            except (ValueError, TypeError) as e:
+                raise ValueError(f'Loan {row} could not be converted to features: {e}')
+            for col, value in values.items():
+                position = self.column_positions.get(col)
+                if position is None or is_missing(value):
+                    continue
+                try:
+                    features[row, position] = value
+                except (ValueError, TypeError):
+                    raise ValueError(f'Feature {col} of loan {row} must be a number, not {value!r}.')
+        return features
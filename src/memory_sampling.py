@@ -0,0 +1,65 @@
+'''
+This file contains helpers for measuring a process's memory, shared by the benchmarks, the model zoo and the stage
+profiler. The operating system only keeps the peak resident memory of a whole process, so PeakMemorySampler samples it
+from a background thread to get the peak of a single step.
+'''
+
+import os
+import platform
+import resource
+import threading
+
+def get_rss_mb():
+    '''
+    Get the resident memory of this process in MB. Where /proc isn't available the peak memory of the process is
+    returned instead.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        # ru_maxrss is in KB on Linux and bytes on macOS.
+        scale = 2**20 if platform.system() == 'Darwin' else 2**10
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def get_private_rss_mb():
+    '''
+    Get the resident memory of this process in MB, leaving out pages shared with other processes such as shared memory
+    blocks and the loaded libraries. Where /proc isn't available all resident memory is returned instead.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            fields = f.read().split()
+        return (int(fields[1]) - int(fields[2])) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return get_rss_mb()
+
+class PeakMemorySampler:
+    '''
+    Context manager that samples the process's resident memory from a background thread and keeps the highest value.
+
+    Args:
+        interval (float): Seconds between samples.
+        get_memory (function): Function returning the memory to sample in MB, for example get_private_rss_mb.
+    '''
+    def __init__(self, interval=0.005, get_memory=get_rss_mb):
+        self.interval = interval
+        self.get_memory = get_memory
+        self.stopped = threading.Event()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, self.get_memory())
+
+    def __enter__(self):
+        self.start_mb = self.get_memory()
+        self.peak_mb = self.start_mb
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        self.peak_mb = max(self.peak_mb, self.get_memory())
+        return False
@@ -0,0 +1,212 @@
+'''
+This file contains a harness for training and evaluating several models at once. Modeling.ipynb trains each model one
+after another and every library picks its own number of threads, which leaves cores idle for single threaded models and
+oversubscribes them when two multithreaded libraries run together. Here the CPUs are split into a number of worker
+processes times a number of threads per model, and each model is told how many threads it may use.
+
+The training and testing features are copied once into shared memory as float32 arrays. Every worker process reads
+the same copy instead of receiving its own pickled dataframe. Each model is trained in its own worker process, which
+samples its memory from just before the model is fit until it has predicted, and the predictions of every model are
+simulated together with simulate_multiple_strategies.
+'''
+
+import multiprocessing as mp
+import os
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from src.memory_sampling import PeakMemorySampler, get_private_rss_mb
+from src.modeling import create_dataframe_for_simulation
+from src.portfolio import simulate_multiple_strategies
+
+# Set by run_model_zoo before the process pool is created, so forked workers can find each spec's factory by name.
+zoo_model_specs = None
+
+# Parameters the tree libraries use for their number of threads. Models without one, such as scikit-learn's decision
+# tree and gradient boosting, always run on a single thread.
+THREAD_PARAMS = ('n_jobs', 'nthread', 'thread_count', 'num_threads')
+
+def get_model_specs(random_state=91):
+    '''
+    Get the models trained in Modeling.ipynb as specs for run_model_zoo. The libraries are imported when a model is
+    created, so specs for libraries that aren't installed can be removed before running the zoo.
+
+    Args:
+        random_state (int): Seed passed to every model.
+
+    Returns:
+        list: List of (name, factory) tuples, where factory takes the number of threads the model may use and returns
+        a new, untrained model.
+    '''
+    def xgb(n_threads):
+        from xgboost import XGBRegressor
+        return XGBRegressor(objective='reg:squarederror', n_jobs=n_threads, random_state=random_state)
+
+    # dt and gbrt have no threads parameter, so they ignore n_threads and run single threaded.
+    def dt(n_threads):
+        from sklearn.tree import DecisionTreeRegressor
+        return DecisionTreeRegressor(random_state=random_state)
+
+    def rf(n_threads):
+        from sklearn.ensemble import RandomForestRegressor
+        return RandomForestRegressor(max_features='sqrt', n_jobs=n_threads, random_state=random_state)
+
+    def gbrt(n_threads):
+        from sklearn.ensemble import GradientBoostingRegressor
+        return GradientBoostingRegressor(random_state=random_state)
+
+    def lgbm(n_threads):
+        from lightgbm import LGBMRegressor
+        return LGBMRegressor(n_jobs=n_threads, random_state=random_state, verbose=-1)
+
+    def catboost(n_threads):
+        from catboost import CatBoostRegressor
+        return CatBoostRegressor(verbose=False, thread_count=n_threads, random_state=random_state)
+
+    return [('xgb', xgb), ('dt', dt), ('rf', rf), ('gbrt', gbrt), ('lgbm', lgbm), ('catboost', catboost)]
+
+def get_cpu_budget(num_models, cpus=None, processes=None):
+    '''
+    Split the CPUs between worker processes and threads per model.
+
+    Args:
+        num_models (int): Number of models to train.
+        cpus (int or None): Number of CPUs to use. None uses every CPU available to this process.
+        processes (int or None): Number of models to train at the same time. None trains as many models at once as
+            there are CPUs, up to the number of models.
+
+    Returns:
+        tuple: Returns the number of processes and the number of threads each model may use.
+    '''
+    if cpus is None:
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    if processes is None:
+        processes = min(num_models, cpus)
+    processes = max(min(processes, num_models, cpus), 1)
+    return processes, max(cpus // processes, 1)
+
+def copy_to_shared_memory(array):
+    '''
+    Copy an array into a new block of shared memory.
+
+    Args:
+        array (array): The array to copy.
+
+    Returns:
+        tuple: Returns the SharedMemory block and a (name, shape, dtype) tuple workers use to attach to it.
+    '''
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+def attach_shared_array(description):
+    name, shape, dtype = description
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def get_model_threads(model, n_threads):
+    '''
+    Get the number of threads a model will actually use: n_threads if it has a threads parameter, otherwise 1.
+    '''
+    params = model.get_params() if hasattr(model, 'get_params') else {}
+    return n_threads if any(param in params for param in THREAD_PARAMS) else 1
+
+def train_and_predict(task):
+    '''
+    Train one model and predict the testing loans. This is the function mapped over the process pool.
+
+    Args:
+        task (tuple): Tuple of (model name, threads per model, shared X_train, shared y_train, shared X_test).
+
+    Returns:
+        dict: Returns the model name, its predictions, the threads it used, fit and predict time, and how far the
+        worker's memory rose above its level just before the fit. Shared memory, such as the features, isn't counted,
+        and neither is memory the worker inherited from the parent process.
+    '''
+    name, n_threads, X_train_description, y_train_description, X_test_description = task
+    factory = dict(zoo_model_specs)[name]
+    blocks = []
+    try:
+        block, X_train = attach_shared_array(X_train_description)
+        blocks.append(block)
+        block, y_train = attach_shared_array(y_train_description)
+        blocks.append(block)
+        block, X_test = attach_shared_array(X_test_description)
+        blocks.append(block)
+
+        # The model is created before the timer starts so the library import isn't counted as fit time.
+        model = factory(n_threads)
+        # ru_maxrss would include the parent's peak, which a forked worker inherits, so memory is sampled instead.
+        with PeakMemorySampler(get_memory=get_private_rss_mb) as memory:
+            start = time.perf_counter()
+            fit_model = model.fit(X_train, y_train)
+            fit_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            predictions = np.asarray(fit_model.predict(X_test), dtype='float64')
+            predict_seconds = time.perf_counter() - start
+    finally:
+        for block in blocks:
+            block.close()
+    return {'name': name, 'predictions': predictions, 'threads': get_model_threads(model, n_threads),
+            'fit_seconds': fit_seconds, 'predict_seconds': predict_seconds,
+            'rss_growth_mb': memory.peak_mb - memory.start_mb}
+
+def run_model_zoo(model_specs, X_train, y_train, X_test, testing_loans, all_payments, start_date, end_date,
+                  starting_balance=50000, investment_per_loan=100, min_roi=10.0, cpus=None, processes=None):
+    '''
+    Train every model, predict the ROI of the testing loans and simulate a portfolio with each model's predictions.
+
+    Args:
+        model_specs (list): List of (name, factory) tuples, such as those from get_model_specs. Each factory takes the
+            number of threads the model may use and returns a new, untrained model.
+        X_train (dataframe): Dataframe of training features.
+        y_train (series): The ROI of the training loans.
+        X_test (dataframe): Dataframe of testing features, with the same columns as X_train.
+        testing_loans (dataframe): The testing loans indexed by loan id, in the same order as X_test and containing
+            issue_d and loan_amnt. Used to create the simulation dataframes.
+        all_payments (dataframe): Payments for the testing loans with a multi-level index of payment date and loan ID.
+        start_date (datetime.date): The first month of the simulation.
+        end_date (datetime.date): The simulation stops before this month.
+        starting_balance (float): Starting cash balance of every portfolio.
+        investment_per_loan (float): Amount to invest in each loan.
+        min_roi (float): Minimum predicted ROI a loan needs for us to buy it.
+        cpus (int or None): Number of CPUs to use. None uses every CPU available.
+        processes (int or None): Number of models to train at the same time. See get_cpu_budget.
+
+    Returns:
+        tuple: Returns a results dataframe indexed by model name with the threads used, fit and predict time in
+        seconds, memory growth during fit and predict in MB and simulated annualized ROI of each model, and a dictionary of each model's
+        dataframe from create_dataframe_for_simulation.
+    '''
+    global zoo_model_specs
+    zoo_model_specs = model_specs
+    processes, n_threads = get_cpu_budget(len(model_specs), cpus, processes)
+
+    blocks = []
+    try:
+        block, X_train_description = copy_to_shared_memory(np.ascontiguousarray(X_train, dtype='float32'))
+        blocks.append(block)
+        block, y_train_description = copy_to_shared_memory(np.ascontiguousarray(y_train, dtype='float32'))
+        blocks.append(block)
+        block, X_test_description = copy_to_shared_memory(np.ascontiguousarray(X_test, dtype='float32'))
+        blocks.append(block)
+
+        tasks = [(name, n_threads, X_train_description, y_train_description, X_test_description)
+                 for name, factory in model_specs]
+        # A new process for every model, so memory left over from one model isn't counted in the next one's baseline.
+        with mp.get_context('fork').Pool(processes=processes, maxtasksperchild=1) as pool:
+            results = pool.map(train_and_predict, tasks, chunksize=1)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    predictions_by_model = {result['name']: create_dataframe_for_simulation(testing_loans, result.pop('predictions'))
+                            for result in results}
+    dates, balances, rois = simulate_multiple_strategies(all_payments, predictions_by_model, start_date, end_date,
+                                                         starting_balance, investment_per_loan, min_roi)
+    results = pd.DataFrame(results).set_index('name')
+    results['roi'] = pd.Series(rois)
+    return results, predictions_by_model
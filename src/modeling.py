@@ -1,4 +1,6 @@
 # Code to start training and testing a model once the data has been cleaned.
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 
 def split_data_into_labels_and_target(df):
@@ -27,11 +29,11 @@ def split_training_and_testing_data(df, split_date):
 
     Returns:
         Dataframes: Returns 2 dataframes, one for training the model and another for testing.
-
-    TODO: Apply masks and use .loc to select relevant loans.
     '''
-    training_loans = df[df['issue_d'].isin(pd.date_range('2010-01-01', split_date)) == True]
-    testing_loans = df[df['issue_d'].isin(pd.date_range('2010-01-01', split_date)) == False]
+    # The mask is built once and used for both selections. backtesting.py splits by position for many split dates.
+    in_training_period = df['issue_d'].between(pd.Timestamp('2010-01-01'), pd.Timestamp(split_date))
+    training_loans = df.loc[in_training_period, :]
+    testing_loans = df.loc[~in_training_period, :]
     return training_loans, testing_loans
 
 def train_model(model, X_train, y_train):
@@ -67,6 +69,83 @@ def get_predictions(fit_model, X_test):
     return fit_model.predict(X_test)
 
 def create_dataframe_for_simulation(loan_df, predictions):
-    simulation_df = loan_df.copy(deep=True)
-    simulation_df['predicted_roi'] = predictions
-    return simulation_df[['issue_d', 'loan_amnt', 'predicted_roi']].reset_index(level=0).set_index('issue_d')
\ No newline at end of file
+    '''
+    Create the dataframe of loans and their predicted ROI used by the portfolio simulation. Only the columns the
+    simulation needs are taken from loan_df, so the full loan dataframe isn't copied.
+
+    Args:
+        loan_df (dataframe): Dataframe of testing loans indexed by loan id, containing issue_d and loan_amnt.
+        predictions (array or series): Predicted ROI of each loan, in the same order as loan_df or indexed by loan id.
+
+    Returns:
+        DataFrame: Returns a dataframe indexed by issue_d, sorted by issue date, with the columns id, loan_amnt and
+        predicted_roi. Loans issued on the same date keep their order from loan_df.
+    '''
+    simulation_df = loan_df[['issue_d', 'loan_amnt']].assign(predicted_roi=predictions)
+    return simulation_df.reset_index(level=0).set_index('issue_d').sort_index(kind='stable')
+
+def get_feature_matrix(X):
+    '''
+    Convert the features to the float32, row-major array the tree libraries predict from. Doing this once lets every
+    model score the same array instead of each one converting the dataframe again.
+
+    Args:
+        X (dataframe): Dataframe of features, for example X_test.
+
+    Returns:
+        array: Returns a C-contiguous float32 array of the features.
+    '''
+    return np.ascontiguousarray(X, dtype='float32')
+
+def get_batch_predictions(fit_models, X_test, loan_df, chunk_size=100000, n_threads=1):
+    '''
+    Get the predicted ROI of every model for the testing loans. The features are converted once and each model
+    predicts chunk_size rows at a time, so the memory a model's predict call uses doesn't grow with the number of loans.
+
+    Args:
+        fit_models (dict): Dictionary where the key is the model name, for example 'xgb', and the value is a model
+            that has been trained to predict loan ROI.
+        X_test (dataframe): Dataframe of features in our testing dataset.
+        loan_df (dataframe): Dataframe of testing loans indexed by loan id, in the same order as X_test and containing
+            issue_d and loan_amnt.
+        chunk_size (int): Number of rows each predict call scores.
+        n_threads (int): Number of chunks scored at the same time. The tree libraries release the GIL while
+            predicting, so threads can run in parallel.
+
+    Returns:
+        DataFrame: Returns a dataframe indexed by issue_d, sorted by issue date, with the columns id and loan_amnt
+        followed by one column of predicted ROI per model.
+    '''
+    features = get_feature_matrix(X_test)
+    names = list(fit_models)
+    predictions = np.empty((len(features), len(names)))
+    chunks = [(column, start) for column in range(len(names)) for start in range(0, len(features), chunk_size)]
+
+    def predict_chunk(chunk):
+        column, start = chunk
+        rows = features[start:start + chunk_size]
+        predictions[start:start + len(rows), column] = fit_models[names[column]].predict(rows)
+
+    if n_threads == 1:
+        for chunk in chunks:
+            predict_chunk(chunk)
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(predict_chunk, chunks))
+
+    prediction_df = loan_df[['issue_d', 'loan_amnt']].assign(**dict(zip(names, predictions.T)))
+    return prediction_df.reset_index(level=0).set_index('issue_d').sort_index(kind='stable')
+
+def get_simulation_dataframe(prediction_df, name):
+    '''
+    Select one model's predictions from get_batch_predictions in the format created by create_dataframe_for_simulation.
+
+    Args:
+        prediction_df (dataframe): The dataframe returned by get_batch_predictions.
+        name (string): The name of the model.
+
+    Returns:
+        DataFrame: Returns a dataframe indexed by issue_d with the columns id, loan_amnt and predicted_roi.
+    '''
+    id_col = prediction_df.columns[0]
+    return prediction_df[[id_col, 'loan_amnt', name]].rename(columns={name: 'predicted_roi'})
@@ -0,0 +1,189 @@
+'''
+This file contains a Monte Carlo version of the portfolio simulation. The regular simulation assumes we can buy every
+top ranked loan in the month it was issued. In reality we compete with other investors, so a loan may not be available
+to us, we may only get part of the amount we wanted, and we may buy it a little later than its issue month.
+
+Instead of creating thousands of Portfolio objects, every path of a simulation is a row in a set of NumPy arrays with
+one column per loan that meets the minimum ROI. Each month is applied to all paths at once.
+'''
+
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from src.portfolio import (bucket_payments_by_month, filter_payments_for_simulation, get_annualized_roi, get_month_ordinal,
+                           get_simulation_dates)
+from src.portfolio_metrics import get_max_drawdowns
+
+# Holding status of a loan within a path.
+NOT_OWNED = 0
+OWNED = 1
+CLOSED = 2
+
+# These are set by simulate_monte_carlo_paths before the process pool is created. The worker processes are forked,
+# so they inherit the candidate loans and bucketed payments without them being copied to every worker.
+mc_candidates = None
+mc_monthly_payments = None
+
+def get_candidate_loans(model_predictions, min_roi):
+    '''
+    Get the loans that meet our minimum ROI, ranked from the highest predicted ROI to the lowest. Every path buys loans
+    in this order, so it only needs to be sorted once.
+
+    Args:
+        model_predictions (dataframe): The dataframe created by modeling.create_dataframe_for_simulation.
+        min_roi (float): Minimum predicted ROI a loan needs for us to buy it.
+
+    Returns:
+        dict: Dictionary of arrays for the ranked loans. Keys are 'ids', 'loan_amounts' and 'issue_months', where issue
+        months are month ordinals from portfolio.get_month_ordinal.
+    '''
+    loans = model_predictions.loc[model_predictions['predicted_roi'] >= min_roi, :]
+    order = np.argsort(-loans['predicted_roi'].to_numpy(), kind='stable')
+    issue_dates = pd.DatetimeIndex(loans.index)
+    issue_months = np.asarray(12 * issue_dates.year + issue_dates.month - 1, dtype='int64')
+    return {'ids': loans['id'].to_numpy(dtype='int64')[order],
+            'loan_amounts': loans['loan_amnt'].to_numpy(dtype='float64')[order],
+            'issue_months': issue_months[order]}
+
+def simulate_path_chunk(task):
+    '''
+    Simulate a chunk of paths as one set of arrays. This is the function mapped over the process pool, so it reads
+    the candidate loans and payments from the module level variables set up by simulate_monte_carlo_paths.
+
+    Args:
+        task (tuple): Tuple of (seed_sequence, num_paths, dates, starting_balance, investment_per_loan, availability,
+            min_fill, listing_window_months).
+
+    Returns:
+        array: Returns an array of the total balance of every path (rows) at the start of every month (columns).
+    '''
+    (seed_sequence, num_paths, dates, starting_balance, investment_per_loan, availability, min_fill,
+     listing_window_months) = task
+    rng = np.random.default_rng(seed_sequence)
+    loan_amounts = mc_candidates['loan_amounts']
+    issue_months = mc_candidates['issue_months']
+    num_loans = len(loan_amounts)
+
+    # Every random draw is made up front, one value per path and loan.
+    available = rng.random((num_paths, num_loans)) < availability
+    fill_fraction = rng.uniform(min_fill, 1.0, size=(num_paths, num_loans)).astype('float32')
+    investments = np.minimum(investment_per_loan * fill_fraction, loan_amounts.astype('float32'))
+    purchase_delays = rng.integers(0, listing_window_months, size=(num_paths, num_loans), dtype='int16')
+
+    statuses = np.full((num_paths, num_loans), NOT_OWNED, dtype='int8')
+    principal_balances = np.zeros((num_paths, num_loans), dtype='float32')
+    months_since_last_payment = np.zeros((num_paths, num_loans), dtype='int16')
+    cash_balances = np.full(num_paths, starting_balance, dtype='float64')
+    total_balances = np.empty((num_paths, len(dates)), dtype='float64')
+    total_balances[:, 0] = starting_balance
+
+    for t, date in enumerate(dates[:-1]):
+        month = get_month_ordinal(date)
+
+        # Buy loans listed in this month's window, best predicted ROI first, until each path runs out of cash.
+        cols = np.flatnonzero((issue_months > month - listing_window_months) & (issue_months <= month))
+        if len(cols) > 0:
+            buyable = (available[:, cols] & (purchase_delays[:, cols] == month - issue_months[cols])
+                       & (statuses[:, cols] == NOT_OWNED))
+            # Like Portfolio.get_top_loans_to_buy, the budget is based on the amount we asked for rather than the amount
+            # invested, which can be smaller when the loan itself is smaller than our investment.
+            requested = np.where(buyable, investment_per_loan * fill_fraction[:, cols], 0)
+            bought = buyable & (np.cumsum(requested, axis=1, dtype='float64') <= cash_balances[:, None])
+            costs = investments[:, cols]
+            cash_balances -= np.where(bought, costs, 0).sum(axis=1, dtype='float64')
+            statuses[:, cols] = np.where(bought, OWNED, statuses[:, cols])
+            principal_balances[:, cols] = np.where(bought, costs, principal_balances[:, cols])
+            months_since_last_payment[:, cols] = np.where(bought, 0, months_since_last_payment[:, cols])
+
+        # Payments are summed per loan once and then applied to every path that owns the loan.
+        payments = mc_monthly_payments.get_month(date)
+        if len(payments.loan_positions) > 0:
+            cols, inverse = np.unique(payments.loan_positions, return_inverse=True)
+            received = np.bincount(inverse, weights=payments.received)
+            end_principal = np.full(len(cols), np.inf)
+            np.minimum.at(end_principal, inverse, payments.end_principal)
+            owned = statuses[:, cols] == OWNED
+            fractional_investments = investments[:, cols] / loan_amounts[cols]
+            cash_balances += np.where(owned, fractional_investments * received, 0).sum(axis=1)
+            principal_balances[:, cols] = np.where(owned, fractional_investments * end_principal, principal_balances[:, cols])
+            months_since_last_payment[:, cols] = np.where(owned, 0, months_since_last_payment[:, cols])
+
+        months_since_last_payment += 1
+        defaulted = (statuses == OWNED) & (months_since_last_payment > 4)
+        statuses[defaulted] = CLOSED
+        principal_balances[defaulted] = 0
+
+        total_balances[:, t + 1] = cash_balances + principal_balances.sum(axis=1, dtype='float64')
+    return total_balances
+
+def simulate_monte_carlo_paths(all_payments, model_predictions, start_date, end_date, starting_balance, investment_per_loan,
+                               min_roi, num_paths=1000, availability=0.8, min_fill=0.5, listing_window_months=1, seed=91,
+                               paths_per_chunk=128, processes=None):
+    '''
+    Run a Monte Carlo simulation of our portfolio where loan availability, fill sizes and purchase months are random.
+
+    Each path follows the same rules as portfolio.ArrayPortfolio, except that:
+        - Each loan is available to a path with probability `availability`.
+        - A path gets a random fraction between `min_fill` and 1 of the amount it wanted to invest in a loan.
+        - A path can buy a loan in its issue month or up to `listing_window_months - 1` months later. Payments made
+          before the purchase month are not received.
+    With availability=1, min_fill=1 and listing_window_months=1 every path matches the regular simulation.
+
+    Paths are simulated in chunks of `paths_per_chunk` across a process pool. Each chunk gets its own seed spawned from
+    `seed`, so results are reproducible and don't depend on the number of processes.
+
+    Args:
+        all_payments (dataframe): Payments for the testing loans with a multi-level index of payment date and loan ID.
+        model_predictions (dataframe): The dataframe created by modeling.create_dataframe_for_simulation.
+        start_date (datetime.date): The first month of the simulation.
+        end_date (datetime.date): The simulation stops before this month.
+        starting_balance (float): Starting cash balance of every path.
+        investment_per_loan (float): Amount we want to invest in each loan.
+        min_roi (float): Minimum predicted ROI a loan needs for us to buy it.
+        num_paths (int): Number of randomized paths to simulate.
+        availability (float): Probability that a loan is available to us.
+        min_fill (float): Smallest fraction of investment_per_loan we can be filled with.
+        listing_window_months (int): Number of months, starting with the issue month, a loan can be bought in.
+        seed (int): Seed for the random number generator.
+        paths_per_chunk (int): Number of paths simulated together as one set of arrays. Memory use of each worker
+            grows with paths_per_chunk times the number of loans meeting min_roi.
+        processes (int or None): Number of worker processes. None uses every CPU, 1 runs in this process.
+
+    Returns:
+        DataFrame: Returns a dataframe with one row per path and columns for the path's annualized ROI, maximum
+        drawdown and final balance.
+    '''
+    global mc_candidates, mc_monthly_payments
+    mc_candidates = get_candidate_loans(model_predictions, min_roi)
+    payments_filtered = filter_payments_for_simulation(all_payments, model_predictions, min_roi)
+    mc_monthly_payments = bucket_payments_by_month(payments_filtered, mc_candidates['ids'])
+
+    dates = get_simulation_dates(start_date, end_date)
+
+    chunk_sizes = [min(paths_per_chunk, num_paths - start) for start in range(0, num_paths, paths_per_chunk)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    tasks = [(seed_sequence, chunk_size, dates, starting_balance, investment_per_loan, availability, min_fill,
+              listing_window_months) for seed_sequence, chunk_size in zip(seed_sequences, chunk_sizes)]
+    if processes == 1:
+        chunks = [simulate_path_chunk(task) for task in tasks]
+    else:
+        with mp.get_context('fork').Pool(processes=processes) as pool:
+            chunks = pool.map(simulate_path_chunk, tasks)
+    balances = np.concatenate(chunks)
+
+    return pd.DataFrame({'roi': get_annualized_roi(dates, balances.T),
+                         'max_drawdown': get_max_drawdowns(balances),
+                         'final_balance': balances[:, -1]})
+
+def summarize_monte_carlo_results(results, percentiles=(0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)):
+    '''
+    Summarize the distributions of ROI and drawdown from simulate_monte_carlo_paths.
+
+    Args:
+        results (dataframe): The dataframe returned by simulate_monte_carlo_paths.
+        percentiles (list or tuple of floats): Percentiles to include in the summary.
+
+    Returns:
+        DataFrame: Returns the mean, standard deviation and percentiles of every column in results.
+    '''
+    return results.describe(percentiles=percentiles)
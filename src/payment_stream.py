@@ -0,0 +1,223 @@
+'''
+This file contains a streaming version of the portfolio simulation. The regular simulation needs the filtered payments
+history in memory. Here payments are stored on disk as one folder per month of .npz batches and read lazily while the
+simulation runs. A background thread prefetches the next few months, so only about one month of payments is in memory
+at a time.
+
+The payments folder is laid out as:
+    payments_directory/2017-08/part-00000.npz
+    payments_directory/2017-08/part-00001.npz
+    payments_directory/2017-09/part-00000.npz
+Each part holds the arrays LOAN_ID, RECEIVED_AMT_INVESTORS and PBAL_END_PERIOD_INVESTORS for payments received that month.
+The amounts are stored as float64, the same as the payments dataframe, because float32 can only step about $0.004 near
+$40,000 and the balances would drift away from the in-memory simulation by cents.
+'''
+
+import os
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from src.payments import convert_payment_date
+from src.portfolio import ArrayPortfolio, MonthlyPayments, MonthPayments, get_annualized_roi, get_simulation_dates
+
+def get_month_directory(payments_directory, date):
+    return os.path.join(payments_directory, f'{date.year}-{date.month:02d}')
+
+def write_payment_batch(payments_directory, date, loan_ids, received, end_principal):
+    '''
+    Write the payments received in one month as a new part file in that month's folder.
+
+    Args:
+        payments_directory (string): Folder containing one folder per month of payments.
+        date (datetime.date or Timestamp): Any date in the month the payments were received.
+        loan_ids (array of ints): The loan ID of each payment.
+        received (array of floats): The amount received by investors for each payment.
+        end_principal (array of floats): The principal balance left after each payment.
+    '''
+    month_directory = get_month_directory(payments_directory, date)
+    os.makedirs(month_directory, exist_ok=True)
+    part = len([f for f in os.listdir(month_directory) if f.endswith('.npz')])
+    np.savez(os.path.join(month_directory, f'part-{part:05d}.npz'), LOAN_ID=np.asarray(loan_ids, dtype='int64'),
+             RECEIVED_AMT_INVESTORS=np.asarray(received, dtype='float64'),
+             PBAL_END_PERIOD_INVESTORS=np.asarray(end_principal, dtype='float64'))
+
+def write_monthly_payment_batches(payments_df, payments_directory):
+    '''
+    Split a payments dataframe into monthly batches on disk.
+
+    Args:
+        payments_df (dataframe): Payments with a multi-level index of payment date and loan ID, as created by
+            payments.set_and_sort_indices.
+        payments_directory (string): Folder to write the monthly batches to.
+    '''
+    received_dates = payments_df.index.get_level_values('RECEIVED_D')
+    for date, rows in pd.Series(np.arange(len(payments_df))).groupby(received_dates.to_period('M')):
+        batch = payments_df.iloc[rows.to_numpy()]
+        write_payment_batch(payments_directory, date, batch.index.get_level_values('LOAN_ID'),
+                            batch['RECEIVED_AMT_INVESTORS'], batch['PBAL_END_PERIOD_INVESTORS'])
+
+def write_monthly_payment_batches_from_csv(csv_file, payments_directory, chunksize=1000000):
+    '''
+    Convert the raw payments CSV file into monthly batches on disk without loading the whole file. The file is read
+    chunksize rows at a time and each chunk adds one part file to every month it contains payments for.
+
+    Args:
+        csv_file (string): Path to the raw payments file, for example 'data/PMTHIST_INVESTOR_201904.csv'.
+        payments_directory (string): Folder to write the monthly batches to.
+        chunksize (int): Number of CSV rows to read at a time.
+    '''
+    columns_to_use = ('LOAN_ID', 'RECEIVED_D', 'PBAL_END_PERIOD_INVESTORS', 'RECEIVED_AMT_INVESTORS')
+    for chunk in pd.read_csv(csv_file, usecols=columns_to_use, chunksize=chunksize):
+        chunk = chunk.dropna()
+        chunk['RECEIVED_D'] = convert_payment_date(chunk['RECEIVED_D'])
+        for date, batch in chunk.groupby(chunk['RECEIVED_D'].dt.to_period('M')):
+            write_payment_batch(payments_directory, date, batch['LOAN_ID'], batch['RECEIVED_AMT_INVESTORS'],
+                                batch['PBAL_END_PERIOD_INVESTORS'])
+
+def read_monthly_payment_batches(payments_directory, dates, loan_index):
+    '''
+    Lazily read the payments for each month from disk and join them to the simulation's loans by position.
+
+    Args:
+        payments_directory (string): Folder containing one folder per month of payments.
+        dates (list of datetime.date): The months to read, in order.
+        loan_index (pandas Index): Index of the loan IDs that can be bought in the simulation. Payments for other loans
+            are dropped.
+
+    Yields:
+        MonthPayments: The payments received in each month, in the same format as MonthlyPayments.get_month.
+    '''
+    for date in dates:
+        month_directory = get_month_directory(payments_directory, date)
+        parts = sorted(f for f in os.listdir(month_directory) if f.endswith('.npz')) if os.path.isdir(month_directory) else []
+        loan_ids, received, end_principal = [np.empty(0, dtype='int64')], [np.empty(0)], [np.empty(0)]
+        for part in parts:
+            with np.load(os.path.join(month_directory, part)) as batch:
+                loan_ids.append(batch['LOAN_ID'])
+                received.append(batch['RECEIVED_AMT_INVESTORS'].astype('float64'))
+                end_principal.append(batch['PBAL_END_PERIOD_INVESTORS'].astype('float64'))
+        loan_positions = loan_index.get_indexer(np.concatenate(loan_ids))
+        known_loans = loan_positions >= 0
+        yield MonthPayments(loan_positions[known_loans], np.concatenate(received)[known_loans],
+                            np.concatenate(end_principal)[known_loans])
+
+# Put in the queue after the last item.
+DONE = object()
+
+def fill_queue(iterable, item_queue, stop_event, poll_seconds):
+    '''
+    Read items into the queue until the iterable runs out or stop_event is set. This runs in PrefetchingIterator's
+    thread, and it's a function rather than a method so the thread doesn't keep the iterator alive after the consumer
+    drops it.
+    '''
+    def put(item):
+        # Waiting in short steps lets the thread notice the consumer has stopped instead of blocking on a full queue.
+        while not stop_event.is_set():
+            try:
+                item_queue.put(item, timeout=poll_seconds)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    iterator = iter(iterable)
+    try:
+        for item in iterator:
+            if not put(item):
+                return
+    except Exception as e:
+        # Errors are raised again in the consumer's thread.
+        put(e)
+    finally:
+        # Closing a generator runs its finally and with blocks, which closes any open npz files.
+        if hasattr(iterator, 'close'):
+            iterator.close()
+    put(DONE)
+
+class PrefetchingIterator:
+    '''
+    Iterate over another iterator while a background thread reads up to `lookahead` items ahead of the consumer. Used
+    to read upcoming months of payments from disk while the current month is being simulated.
+
+    A consumer that stops early, because of an exception or a break, should call close, or use the iterator in a with
+    block. Otherwise the thread is stopped when the iterator is garbage collected.
+
+    Args:
+        iterable (iterable): The items to read.
+        lookahead (int): Most items read ahead of the consumer.
+        poll_seconds (float): How often a thread waiting on a full queue checks whether it should stop.
+    '''
+    def __init__(self, iterable, lookahead=2, poll_seconds=0.1):
+        self.queue = queue.Queue(maxsize=lookahead)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=fill_queue, args=(iterable, self.queue, self.stop_event, poll_seconds),
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self):
+        '''
+        Stop the background thread and wait for it to close the underlying iterator.
+        '''
+        self.stop_event.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def __del__(self):
+        self.stop_event.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stop_event.is_set():
+            raise StopIteration
+        item = self.queue.get()
+        if item is DONE:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+def simulate_loan_investment_portfolio_streaming(payments_directory, model_predictions, start_date, end_date, starting_balance,
+                                                 investment_per_loan, min_roi, lookahead=2):
+    '''
+    Same as portfolio.simulate_loan_investment_portfolio, except payments are streamed month by month from the batches
+    written by write_monthly_payment_batches or write_monthly_payment_batches_from_csv.
+
+    Args:
+        payments_directory (string): Folder containing one folder per month of payments.
+        model_predictions (dataframe): The dataframe created by modeling.create_dataframe_for_simulation.
+        start_date (datetime.date): The first month of the simulation.
+        end_date (datetime.date): The simulation stops before this month.
+        starting_balance (float): Starting cash balance of the portfolio.
+        investment_per_loan (float): Amount to invest in each loan.
+        min_roi (float): Minimum predicted ROI a loan needs for us to buy it.
+        lookahead (int): Number of months of payments to prefetch.
+
+    Returns:
+        tuple: Returns the dates, balances and annualized ROI of the simulated portfolio.
+    '''
+    loan_ids = model_predictions['id'].to_numpy(dtype='int64')
+    # The portfolio only needs the loan positions from MonthlyPayments, the payments themselves are streamed.
+    no_payments = MonthlyPayments(loan_ids, 0, np.zeros(1, dtype='int64'), np.empty(0, dtype='int64'), np.empty(0), np.empty(0))
+    portfolio = ArrayPortfolio(starting_balance, investment_per_loan, start_date, model_predictions, no_payments, min_roi)
+
+    dates = get_simulation_dates(start_date, end_date)
+
+    balances = []
+    monthly_batches = PrefetchingIterator(read_monthly_payment_batches(payments_directory, dates, no_payments.loan_index),
+                                          lookahead)
+    with monthly_batches:
+        for payments_this_month in monthly_batches:
+            balances.append(portfolio.total_balance)
+            portfolio.simulate_month(payments_this_month)
+
+    roi = get_annualized_roi(dates, balances)
+    return dates, balances, roi
@@ -1,4 +1,14 @@
+from collections import namedtuple
 from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
+from src.allocation import TopKAllocator
+from src.portfolio_metrics import SimulationLedger, get_portfolio_metrics
+from src.tracing import disabled_tracer
+
+# Status codes used by ArrayPortfolio's status column.
+CURRENT = 0
+DEFAULT = 1
 
 class Loan:
     def __init__(self, loan_id, borrowed_amount, investment_amount):
@@ -21,7 +31,7 @@ class Loan:
         self.months_since_last_payment += 1
 
 class Portfolio:
-    def __init__(self, starting_balance, investment_per_loan, start_date, loans_df, payments_df, min_roi=5.0):
+    def __init__(self, starting_balance, investment_per_loan, start_date, loans_df, payments_df, min_roi=5.0, tracer=None):
         self.active_loans = []
         self.defaulted_loans = []
         self.cash_balance = starting_balance
@@ -31,7 +41,9 @@ class Portfolio:
         self.date = start_date
         self.min_roi = min_roi
         self.all_loans_available = loans_df
+        self.monthly_loans = bucket_loans_by_month(loans_df)
         self.all_payments_data = payments_df
+        self.tracer = tracer if tracer is not None else disabled_tracer
 
     def update_invested_principal_balance(self):
         self.invested_principal_balance = sum([loan.principal_balance for loan in self.active_loans])
@@ -52,14 +64,9 @@ class Portfolio:
         return loans
 
     def get_loans_available_for_current_date(self):
-        '''
-        TODO: The date parameter used to need to be of type datetime.date but now I have to cast it to string.
-              Figure out why.
-        '''
-        available_loans = self.all_loans_available.loc[str(self.date)]
-        # Setting the dataframe index to loan id makes it easier to search and retrieve loans later.
-        #available_loans.set_index('id', inplace=True)
-        return available_loans
+        # The loans issued this month are a slice of the loan index, so no date lookup on the dataframe is needed.
+        rows = self.monthly_loans.get_month(self.date)
+        return self.all_loans_available.iloc[self.monthly_loans.df_rows[rows]]
     
     def get_loans_over_required_roi_threshold(self, loans):
         return loans.loc[loans['predicted_roi'] >= self.min_roi, :]
@@ -130,12 +137,307 @@ class Portfolio:
         self.total_balance = self.invested_principal_balance + self.cash_balance
         
     def simulate_month(self):
-        self.buy_loans_for_current_month()
-        self.get_and_apply_payments_for_current_month()
-        self.add_one_month_since_loan_payment()
-        self.clear_defaulted_loans()
-        self.update_invested_principal_balance()
-        self.update_portfolio_total_balance()
+        tracer = self.tracer
+        with tracer.span('simulate_month', date=self.date) as month_span:
+            num_loans_before = len(self.active_loans)
+            with tracer.span('buy_loans'):
+                self.buy_loans_for_current_month()
+            num_loans_bought = len(self.active_loans) - num_loans_before
+            with tracer.span('get_payments'):
+                payments_this_month = self.get_payments_for_current_month()
+                payments_from_active_loans = self.get_payments_from_active_loans(payments_this_month)
+            with tracer.span('apply_payments'):
+                self.apply_payments(payments_from_active_loans)
+            with tracer.span('clear_defaulted_loans'):
+                self.add_one_month_since_loan_payment()
+                self.clear_defaulted_loans()
+            with tracer.span('update_balances'):
+                self.update_invested_principal_balance()
+                self.update_portfolio_total_balance()
+            if tracer.enabled:
+                month_span.args.update(active_loans=len(self.active_loans), payment_rows=len(payments_from_active_loans),
+                                       loans_bought=num_loans_bought)
+        self.increment_date_by_one_month()
+
+# The payments received in one month. Loans are identified by their position in MonthlyPayments.loan_ids.
+MonthPayments = namedtuple('MonthPayments', ['loan_positions', 'received', 'end_principal'])
+
+def get_month_ordinal(date):
+    return 12 * date.year + date.month - 1
+
+def get_month_offsets(months):
+    '''
+    Find where each month starts in a sorted array of month ordinals.
+
+    Args:
+        months (array of ints): Sorted month ordinals from get_month_ordinal.
+
+    Returns:
+        tuple: Returns the first month and the offsets, where the rows for month first_month + i are
+        offsets[i]:offsets[i + 1].
+    '''
+    if len(months) == 0:
+        return 0, np.zeros(1, dtype='int64')
+    first_month = months[0]
+    return first_month, np.searchsorted(months, np.arange(first_month, months[-1] + 2))
+
+def get_simulation_dates(start_date, end_date):
+    dates = []
+    date = start_date
+    while date < end_date:
+        dates.append(date)
+        date += relativedelta(months=1)
+    return dates
+
+class MonthlyPayments:
+    '''
+    Payments bucketed by the month they were received. Rows are sorted by month so the payments for a month are the
+    slice offsets[month]:offsets[month + 1], and each payment stores the position of its loan in loan_ids instead of
+    the loan ID. Looking up a month is a slice, and payments are joined to holdings by integer position.
+    '''
+    def __init__(self, loan_ids, first_month, offsets, loan_positions, received, end_principal):
+        self.loan_ids = loan_ids
+        self.loan_index = pd.Index(loan_ids)
+        self.first_month = first_month
+        self.offsets = offsets
+        self.loan_positions = loan_positions
+        self.received = received
+        self.end_principal = end_principal
+
+    def get_month(self, date):
+        month = get_month_ordinal(date) - self.first_month
+        if month < 0 or month >= len(self.offsets) - 1:
+            start, end = 0, 0
+        else:
+            start, end = self.offsets[month], self.offsets[month + 1]
+        return MonthPayments(self.loan_positions[start:end], self.received[start:end], self.end_principal[start:end])
+
+def bucket_payments_by_month(payments_df, loan_ids):
+    '''
+    Convert the payments dataframe used by the simulation into MonthlyPayments arrays. This is done once before the
+    simulation starts so no dataframe indexing is needed inside the monthly loop.
+
+    Args:
+        payments_df (dataframe): Payments with a multi-level index of payment date and loan ID, as created by
+            payments.set_and_sort_indices. Must contain the columns RECEIVED_AMT_INVESTORS and PBAL_END_PERIOD_INVESTORS.
+        loan_ids (array or series of ints): IDs of every loan that can be bought in the simulation. Payments are
+            stored against the position of their loan in this array. Payments for other loans are dropped.
+
+    Returns:
+        MonthlyPayments: The payments bucketed by the month they were received.
+    '''
+    loan_ids = np.asarray(loan_ids, dtype='int64')
+    loan_positions = pd.Index(loan_ids).get_indexer(payments_df.index.get_level_values('LOAN_ID'))
+    received_dates = payments_df.index.get_level_values('RECEIVED_D')
+    months = np.asarray(12 * received_dates.year + received_dates.month - 1, dtype='int64')
+
+    known_loans = loan_positions >= 0
+    order = np.argsort(months[known_loans], kind='stable')
+    months = months[known_loans][order]
+    loan_positions = loan_positions[known_loans][order]
+    received = payments_df['RECEIVED_AMT_INVESTORS'].to_numpy(dtype='float64')[known_loans][order]
+    end_principal = payments_df['PBAL_END_PERIOD_INVESTORS'].to_numpy(dtype='float64')[known_loans][order]
+
+    first_month, offsets = get_month_offsets(months)
+    return MonthlyPayments(loan_ids, first_month, offsets, loan_positions, received, end_principal)
+
+class MonthlyLoans:
+    '''
+    The loans that can be bought in the simulation, sorted by the month they were issued. The loans issued in a month
+    are the rows offsets[month]:offsets[month + 1], so finding a month's loans is a slice instead of a .loc lookup on the
+    issue_d index. df_rows is the row of each loan in the original dataframe and id_rows maps a loan ID to its row here.
+    '''
+    def __init__(self, loans_df, df_rows, first_month, offsets):
+        self.loans_df = loans_df
+        self.df_rows = df_rows
+        self.ids = loans_df['id'].to_numpy(dtype='int64')[df_rows]
+        self.loan_amounts = loans_df['loan_amnt'].to_numpy(dtype='float64')[df_rows]
+        self.predicted_rois = loans_df['predicted_roi'].to_numpy(dtype='float64')[df_rows]
+        self.id_rows = pd.Index(self.ids)
+        self.first_month = first_month
+        self.offsets = offsets
+
+    def get_month(self, date):
+        month = get_month_ordinal(date) - self.first_month
+        if month < 0 or month >= len(self.offsets) - 1:
+            return slice(0, 0)
+        return slice(self.offsets[month], self.offsets[month + 1])
+
+def bucket_loans_by_month(loans_df):
+    '''
+    Sort the simulation's loans by issue month once so each month's available loans can be found with a slice.
+
+    Args:
+        loans_df (dataframe): The dataframe created by modeling.create_dataframe_for_simulation, indexed by issue_d.
+
+    Returns:
+        MonthlyLoans: The loans bucketed by the month they were issued. Loans issued in the same month keep their order
+        from loans_df.
+    '''
+    issue_dates = pd.DatetimeIndex(loans_df.index)
+    months = np.asarray(12 * issue_dates.year + issue_dates.month - 1, dtype='int64')
+    df_rows = np.argsort(months, kind='stable')
+    first_month, offsets = get_month_offsets(months[df_rows])
+    return MonthlyLoans(loans_df, df_rows, first_month, offsets)
+
+class ArrayPortfolio:
+    '''
+    Array-backed version of Portfolio. Instead of a list of Loan objects the active holdings are stored as NumPy columns
+    (id, fractional investment, principal, months since last payment and status), so payments, defaults and balance
+    updates are applied to every loan at once each month. Balances match Portfolio on the same inputs.
+
+    Payments come from a MonthlyPayments object instead of the payments dataframe. Each holding keeps the position of
+    its loan in monthly_payments.loan_ids, and holding_slots maps a loan position back to its row in the holdings
+    (-1 if we don't own the loan).
+
+    loans_df can be the predictions dataframe or a MonthlyLoans built from it with bucket_loans_by_month, which saves
+    sorting the loans again when many portfolios are simulated from the same predictions.
+
+    If a portfolio_metrics.SimulationLedger is passed in, every purchase, payment and default is also written to it.
+    The loans bought each month are chosen by an allocator from allocation.py, TopKAllocator by default.
+    '''
+    def __init__(self, starting_balance, investment_per_loan, start_date, loans_df, monthly_payments, min_roi=5.0, tracer=None,
+                 ledger=None, allocator=None):
+        self.ids = np.empty(0, dtype='int64')
+        self.loan_positions = np.empty(0, dtype='int64')
+        self.holding_slots = np.full(len(monthly_payments.loan_ids), -1, dtype='int64')
+        self.fractional_investments = np.empty(0, dtype='float64')
+        self.principal_balances = np.empty(0, dtype='float64')
+        self.months_since_last_payment = np.empty(0, dtype='int16')
+        self.statuses = np.empty(0, dtype='uint8')
+        self.defaulted_loan_ids = np.empty(0, dtype='int64')
+        self.cash_balance = starting_balance
+        self.total_balance = starting_balance
+        self.invested_principal_balance = 0
+        self.investment_per_loan = investment_per_loan
+        self.date = start_date
+        self.min_roi = min_roi
+        self.monthly_loans = loans_df if isinstance(loans_df, MonthlyLoans) else bucket_loans_by_month(loans_df)
+        self.all_loans_available = self.monthly_loans.loans_df
+        self.monthly_payments = monthly_payments
+        # Position of each loan in monthly_payments.loan_ids, by its row in monthly_loans.
+        self.payment_positions = monthly_payments.loan_index.get_indexer(self.monthly_loans.ids)
+        self.tracer = tracer if tracer is not None else disabled_tracer
+        self.ledger = ledger
+        self.allocator = allocator if allocator is not None else TopKAllocator()
+        self.bucket_codes = self.allocator.get_bucket_codes(self.all_loans_available, monthly_payments.loan_index)
+
+    def update_invested_principal_balance(self):
+        self.invested_principal_balance = self.principal_balances.sum()
+
+    def increment_date_by_one_month(self):
+        self.date += relativedelta(months=1)
+
+    def purchase_loans(self, loan_ids, loan_amounts, loan_positions, initial_investments):
+        self.holding_slots[loan_positions] = np.arange(len(self.ids), len(self.ids) + len(loan_ids))
+        self.ids = np.concatenate([self.ids, loan_ids])
+        self.loan_positions = np.concatenate([self.loan_positions, loan_positions])
+        self.fractional_investments = np.concatenate([self.fractional_investments, initial_investments / loan_amounts])
+        self.principal_balances = np.concatenate([self.principal_balances, initial_investments])
+        self.months_since_last_payment = np.concatenate([self.months_since_last_payment,
+                                                         np.zeros(len(loan_ids), dtype='int16')])
+        self.statuses = np.concatenate([self.statuses, np.full(len(loan_ids), CURRENT, dtype='uint8')])
+        self.cash_balance -= initial_investments.sum()
+        if self.ledger is not None:
+            self.ledger.record_purchases(loan_positions, initial_investments)
+
+    def get_loans_available_for_current_date(self):
+        rows = self.monthly_loans.get_month(self.date)
+        return np.arange(rows.start, rows.stop)
+
+    def get_loans_over_required_roi_threshold(self, rows):
+        return rows[self.monthly_loans.predicted_rois[rows] >= self.min_roi]
+
+    def buy_loans_for_current_month(self):
+        # Loans are handled as rows of monthly_loans until we know which ones to buy.
+        rows = self.get_loans_available_for_current_date()
+        rows = self.get_loans_over_required_roi_threshold(rows)
+        loan_amounts = self.monthly_loans.loan_amounts[rows]
+        loan_positions = self.payment_positions[rows]
+        chosen, investments = self.allocator.allocate(self, self.monthly_loans.predicted_rois[rows], loan_amounts,
+                                                      loan_positions)
+        self.purchase_loans(self.monthly_loans.ids[rows[chosen]], loan_amounts[chosen], loan_positions[chosen], investments)
+
+    def get_payments_for_current_month(self):
+        return self.monthly_payments.get_month(self.date)
+
+    def apply_payments(self, payments_this_month):
+        holding_slots = self.holding_slots[payments_this_month.loan_positions]
+        owned = holding_slots >= 0
+        holding_slots = holding_slots[owned]
+        if len(holding_slots) == 0:
+            return
+        received = payments_this_month.received[owned]
+        end_principal = payments_this_month.end_principal[owned]
+
+        # A loan can have more than 1 payment per month, so sum what was received and keep the lowest ending principal.
+        total_received = np.bincount(holding_slots, weights=received, minlength=len(self.ids))
+        end_principal_total = np.full(len(self.ids), np.inf)
+        np.minimum.at(end_principal_total, holding_slots, end_principal)
+        paid = np.isfinite(end_principal_total)
+
+        self.update_portfolio_cash_balance(np.dot(self.fractional_investments[paid], total_received[paid]))
+        self.principal_balances[paid] = end_principal_total[paid] * self.fractional_investments[paid]
+        self.months_since_last_payment[paid] = 0
+        if self.ledger is not None:
+            self.ledger.record_payments(self.loan_positions[paid], self.fractional_investments[paid] * total_received[paid])
+
+    def get_and_apply_payments_for_current_month(self, payments_this_month=None):
+        # Payments can be passed in when several portfolios share one read of the month's payments.
+        if payments_this_month is None:
+            payments_this_month = self.get_payments_for_current_month()
+        self.apply_payments(payments_this_month)
+
+    def update_portfolio_cash_balance(self, payment):
+        self.cash_balance += payment
+
+    def add_one_month_since_loan_payment(self):
+        self.months_since_last_payment += 1
+
+    def clear_defaulted_loans(self):
+        defaulted = self.months_since_last_payment > 4
+        if self.ledger is not None:
+            self.ledger.record_defaults(self.loan_positions[defaulted], self.principal_balances[defaulted])
+        self.statuses[defaulted] = DEFAULT
+        self.principal_balances[defaulted] = 0
+        self.defaulted_loan_ids = np.concatenate([self.defaulted_loan_ids, self.ids[defaulted]])
+        active = self.statuses == CURRENT
+        self.holding_slots[self.loan_positions[~active]] = -1
+        self.holding_slots[self.loan_positions[active]] = np.arange(np.count_nonzero(active))
+        self.ids = self.ids[active]
+        self.loan_positions = self.loan_positions[active]
+        self.fractional_investments = self.fractional_investments[active]
+        self.principal_balances = self.principal_balances[active]
+        self.months_since_last_payment = self.months_since_last_payment[active]
+        self.statuses = self.statuses[active]
+
+    def update_portfolio_total_balance(self):
+        self.total_balance = self.invested_principal_balance + self.cash_balance
+
+    def simulate_month(self, payments_this_month=None):
+        tracer = self.tracer
+        with tracer.span('simulate_month', date=self.date) as month_span:
+            num_loans_before = len(self.ids)
+            with tracer.span('buy_loans'):
+                self.buy_loans_for_current_month()
+            num_loans_bought = len(self.ids) - num_loans_before
+            with tracer.span('get_payments'):
+                # Payments can be passed in when several portfolios share one read of the month's payments.
+                if payments_this_month is None:
+                    payments_this_month = self.get_payments_for_current_month()
+            with tracer.span('apply_payments'):
+                self.apply_payments(payments_this_month)
+            with tracer.span('clear_defaulted_loans'):
+                self.add_one_month_since_loan_payment()
+                self.clear_defaulted_loans()
+            with tracer.span('update_balances'):
+                self.update_invested_principal_balance()
+                self.update_portfolio_total_balance()
+            if self.ledger is not None:
+                self.ledger.record_month_end(self.cash_balance, self.total_balance)
+            if tracer.enabled:
+                month_span.args.update(active_loans=len(self.ids), payment_rows=len(payments_this_month.loan_positions),
+                                       loans_bought=num_loans_bought)
         self.increment_date_by_one_month()
 
 def get_annualized_roi(dates, balances):
@@ -145,15 +447,15 @@ def get_annualized_roi(dates, balances):
     profit = ending_balance - starting_balance
     return 100 * (((1+(profit/starting_balance))**(1/num_months))**12 - 1)
 
-def simulate_loan_investment_portfolio(all_payments, model_predictions, start_date, end_date, starting_balance, investment_per_loan, min_roi):
+def filter_payments_for_simulation(all_payments, model_predictions, min_roi):
     # To speed up the simulation we can look at just the payments from loans matching our minimum ROI criteria. 
     loans_meeting_min_roi = model_predictions.loc[model_predictions['predicted_roi'] >= min_roi, 'id']
-    payments_filtered = all_payments.loc[all_payments.index.get_level_values(1).isin(loans_meeting_min_roi), ['RECEIVED_AMT_INVESTORS', 'PBAL_END_PERIOD_INVESTORS', 'IssuedDate']]
-    
+    return all_payments.loc[all_payments.index.get_level_values(1).isin(loans_meeting_min_roi), ['RECEIVED_AMT_INVESTORS', 'PBAL_END_PERIOD_INVESTORS', 'IssuedDate']]
+
+def run_portfolio_simulation(portfolio, end_date):
     dates = []
     balances = []
     
-    portfolio = Portfolio(starting_balance, investment_per_loan, start_date, model_predictions, payments_filtered, min_roi)
     while portfolio.date < end_date:
         dates.append(portfolio.date)
         balances.append(portfolio.total_balance)
@@ -161,4 +463,76 @@ def simulate_loan_investment_portfolio(all_payments, model_predictions, start_da
         
     roi = get_annualized_roi(dates, balances)
         
-    return dates, balances, roi
\ No newline at end of file
+    return dates, balances, roi
+
+def simulate_loan_investment_portfolio(all_payments, model_predictions, start_date, end_date, starting_balance, investment_per_loan, min_roi,
+                                       vectorized=True, tracer=None, metrics=False, allocator=None):
+    '''
+    Simulate investing in the loans our model predicts will have the highest ROI, starting at start_date and stopping
+    before end_date.
+
+    With metrics=True the portfolio also fills in a portfolio_metrics.SimulationLedger as it runs, and a dictionary of
+    metrics from portfolio_metrics.get_portfolio_metrics is returned as a 4th value. An allocator from allocation.py
+    can be passed in to change how loans are chosen each month. Metrics and allocators require vectorized=True.
+    '''
+    payments_filtered = filter_payments_for_simulation(all_payments, model_predictions, min_roi)
+    
+    # The array-backed portfolio is much faster. The original Loan object version is kept for reference and comparison.
+    if vectorized:
+        monthly_loans = bucket_loans_by_month(model_predictions)
+        monthly_payments = bucket_payments_by_month(payments_filtered, monthly_loans.ids)
+        ledger = None
+        if metrics:
+            num_months = len(get_simulation_dates(start_date, end_date))
+            ledger = SimulationLedger(num_months, len(monthly_payments.loan_ids))
+        portfolio = ArrayPortfolio(starting_balance, investment_per_loan, start_date, monthly_loans, monthly_payments, min_roi,
+                                   tracer, ledger, allocator)
+    else:
+        portfolio = Portfolio(starting_balance, investment_per_loan, start_date, model_predictions, payments_filtered, min_roi, tracer)
+
+    dates, balances, roi = run_portfolio_simulation(portfolio, end_date)
+    if metrics:
+        return dates, balances, roi, get_portfolio_metrics(portfolio, dates, starting_balance)
+    return dates, balances, roi
+
+def simulate_multiple_strategies(all_payments, predictions_by_strategy, start_date, end_date, starting_balance, investment_per_loan, min_roi):
+    '''
+    Simulate a portfolio for several sets of predictions at once. All portfolios are advanced together month by month,
+    and each month's payments are read once and applied to every strategy's holdings. Comparing N models this way
+    filters the payments and walks the months once instead of N times.
+
+    Args:
+        all_payments (dataframe): Payments for the testing loans with a multi-level index of payment date and loan ID.
+        predictions_by_strategy (dict): Dictionary where the key is the strategy name, for example 'xgb' or 'random', and the
+            value is the dataframe created by modeling.create_dataframe_for_simulation for that strategy.
+        start_date (datetime.date): The first month of the simulation.
+        end_date (datetime.date): The simulation stops before this month.
+        starting_balance (float): Starting cash balance of every portfolio.
+        investment_per_loan (float): Amount to invest in each loan.
+        min_roi (float): Minimum predicted ROI a loan needs for us to buy it.
+
+    Returns:
+        tuple: Returns the simulated dates, a dictionary of balances for each strategy and a dictionary of annualized ROI
+        for each strategy.
+    '''
+    # Every strategy shares one set of loan positions so the month's payments can be joined to all of their holdings.
+    all_predictions = pd.concat([predictions[['id', 'predicted_roi']] for predictions in predictions_by_strategy.values()])
+    payments_filtered = filter_payments_for_simulation(all_payments, all_predictions, min_roi)
+    monthly_payments = bucket_payments_by_month(payments_filtered, all_predictions['id'].unique())
+
+    portfolios = {name: ArrayPortfolio(starting_balance, investment_per_loan, start_date, predictions, monthly_payments, min_roi)
+                  for name, predictions in predictions_by_strategy.items()}
+    dates = []
+    balances = {name: [] for name in portfolios}
+
+    date = start_date
+    while date < end_date:
+        dates.append(date)
+        payments_this_month = monthly_payments.get_month(date)
+        for name, portfolio in portfolios.items():
+            balances[name].append(portfolio.total_balance)
+            portfolio.simulate_month(payments_this_month)
+        date += relativedelta(months=1)
+
+    rois = {name: get_annualized_roi(dates, balances[name]) for name in portfolios}
+    return dates, balances, rois
@@ -0,0 +1,171 @@
+'''
+This file contains the cash-flow ledger filled in by portfolio.ArrayPortfolio while a simulation runs, and the metrics
+computed from it afterwards. get_annualized_roi only compares the first and last balances. The ledger also keeps when
+money was deployed and received, so the portfolio's XIRR, drawdown, cash drag and default curves can be calculated
+without running the simulation a second time.
+'''
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+class SimulationLedger:
+    '''
+    Arrays preallocated for every month of the simulation and every loan that can be bought. The portfolio writes to
+    them as it runs. Loans are identified by their position in the simulation's MonthlyPayments.loan_ids.
+
+    Args:
+        num_months (int): Number of months that will be simulated.
+        num_loans (int): Number of loans that can be bought.
+    '''
+    def __init__(self, num_months, num_loans):
+        self.month = 0
+        self.deployed = np.zeros(num_months)
+        self.received = np.zeros(num_months)
+        self.defaults = np.zeros(num_months, dtype='int64')
+        self.defaulted_principal = np.zeros(num_months)
+        self.cash_balances = np.zeros(num_months)
+        self.total_balances = np.zeros(num_months)
+        self.loan_invested = np.zeros(num_loans)
+        self.loan_received = np.zeros(num_loans)
+        self.loan_purchase_months = np.full(num_loans, -1, dtype='int32')
+        self.loan_default_months = np.full(num_loans, -1, dtype='int32')
+
+    def record_purchases(self, loan_positions, investments):
+        self.deployed[self.month] += investments.sum()
+        self.loan_invested[loan_positions] = investments
+        self.loan_purchase_months[loan_positions] = self.month
+
+    def record_payments(self, loan_positions, amounts):
+        self.received[self.month] += amounts.sum()
+        self.loan_received[loan_positions] += amounts
+
+    def record_defaults(self, loan_positions, principal_lost):
+        self.defaults[self.month] += len(loan_positions)
+        self.defaulted_principal[self.month] += principal_lost.sum()
+        self.loan_default_months[loan_positions] = self.month
+
+    def record_month_end(self, cash_balance, total_balance):
+        self.cash_balances[self.month] = cash_balance
+        self.total_balances[self.month] = total_balance
+        self.month += 1
+
+def get_xirr(cash_flows, dates, iterations=100):
+    '''
+    Calculate the annualized internal rate of return of cash flows made on the given dates. Like payments.get_roi_for_loan_id,
+    the rate is found by bisection, but the net present value of every cash flow is calculated at once with NumPy.
+
+    Args:
+        cash_flows (array of floats): Money put in is negative, money taken out is positive.
+        dates (list of datetime.date): The date of each cash flow.
+        iterations (int): Number of bisection steps.
+
+    Returns:
+        float: Returns the annualized rate of return in the format of "13.57" and not ".1357", or NaN if the cash flows
+        don't have both money put in and money taken out, since no rate of return exists then.
+    '''
+    cash_flows = np.asarray(cash_flows, dtype='float64')
+    # Without a sign change the NPV never crosses zero, and bisection would walk to one of the bounds.
+    if not (cash_flows < 0).any() or not (cash_flows > 0).any():
+        return np.nan
+    years = np.array([(date - dates[0]).days for date in dates]) / 365.0
+    r_min, r_max = -0.9999, 10.0
+    for _ in range(iterations):
+        r_guess = (r_min + r_max) / 2
+        npv = np.sum(cash_flows / (1 + r_guess)**years)
+        # A positive NPV means the guess is too low.
+        if npv > 0:
+            r_min = r_guess
+        else:
+            r_max = r_guess
+    return 100 * (r_min + r_max) / 2
+
+def get_max_drawdowns(balances):
+    '''
+    Calculate the largest percentage drop from a previous peak for each row of balances.
+
+    Args:
+        balances (array): Array of portfolio balances, one row per portfolio and one column per month.
+
+    Returns:
+        array: Returns the maximum drawdown of each row. A drop from $100 to $90 is returned as 10.0.
+    '''
+    running_peaks = np.maximum.accumulate(balances, axis=1)
+    return 100 * (1 - balances / running_peaks).max(axis=1)
+
+def get_vintage_default_curves(purchase_months, default_months, dates):
+    '''
+    Calculate the cumulative percent of loans defaulted by the number of months since they were bought, for each month
+    of purchases (vintage).
+
+    Args:
+        purchase_months (array of ints): Month of the simulation each loan was bought in, -1 for loans never bought.
+        default_months (array of ints): Month of the simulation each loan defaulted in, -1 for loans that didn't.
+        dates (list of datetime.date): The simulated months.
+
+    Returns:
+        DataFrame: Returns a dataframe indexed by vintage with one column per month since purchase. Months that
+        haven't been observed yet for a vintage are NaN.
+    '''
+    num_months = len(dates)
+    bought = purchase_months >= 0
+    defaulted = bought & (default_months >= 0)
+    loans_per_vintage = np.bincount(purchase_months[bought], minlength=num_months)
+    defaults = np.zeros((num_months, num_months))
+    np.add.at(defaults, (purchase_months[defaulted], default_months[defaulted] - purchase_months[defaulted]), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curves = 100 * np.cumsum(defaults, axis=1) / loans_per_vintage[:, None]
+    # Vintage v has only been observed for num_months - v months.
+    ages = np.arange(num_months)
+    curves[ages[None, :] >= num_months - ages[:, None]] = np.nan
+    curves = pd.DataFrame(curves, index=pd.Index(dates, name='vintage'), columns=ages)
+    return curves.loc[loans_per_vintage > 0, :]
+
+def get_portfolio_metrics(portfolio, dates, starting_balance):
+    '''
+    Calculate the portfolio's metrics from the ledger it filled in during the simulation.
+
+    Args:
+        portfolio (ArrayPortfolio): A portfolio that was simulated with a SimulationLedger.
+        dates (list of datetime.date): The simulated months.
+        starting_balance (float): Starting cash balance of the portfolio.
+
+    Returns:
+        dict: Dictionary containing:
+            'xirr': The annualized return on the money deployed into loans, from the timing of every purchase and
+                payment plus the principal still outstanding at the end. NaN if no loans were bought.
+            'max_drawdown': The largest percentage drop of the total balance from a previous peak.
+            'mean_cash_drag': The average percent of the total balance left sitting in cash.
+            'monthly': Dataframe of the money deployed and received, defaults, cash and total balance each month.
+            'vintage_default_curves': Dataframe from get_vintage_default_curves.
+            'loan_pnl': Dataframe of the amount invested, received, still outstanding, and the profit of every loan bought.
+    '''
+    ledger = portfolio.ledger
+    outstanding = np.zeros(len(ledger.loan_invested))
+    outstanding[portfolio.loan_positions] = portfolio.principal_balances
+
+    # Flows happen at the start of each month, and the outstanding principal is counted as returned after the last one.
+    flow_dates = list(dates) + [dates[-1] + relativedelta(months=1)]
+    cash_flows = np.append(ledger.received - ledger.deployed, outstanding.sum())
+
+    total_balances = np.append(starting_balance, ledger.total_balances)
+    monthly = pd.DataFrame({'deployed': ledger.deployed, 'received': ledger.received,
+                            'net_cash_flow': ledger.received - ledger.deployed, 'defaults': ledger.defaults,
+                            'defaulted_principal': ledger.defaulted_principal, 'cash_balance': ledger.cash_balances,
+                            'total_balance': ledger.total_balances,
+                            'cash_drag': 100 * ledger.cash_balances / ledger.total_balances},
+                           index=pd.Index(dates, name='date'))
+
+    bought = ledger.loan_purchase_months >= 0
+    loan_pnl = pd.DataFrame({'id': portfolio.monthly_payments.loan_ids[bought], 'invested': ledger.loan_invested[bought],
+                             'received': ledger.loan_received[bought], 'outstanding': outstanding[bought],
+                             'defaulted': ledger.loan_default_months[bought] >= 0})
+    loan_pnl['profit'] = loan_pnl['received'] + loan_pnl['outstanding'] - loan_pnl['invested']
+
+    return {'xirr': get_xirr(cash_flows, flow_dates),
+            'max_drawdown': get_max_drawdowns(total_balances[None, :])[0],
+            'mean_cash_drag': monthly['cash_drag'].mean(),
+            'monthly': monthly,
+            'vintage_default_curves': get_vintage_default_curves(ledger.loan_purchase_months, ledger.loan_default_months,
+                                                                 dates),
+            'loan_pnl': loan_pnl}
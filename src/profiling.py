@@ -0,0 +1,328 @@
+'''
+This file contains an opt-in profiler for the pipeline's stages. enable_profiling replaces every public function in
+data_cleaning, feature_engineering, payments, modeling and portfolio with a wrapper that records, for each call:
+    calls            Number of calls
+    wall_seconds     Wall time, including the functions it called
+    cpu_seconds      CPU time of the whole process, so it's above the wall time when a model trains on many threads
+    rows_in          Length of the first dataframe, series or array passed in
+    rows_out         Length of the dataframe, series or array returned
+    memory_delta_mb  Memory of the returned dataframe minus the memory of the one passed in, without string contents
+    peak_rss_mb      Highest resident memory of the process while the function ran
+    peak_growth_mb   Most the resident memory rose above where it was when a call started, so the memory hungry
+                     functions stand out even after an earlier one has set the process's peak
+
+Calls are grouped by call stack, so fill_nas called by clean_and_prepare_raw_data_for_model is kept apart from fill_nas
+called directly. get_report returns the totals as a dataframe, and write_folded_stacks writes them in the folded stack
+format read by flamegraph.pl, speedscope and most other flame graph tools.
+
+data_cleaning star imports feature_engineering, and the notebooks star import these modules, so the same function is
+bound to a name in several modules. The wrapper replaces every name in a loaded src module or in __main__ that's bound
+to the original function. Nothing is wrapped until enable_profiling is called, and disable_profiling puts every
+original function back, so there's no cost when profiling is off. Calls made in forked worker processes aren't
+recorded.
+
+The operating system only keeps the peak memory of the whole process, so while profiling is on with track_memory, one
+background thread samples the resident memory and raises the peak of every call that's running.
+'''
+
+from contextlib import contextmanager
+import functools
+import importlib
+import inspect
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+from src.memory_sampling import get_rss_mb
+
+PROFILED_MODULES = ('src.data_cleaning', 'src.feature_engineering', 'src.payments', 'src.modeling', 'src.portfolio')
+
+# The profiler that's recording, and the (module, name, original function) of every name it replaced.
+active_profiler = None
+active_patches = []
+
+def get_size(value):
+    '''
+    Get the number of rows and bytes of a dataframe, series or array, without measuring the contents of strings.
+
+    Returns:
+        tuple: Returns the number of rows and the number of bytes, or None if value isn't one of these types.
+    '''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        memory = value.memory_usage(index=True, deep=False)
+        return len(value), int(memory.sum() if isinstance(value, pd.DataFrame) else memory)
+    if isinstance(value, np.ndarray):
+        return (len(value) if value.ndim > 0 else 1), value.nbytes
+    return None
+
+def get_first_size(values):
+    for value in values:
+        size = get_size(value)
+        if size is not None:
+            return size
+    return None
+
+class StageProfiler:
+    '''
+    Records the calls of wrapped functions, grouped by call stack. Created by enable_profiling.
+
+    Args:
+        track_memory (boolean): Whether rows, dataframe memory and resident memory are recorded. Timing is always
+            recorded.
+        interval (float): Seconds between resident memory samples.
+    '''
+    def __init__(self, track_memory=True, interval=0.005):
+        self.track_memory = track_memory
+        self.interval = interval
+        # Each call stack is a tuple of function names, and maps to a list of
+        # [calls, wall seconds, cpu seconds, rows in, rows out, memory delta bytes, peak rss MB, peak growth MB].
+        self.stacks = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # The highest resident memory seen so far by each running call, keyed by the id of its one item list.
+        self.running_peaks = {}
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def sample_memory(self):
+        while not self.stopped.wait(self.interval):
+            memory = get_rss_mb()
+            with self.lock:
+                for peak in self.running_peaks.values():
+                    peak[0] = max(peak[0], memory)
+
+    def start(self):
+        '''
+        Start the thread that samples resident memory. Without it each call's peak is the larger of its memory at the
+        start and the end.
+        '''
+        if self.track_memory and self.sampler is None:
+            self.stopped.clear()
+            self.sampler = threading.Thread(target=self.sample_memory, daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        if self.sampler is not None:
+            self.stopped.set()
+            self.sampler.join()
+            self.sampler = None
+
+    def get_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def call(self, name, function, args, kwargs):
+        '''
+        Call a wrapped function and record the call under the current call stack.
+        '''
+        stack = self.get_stack()
+        stack.append(name)
+        path = tuple(stack)
+        size_in = get_first_size(args) if self.track_memory else None
+        if size_in is None and self.track_memory:
+            size_in = get_first_size(kwargs.values())
+        if self.track_memory:
+            start_mb = get_rss_mb()
+            peak = [start_mb]
+            with self.lock:
+                self.running_peaks[id(peak)] = peak
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            return result
+        finally:
+            wall_seconds = time.perf_counter() - start
+            cpu_seconds = time.process_time() - start_cpu
+            stack.pop()
+            memory = None
+            if self.track_memory:
+                end_mb = get_rss_mb()
+                with self.lock:
+                    del self.running_peaks[id(peak)]
+                memory = (start_mb, max(peak[0], end_mb))
+            self.record(path, wall_seconds, cpu_seconds, size_in, result, memory)
+
+    def record(self, path, wall_seconds, cpu_seconds, size_in, result, memory=None):
+        '''
+        Add one call to the totals of its call stack. memory is a tuple of the resident memory in MB when the call
+        started and the highest it reached before the call returned.
+        '''
+        rows_in = rows_out = memory_delta = 0
+        peak_rss_mb = peak_growth_mb = 0.0
+        if self.track_memory:
+            # Functions returning several values are measured by the first dataframe, series or array among them.
+            size_out = get_first_size(result if isinstance(result, tuple) else (result,))
+            rows_in, bytes_in = size_in if size_in is not None else (0, 0)
+            rows_out, bytes_out = size_out if size_out is not None else (0, 0)
+            memory_delta = bytes_out - bytes_in
+        if memory is not None:
+            start_mb, peak_rss_mb = memory
+            peak_growth_mb = peak_rss_mb - start_mb
+        with self.lock:
+            stats = self.stacks.setdefault(path, [0, 0.0, 0.0, 0, 0, 0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += wall_seconds
+            stats[2] += cpu_seconds
+            stats[3] += rows_in
+            stats[4] += rows_out
+            stats[5] += memory_delta
+            stats[6] = max(stats[6], peak_rss_mb)
+            stats[7] = max(stats[7], peak_growth_mb)
+
+    def reset(self):
+        with self.lock:
+            self.stacks = {}
+
+    def get_report(self):
+        '''
+        Get the totals of every call stack.
+
+        Returns:
+            DataFrame: Returns a dataframe indexed by call stack, with the function names separated by ';', sorted so
+            every function comes right after the function that called it. Besides the columns described at the top of
+            this file, self_wall_seconds and self_cpu_seconds leave out the time spent in wrapped functions it called.
+        '''
+        with self.lock:
+            stacks = {path: list(stats) for path, stats in self.stacks.items()}
+        child_wall = dict.fromkeys(stacks, 0.0)
+        child_cpu = dict.fromkeys(stacks, 0.0)
+        for path, stats in stacks.items():
+            if path[:-1] in stacks:
+                child_wall[path[:-1]] += stats[1]
+                child_cpu[path[:-1]] += stats[2]
+
+        rows = []
+        for path in sorted(stacks):
+            calls, wall, cpu, rows_in, rows_out, memory_delta, peak_rss_mb, peak_growth_mb = stacks[path]
+            rows.append({'stack': ';'.join(path), 'depth': len(path) - 1, 'calls': calls, 'wall_seconds': wall,
+                         'self_wall_seconds': max(wall - child_wall[path], 0.0), 'cpu_seconds': cpu,
+                         'self_cpu_seconds': max(cpu - child_cpu[path], 0.0), 'rows_in': rows_in, 'rows_out': rows_out,
+                         'memory_delta_mb': memory_delta / 2**20, 'peak_rss_mb': peak_rss_mb,
+                         'peak_growth_mb': peak_growth_mb})
+        columns = ['stack', 'depth', 'calls', 'wall_seconds', 'self_wall_seconds', 'cpu_seconds', 'self_cpu_seconds',
+                   'rows_in', 'rows_out', 'memory_delta_mb', 'peak_rss_mb', 'peak_growth_mb']
+        return pd.DataFrame(rows, columns=columns).set_index('stack')
+
+    def get_folded_stacks(self, metric='wall'):
+        '''
+        Get the report in the folded stack format: one line per call stack with the function names separated by ';',
+        a space and the stack's own time in microseconds.
+
+        Args:
+            metric (string): 'wall' for wall time or 'cpu' for CPU time.
+
+        Returns:
+            list: Returns the lines, without newlines.
+        '''
+        column = {'wall': 'self_wall_seconds', 'cpu': 'self_cpu_seconds'}[metric]
+        report = self.get_report()
+        microseconds = (report[column] * 1e6).round().astype('int64')
+        return [f'{stack} {value}' for stack, value in microseconds.items() if value > 0]
+
+    def write_folded_stacks(self, filename, metric='wall'):
+        '''
+        Write the report in the folded stack format, for example to make an SVG with
+        `flamegraph.pl profile.folded > profile.svg` or by opening the file at https://www.speedscope.app.
+
+        Args:
+            filename (string): Path of the file to write.
+            metric (string): 'wall' for wall time or 'cpu' for CPU time.
+        '''
+        with open(filename, 'w') as f:
+            for line in self.get_folded_stacks(metric):
+                f.write(line + '\n')
+
+def wrap_function(profiler, function):
+    name = f"{function.__module__.rsplit('.', 1)[-1]}.{function.__name__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return profiler.call(name, function, args, kwargs)
+    return wrapper
+
+def get_public_functions(module):
+    '''
+    Get the public functions defined in a module, leaving out the ones it imported from elsewhere.
+
+    Returns:
+        dict: Returns a dictionary where the key is the function name and the value is the function.
+    '''
+    return {name: value for name, value in vars(module).items()
+            if inspect.isfunction(value) and value.__module__ == module.__name__ and not name.startswith('_')}
+
+def enable_profiling(modules=PROFILED_MODULES, track_memory=True):
+    '''
+    Start profiling by wrapping every public function of the modules. Any profiling already running is stopped first.
+
+    Args:
+        modules (list or tuple of strings): Names of the modules whose functions are wrapped. They're imported if they
+            haven't been yet.
+        track_memory (boolean): See StageProfiler.
+
+    Returns:
+        StageProfiler: The profiler recording the calls.
+    '''
+    global active_profiler
+    disable_profiling()
+    profiler = StageProfiler(track_memory)
+    wrappers = {}
+    for module_name in modules:
+        for function in get_public_functions(importlib.import_module(module_name)).values():
+            wrappers[function] = wrap_function(profiler, function)
+
+    # Every loaded src module and __main__ may have its own name for the same function.
+    namespaces = [module for name, module in list(sys.modules.items())
+                  if module is not None and (name == '__main__' or name.startswith('src.'))]
+    for module in namespaces:
+        for name, value in list(vars(module).items()):
+            if inspect.isfunction(value) and value in wrappers:
+                active_patches.append((module, name, value))
+                setattr(module, name, wrappers[value])
+    profiler.start()
+    active_profiler = profiler
+    return profiler
+
+def disable_profiling():
+    '''
+    Stop profiling and put every original function back.
+
+    Returns:
+        StageProfiler or None: The profiler that was recording, so its report can still be read, or None if profiling
+        wasn't on.
+    '''
+    global active_profiler
+    for module, name, original in reversed(active_patches):
+        setattr(module, name, original)
+    active_patches.clear()
+    profiler, active_profiler = active_profiler, None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+@contextmanager
+def profiling(modules=PROFILED_MODULES, track_memory=True):
+    '''
+    Context manager that profiles the code inside it, for example:
+        with profiling() as profiler:
+            df = clean_and_prepare_raw_data_for_model(loans)
+        print(profiler.get_report())
+    '''
+    profiler = enable_profiling(modules, track_memory)
+    try:
+        yield profiler
+    finally:
+        disable_profiling()
+
+if __name__ == '__main__':
+    from src.columns import columns_to_use
+    from src.data_cleaning import clean_and_prepare_raw_data_for_model, load_loan_data_from_local_machine
+    with profiling() as profiler:
+        loans = load_loan_data_from_local_machine(('LoanStats_securev1_2016Q1.csv',), columns_to_use)
+        df = clean_and_prepare_raw_data_for_model(loans)
+    pd.set_option('display.width', 200)
+    print(profiler.get_report())
+    profiler.write_folded_stacks('data/profile.folded')
@@ -0,0 +1,255 @@
+'''
+This file contains a quantized copy of the feature matrix. Every time a histogram-based model is trained on the float32
+features it sorts or sketches every column again to find its bins. Here the bins of each feature are learned once after
+clean_and_prepare_raw_data_for_model, and the matrix is stored on disk as one uint8 bin code per value, a quarter of the
+size of float32, along with each feature's bin edges:
+    <filename>.npy       The bin codes, one row per loan and one column per feature. It's memory mapped when loaded.
+    <filename>.bins.npz  The lower edge of every bin of every feature, and the feature columns.
+
+Bin c of a feature holds the values from edges[c] up to edges[c + 1]. Features with at most max_bins distinct values,
+which is most of them since the dummy, _missing and count columns only hold a few values, get one bin per value and
+lose nothing. Continuous features get bins at quantiles of their values. Code 255 is reserved for missing values.
+
+The bins can be used directly by:
+    XGBoost    get_quantile_dmatrix builds a QuantileDMatrix from the codes a chunk at a time. Every bin is given the
+               value of its lower edge, so XGBoost finds exactly these bins, and the QuantileDMatrix can be reused by
+               every model trained on the same loans.
+    Our trees  compile_trees_for_codes converts the thresholds of a tree_inference.CompiledTrees to bin codes, so the
+               model predicts from the uint8 codes. This is exact for models trained on the quantized matrix.
+'''
+
+import numpy as np
+from src.tree_inference import CompiledTrees
+
+MISSING_CODE = 255
+
+def get_bin_edges(values, max_bins=255):
+    '''
+    Learn the bins of one feature.
+
+    Args:
+        values (array): The values of the feature. NaNs are ignored.
+        max_bins (int): Most bins the feature may have, at most 255.
+
+    Returns:
+        array: Returns the sorted lower edge of each bin. The first edge is the smallest value.
+    '''
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.zeros(1, dtype='float32')
+    unique_values = np.unique(values)
+    if len(unique_values) <= max_bins:
+        return unique_values.astype('float32')
+    # Quantiles are taken on the distinct values as 'lower' so every edge is a value that's in the data.
+    edges = np.quantile(values, np.linspace(0, 1, max_bins, endpoint=False), method='lower')
+    return np.unique(edges).astype('float32')
+
+def get_codes(values, edges):
+    '''
+    Convert the values of one feature to bin codes. Values below the first edge go in the first bin.
+
+    Args:
+        values (array): The values of the feature.
+        edges (array): The lower edges of the feature's bins, from get_bin_edges.
+
+    Returns:
+        array: Returns a uint8 array of bin codes, with MISSING_CODE for NaNs.
+    '''
+    codes = np.maximum(np.searchsorted(edges, values.astype('float32'), side='right') - 1, 0).astype('uint8')
+    codes[np.isnan(values)] = MISSING_CODE
+    return codes
+
+def write_quantized_matrix(X, filename, max_bins=255, sample_rows=500000, chunk_size=100000, seed=91):
+    '''
+    Learn the bins of every feature and write the bin codes and edges to disk.
+
+    Args:
+        X (dataframe): Dataframe of features from clean_and_prepare_raw_data_for_model, without the label or issue date.
+            For example X_train.
+        filename (string): Path of the files to write, without an extension, for example 'data/X_train_quantized'.
+        max_bins (int): Most bins any feature may have, at most 255.
+        sample_rows (int): Number of randomly chosen rows the bins are learned from. Every row is used if there are fewer.
+        chunk_size (int): Number of rows converted to codes at a time, so the whole matrix is never converted at once.
+        seed (int): Seed for choosing the sample rows.
+
+    Returns:
+        QuantizedMatrix: The quantized matrix read back from the files.
+    '''
+    max_bins = min(max_bins, MISSING_CODE)
+    feature_columns = [str(col) for col in X.columns]
+    if len(X) > sample_rows:
+        sample = np.random.default_rng(seed).choice(len(X), sample_rows, replace=False)
+        sample.sort()
+    else:
+        sample = slice(None)
+    edges = [get_bin_edges(X[col].to_numpy(dtype='float32')[sample], max_bins) for col in X.columns]
+
+    codes = np.lib.format.open_memmap(filename + '.npy', mode='w+', dtype='uint8', shape=X.shape)
+    for start in range(0, len(X), chunk_size):
+        chunk = np.asarray(X.iloc[start:start + chunk_size], dtype='float32')
+        for i, feature_edges in enumerate(edges):
+            codes[start:start + len(chunk), i] = get_codes(chunk[:, i], feature_edges)
+    codes.flush()
+    del codes
+
+    offsets = np.cumsum([0] + [len(feature_edges) for feature_edges in edges])
+    np.savez(filename + '.bins.npz', edges=np.concatenate(edges), offsets=offsets,
+             feature_columns=np.array(feature_columns), max_bins=max_bins)
+    return QuantizedMatrix(filename)
+
+class QuantizedMatrix:
+    '''
+    A feature matrix of uint8 bin codes written by write_quantized_matrix. The codes are memory mapped, so only the
+    rows that are used are read from disk.
+
+    Args:
+        filename (string): Path of the files, without an extension.
+    '''
+    def __init__(self, filename):
+        self.codes = np.load(filename + '.npy', mmap_mode='r')
+        with np.load(filename + '.bins.npz') as bins:
+            offsets = bins['offsets']
+            self.edges = [bins['edges'][start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+            self.feature_columns = bins['feature_columns'].tolist()
+            self.max_bins = int(bins['max_bins'])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def quantize(self, X):
+        '''
+        Convert new loans to bin codes with the bins learned from the stored matrix.
+
+        Args:
+            X (dataframe or array): Features with the same columns as the stored matrix.
+
+        Returns:
+            array: Returns a uint8 array of bin codes.
+        '''
+        features = np.asarray(X, dtype='float32')
+        return np.column_stack([get_codes(features[:, i], edges) for i, edges in enumerate(self.edges)])
+
+    def dequantize(self, codes):
+        '''
+        Convert bin codes to float32 values, giving each bin the value of its lower edge and missing codes NaN.
+
+        Args:
+            codes (array): uint8 bin codes, for example rows of self.codes.
+
+        Returns:
+            array: Returns a float32 array the same shape as codes.
+        '''
+        values = np.empty(codes.shape, dtype='float32')
+        for i, edges in enumerate(self.edges):
+            column = codes[:, i]
+            # Missing codes are clipped to a valid bin, then replaced by NaN.
+            values[:, i] = edges[np.minimum(column, len(edges) - 1)]
+            values[column == MISSING_CODE, i] = np.nan
+        return values
+
+    def get_quantile_dmatrix(self, label=None, rows=None, chunk_size=100000, max_bin=256, n_threads=-1):
+        '''
+        Build an XGBoost QuantileDMatrix from the codes. XGBoost reads the matrix a chunk at a time, so the float
+        features are never all in memory, and every bin of the stored matrix becomes one XGBoost bin.
+
+        Args:
+            label (array or series or None): The ROI of each loan, in the same order as the stored rows.
+            rows (slice or None): Range of rows to use, for example slice(0, 100000). None uses every row.
+            chunk_size (int): Number of rows XGBoost reads at a time.
+            max_bin (int): XGBoost's max_bin, which must be the same when the model is trained. The default is
+                XGBoost's own default, and it must be at least self.max_bins.
+            n_threads (int): Number of threads XGBoost may use to build the matrix.
+
+        Returns:
+            QuantileDMatrix: The XGBoost training matrix.
+        '''
+        import xgboost as xgb
+        rows = slice(None) if rows is None else rows
+        codes = self.codes[rows]
+        label = None if label is None else np.asarray(label, dtype='float32')[rows]
+        matrix = self
+
+        class CodeChunks(xgb.DataIter):
+            def __init__(self):
+                self.start = 0
+                super().__init__()
+
+            def next(self, input_data):
+                if self.start >= len(codes):
+                    return False
+                end = self.start + chunk_size
+                input_data(data=matrix.dequantize(codes[self.start:end]),
+                           label=None if label is None else label[self.start:end],
+                           feature_names=matrix.feature_columns)
+                self.start = end
+                return True
+
+            def reset(self):
+                self.start = 0
+
+        return xgb.QuantileDMatrix(CodeChunks(), max_bin=max_bin, nthread=n_threads)
+
+    def compile_trees_for_codes(self, compiled_trees):
+        '''
+        Convert the thresholds of a compiled model to bin codes, so it predicts from self.codes directly. A row goes
+        left when the lower edge of its bin is below the threshold, which is the same as its code being below the
+        number of edges under the threshold. Predictions are exact for models trained on the quantized matrix, such
+        as with get_quantile_dmatrix, and close for models trained on the float features.
+
+        Args:
+            compiled_trees (CompiledTrees): A model compiled with tree_inference.compile_tree_model, trained on
+                features with the same columns as the stored matrix.
+
+        Returns:
+            CompiledTrees: Returns the model with thresholds in bin codes.
+        '''
+        arrays = dict(compiled_trees.arrays)
+        feature = arrays['feature']
+        threshold = np.array(arrays['threshold'], dtype='float32')
+        is_split = ~np.isnan(threshold)
+        for i, edges in enumerate(self.edges):
+            nodes = is_split & (feature == i)
+            threshold[nodes] = np.searchsorted(edges, threshold[nodes], side='left')
+        arrays['threshold'] = threshold
+        return CompiledTrees(arrays, compiled_trees.base_score, compiled_trees.max_depth, 'float32')
+
+    def predict(self, code_trees, rows=None, chunk_size=100000):
+        '''
+        Predict from the stored codes with a model from compile_trees_for_codes.
+
+        Args:
+            code_trees (CompiledTrees): The model with thresholds in bin codes.
+            rows (slice or None): Range of rows to predict. None predicts every row.
+            chunk_size (int): Number of rows converted from uint8 at a time.
+
+        Returns:
+            array: Returns one prediction per row.
+        '''
+        codes = self.codes[slice(None) if rows is None else rows]
+        predictions = np.empty(len(codes))
+        for start in range(0, len(codes), chunk_size):
+            chunk = codes[start:start + chunk_size].astype('float32')
+            chunk[chunk == MISSING_CODE] = np.nan
+            predictions[start:start + len(chunk)] = code_trees.predict(chunk)
+        return predictions
+
+if __name__ == '__main__':
+    import time
+    import pandas as pd
+    import xgboost as xgb
+    from src.tree_inference import compile_tree_model
+    X_train = pd.read_pickle('data/X_train.pkl.bz2', compression='bz2')
+    y_train = pd.read_pickle('data/y_train.pkl.bz2', compression='bz2')
+
+    start = time.perf_counter()
+    quantized = write_quantized_matrix(X_train, 'data/X_train_quantized')
+    print(f'Quantized in {time.perf_counter() - start:.1f}s, {X_train.shape[0] * X_train.shape[1] * 4 / 2**20:.0f} MB '
+          f'as float32, {quantized.codes.nbytes / 2**20:.0f} MB as codes')
+
+    dtrain = quantized.get_quantile_dmatrix(y_train)
+    for learning_rate in (0.05, 0.1, 0.3):
+        start = time.perf_counter()
+        booster = xgb.train({'tree_method': 'hist', 'learning_rate': learning_rate, 'seed': 91}, dtrain, 100)
+        print(f'learning_rate={learning_rate} trained in {time.perf_counter() - start:.1f}s')
+    code_trees = quantized.compile_trees_for_codes(compile_tree_model(booster))
+    print(np.abs(quantized.predict(code_trees, slice(0, 1000)) - booster.predict(dtrain)[:1000]).max())
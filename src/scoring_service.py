@@ -0,0 +1,364 @@
+'''
+This file contains a small HTTP service that predicts the ROI of new loan listings, the first step towards choosing
+loans to invest in automatically. The trained model is loaded, and the transform from raw listings to its features
+is built, once when the service starts.
+
+Requests are grouped into micro-batches before they reach the model. The first request to arrive starts a batch, and
+the batch is scored once it holds max_batch_size loans or max_wait_ms milliseconds have passed. Tree models score 100
+loans in about the time they take to score 1, so under load this raises throughput without adding more than
+max_wait_ms to any request's latency.
+
+Endpoints:
+    POST /predict   Body {"loan": {...}} or {"loans": [{...}, ...]} where each loan maps raw LoanStats columns or
+                    feature names to values. See listing_features.py.
+                    Returns {"predicted_roi": [...]}.
+    GET /metrics    Latency percentiles, throughput and batch sizes since the service started.
+    GET /health     Returns {"status": "ok"}.
+
+Run this file to start the service on a saved model and benchmark it with the local load generator.
+'''
+
+import asyncio
+import collections
+import json
+import pickle
+import time
+import numpy as np
+import pandas as pd
+from src.listing_features import ListingTransform, get_listing_transform_spec
+
+MODEL_FILE = 'data/model_xgb.pickle'
+LISTINGS_FILE = 'data/X_test.pkl.bz2'
+
+class ScoringModel:
+    '''
+    A trained model and the transform that turns listings into the features it expects.
+
+    Args:
+        model (varies): A model that has been trained to predict loan ROI.
+        feature_columns (list): The columns of the training features, for example list(X_train.columns).
+        fill_value (int or float): Value used for features missing from a listing, the same value fill_nas uses.
+        listing_transform (ListingTransform or None): Makes the features from raw listings. If None, listings must
+            already hold the feature columns.
+    '''
+    def __init__(self, model, feature_columns, fill_value=-99, listing_transform=None):
+        self.model = model
+        self.feature_columns = list(feature_columns)
+        self.fill_value = fill_value
+        if listing_transform is None:
+            listing_transform = ListingTransform({'feature_columns': self.feature_columns, 'fill_value': fill_value})
+        self.listing_transform = listing_transform
+
+    def get_features(self, listings):
+        '''
+        Convert listings to the float32 feature matrix the model was trained on. See ListingTransform.get_features.
+        '''
+        return self.listing_transform.get_features(listings)
+
+    def predict_features(self, features):
+        return np.asarray(self.model.predict(features), dtype='float64')
+
+    def predict(self, listings):
+        return self.predict_features(self.get_features(listings))
+
+def load_scoring_model(model_file=MODEL_FILE, feature_columns=None, rates_directory='data'):
+    '''
+    Load a pickled model for the scoring service, and build the transform from raw listings to its features.
+
+    Args:
+        model_file (string): Path to the pickled model.
+        feature_columns (list or None): The columns of the training features. If None they're read from the model's
+            feature_names_in_ attribute, which scikit-learn style models set when trained on a dataframe.
+        rates_directory (string): Folder holding the FRED rate files used in training.
+
+    Returns:
+        ScoringModel: The loaded model.
+    '''
+    with open(model_file, 'rb') as f:
+        model = pickle.load(f)
+    if feature_columns is None:
+        feature_columns = model.feature_names_in_
+    spec = get_listing_transform_spec(feature_columns, rates_directory=rates_directory)
+    return ScoringModel(model, feature_columns, spec['fill_value'], ListingTransform(spec))
+
+class LatencyMetrics:
+    '''
+    Keeps the latency of the most recent requests and counts every request, loan and batch scored.
+
+    Args:
+        max_samples (int): Number of recent request latencies kept for the percentiles.
+    '''
+    def __init__(self, max_samples=100000):
+        self.latencies = collections.deque(maxlen=max_samples)
+        self.start_time = time.perf_counter()
+        self.requests = 0
+        self.loans = 0
+        self.batches = 0
+
+    def record_request(self, latency, num_loans):
+        self.latencies.append(latency)
+        self.requests += 1
+        self.loans += num_loans
+
+    def record_batch(self):
+        self.batches += 1
+
+    def get_summary(self):
+        '''
+        Summarize the service's performance.
+
+        Returns:
+            dict: Dictionary containing the number of requests, loans and batches, the p50, p99 and max request latency
+            in milliseconds, requests and loans scored per second, and the mean number of loans per batch.
+        '''
+        elapsed = time.perf_counter() - self.start_time
+        latencies = 1000 * np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {'requests': self.requests, 'loans': self.loans, 'batches': self.batches,
+                'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+                'max_ms': float(latencies.max()), 'requests_per_second': self.requests / elapsed,
+                'loans_per_second': self.loans / elapsed, 'mean_batch_size': self.loans / max(self.batches, 1)}
+
+class MicroBatcher:
+    '''
+    Groups concurrent prediction requests into batches before calling the model. The model runs in a worker thread so
+    the event loop can keep accepting requests while a batch is scored. Requests are queued as feature matrices that
+    have already been checked, so a bad listing fails only its own request and never the batch it would have joined.
+
+    Args:
+        scoring_model (ScoringModel): The model used to score each batch.
+        metrics (LatencyMetrics): Where batch counts are recorded.
+        max_batch_size (int): Most loans scored in one call to the model.
+        max_wait_ms (float): Longest time the first request in a batch waits for more requests to arrive.
+    '''
+    def __init__(self, scoring_model, metrics, max_batch_size=256, max_wait_ms=5.0):
+        self.scoring_model = scoring_model
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def predict(self, features):
+        '''
+        Queue a request's feature matrix, from ScoringModel.get_features, and wait for its predictions.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((features, future))
+        return await future
+
+    async def get_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        num_loans = len(batch[0][0])
+        deadline = loop.time() + self.max_wait
+        while num_loans < self.max_batch_size:
+            # Requests that are already waiting join the batch even after the deadline.
+            if not self.queue.empty():
+                request = self.queue.get_nowait()
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch.append(request)
+            num_loans += len(request[0])
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.get_batch()
+            features = np.concatenate([request_features for request_features, future in batch])
+            try:
+                predictions = await loop.run_in_executor(None, self.scoring_model.predict_features, features)
+            except Exception as e:
+                for request_features, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.record_batch()
+            start = 0
+            for request_features, future in batch:
+                if not future.done():
+                    future.set_result(predictions[start:start + len(request_features)].tolist())
+                start += len(request_features)
+
+class ScoringService:
+    '''
+    A minimal HTTP/1.1 server built on asyncio streams. Connections are kept alive between requests, which is what the
+    load generator and most HTTP clients do.
+
+    Args:
+        scoring_model (ScoringModel): The model used to score listings.
+        max_batch_size (int): See MicroBatcher.
+        max_wait_ms (float): See MicroBatcher.
+    '''
+    def __init__(self, scoring_model, max_batch_size=256, max_wait_ms=5.0):
+        self.scoring_model = scoring_model
+        self.metrics = LatencyMetrics()
+        self.batcher = MicroBatcher(scoring_model, self.metrics, max_batch_size, max_wait_ms)
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8080):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self.handle_request(method, path, body)
+                writer.write(get_http_response(status, response))
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics.get_summary()
+        if method != 'POST' or path != '/predict':
+            return 404, {'error': f'{method} {path} not found'}
+
+        start = time.perf_counter()
+        try:
+            request = json.loads(body)
+            listings = [request['loan']] if 'loan' in request else request['loans']
+            if not isinstance(listings, list):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            return 400, {'error': 'Body must be JSON with a "loan" object or a "loans" list.'}
+        if not listings:
+            return 200, {'predicted_roi': []}
+        # Listings are transformed and checked here, so a bad one is rejected on its own instead of failing the batch
+        # it would join.
+        try:
+            features = self.scoring_model.get_features(listings)
+        except (ValueError, TypeError) as e:
+            return 400, {'error': str(e)}
+        try:
+            predictions = await self.batcher.predict(features)
+        except Exception as e:
+            return 500, {'error': str(e)}
+        self.metrics.record_request(time.perf_counter() - start, len(listings))
+        return 200, {'predicted_roi': predictions}
+
+def get_http_response(status, response):
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+    body = json.dumps(response).encode()
+    header = f'HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'
+    return header.encode() + body
+
+async def send_requests(host, port, bodies, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for body in bodies:
+            start = time.perf_counter()
+            writer.write(f'POST /predict HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+            await reader.readline()
+            content_length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    content_length = int(line.split(b':', 1)[1])
+            await reader.readexactly(content_length)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+async def run_load_test(host, port, listings, num_requests=2000, concurrency=32, loans_per_request=1, seed=91):
+    '''
+    Send prediction requests to a running scoring service from several concurrent connections.
+
+    Args:
+        host (string): Host the service is listening on.
+        port (int): Port the service is listening on.
+        listings (list of dicts): Listings to send. Each request samples loans_per_request of them.
+        num_requests (int): Total number of requests to send.
+        concurrency (int): Number of connections sending requests at the same time.
+        loans_per_request (int): Number of loans in each request.
+        seed (int): Seed for sampling the listings.
+
+    Returns:
+        dict: Dictionary containing the p50, p99 and max latency in milliseconds seen by the clients, and the requests
+        and loans scored per second.
+    '''
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, len(listings), size=(num_requests, loans_per_request))
+    bodies = [json.dumps({'loans': [listings[i] for i in sample]}).encode() for sample in samples]
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(send_requests(host, port, bodies[i::concurrency], latencies) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies = 1000 * np.array(latencies)
+    return {'requests': num_requests, 'concurrency': concurrency, 'loans_per_request': loans_per_request,
+            'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+            'max_ms': float(latencies.max()), 'requests_per_second': num_requests / elapsed,
+            'loans_per_second': num_requests * loans_per_request / elapsed}
+
+async def run_benchmark(scoring_model, listings, max_wait_ms_values=(0, 2, 5), concurrency=32, num_requests=2000):
+    '''
+    Start the service on a free local port and run the load generator against it for several batching windows. A
+    window of 0 ms scores requests in whatever batches happen to be waiting, which is close to no batching.
+
+    Returns:
+        DataFrame: Returns one row of client-side results per batching window, with the service's mean batch size.
+    '''
+    rows = []
+    for max_wait_ms in max_wait_ms_values:
+        service = ScoringService(scoring_model, max_wait_ms=max_wait_ms)
+        port = await service.start(port=0)
+        try:
+            result = await run_load_test('127.0.0.1', port, listings, num_requests, concurrency)
+        finally:
+            await service.stop()
+        result['max_wait_ms'] = max_wait_ms
+        result['mean_batch_size'] = service.metrics.get_summary()['mean_batch_size']
+        rows.append(result)
+    return pd.DataFrame(rows).set_index('max_wait_ms')
+
+if __name__ == '__main__':
+    scoring_model = load_scoring_model(MODEL_FILE)
+    X_test = pd.read_pickle(LISTINGS_FILE, compression='bz2')
+    listings = X_test[scoring_model.feature_columns].head(10000).to_dict(orient='records')
+    print(asyncio.run(run_benchmark(scoring_model, listings)))
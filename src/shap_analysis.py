@@ -0,0 +1,281 @@
+'''
+This file contains a parallel, cached TreeSHAP computation for the testing loans. SHAP.ipynb explains the model in one
+process and has to start over every session. Here the testing features are split into chunks of rows, a process pool
+computes the SHAP values of each chunk and writes them straight into a float32 .npy file, and the file is memory mapped
+when it's read back so only the rows and columns that are used are loaded.
+
+Results are keyed by a hash of the model and the features, so explaining the same model on the same loans again reads
+the cached file. While the chunks are computed, each worker also sums the absolute SHAP values of its rows for every
+group of loans, such as each grade and issue month. These sums are saved in a small .npz file next to the values, so
+the mean |SHAP| per feature, per grade or per issue month is read without touching the full matrix.
+
+XGBoost models are explained with XGBoost's own TreeSHAP (predict with pred_contribs=True), which gives the same
+values as shap.TreeExplainer without needing the shap package. Other tree models use shap.TreeExplainer.
+'''
+
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from src.model_zoo import get_cpu_budget
+
+SHAP_DIRECTORY = 'data/shap'
+
+# These are set by compute_shap_values before the process pool is created. The worker processes are forked, so they
+# inherit the model, features and group codes without them being pickled and copied to every worker.
+shap_model = None
+shap_features = None
+shap_group_codes = None
+
+def get_model_bytes(fit_model):
+    if hasattr(fit_model, 'get_booster'):
+        fit_model = fit_model.get_booster()
+    if hasattr(fit_model, 'save_raw'):
+        return bytes(fit_model.save_raw('ubj'))
+    return pickle.dumps(fit_model)
+
+def get_shap_key(fit_model, features, feature_columns):
+    '''
+    Get a fingerprint of the model and the features it's explaining.
+
+    Args:
+        fit_model (varies): A model that has been trained to predict loan ROI.
+        features (array): The float32 feature matrix being explained.
+        feature_columns (list): The names of the feature columns.
+
+    Returns:
+        string: Returns the first 24 characters of the SHA-256 hash of the model and the features.
+    '''
+    h = hashlib.sha256()
+    h.update(hashlib.sha256(get_model_bytes(fit_model)).digest())
+    h.update(json.dumps([str(col) for col in feature_columns]).encode())
+    h.update(str(features.shape).encode())
+    h.update(np.ascontiguousarray(features))
+    return h.hexdigest()[:24]
+
+def get_grade_labels(X):
+    '''
+    Get the grade of each loan from the grade dummy columns made by feature_engineering.get_grade_dummies.
+
+    Args:
+        X (dataframe): Dataframe of features containing the grade_A to grade_G columns.
+
+    Returns:
+        Series: Returns the grade of each loan.
+    '''
+    grade_cols = [col for col in X.columns if col.startswith('grade_')]
+    grades = np.array([col[len('grade_'):] for col in grade_cols])
+    return pd.Series(grades[np.argmax(X[grade_cols].to_numpy(), axis=1)], index=X.index)
+
+def get_tree_shap_values(fit_model, features, n_threads=1):
+    '''
+    Compute the SHAP values of some rows.
+
+    Args:
+        fit_model (varies): A trained tree model.
+        features (array): The rows to explain.
+        n_threads (int): Number of threads XGBoost may use. The caller's model keeps its own setting.
+
+    Returns:
+        array: Returns a float32 array with one row per loan, one column per feature and a last column holding the
+        expected value, so each row sums to the model's prediction.
+    '''
+    booster = fit_model.get_booster() if hasattr(fit_model, 'get_booster') else fit_model
+    if hasattr(booster, 'save_raw'):
+        import xgboost as xgb
+        # Setting nthread on a copy leaves the caller's model as it was.
+        booster = booster.copy()
+        booster.set_param('nthread', n_threads)
+        dmatrix = xgb.DMatrix(features, feature_names=booster.feature_names, nthread=n_threads)
+        return booster.predict(dmatrix, pred_contribs=True).astype('float32')
+
+    import shap
+    explainer = shap.TreeExplainer(fit_model)
+    values = np.asarray(explainer.shap_values(features), dtype='float32')
+    expected_value = np.full((len(values), 1), np.ravel(explainer.expected_value)[0], dtype='float32')
+    return np.hstack([values, expected_value])
+
+def explain_chunk(task):
+    '''
+    Compute the SHAP values of one chunk of rows and write them into the memory mapped output. This is the function
+    mapped over the process pool, so it reads the model, features and group codes from the module level variables set
+    up by compute_shap_values.
+
+    Args:
+        task (tuple): Tuple of (output path, first row, last row, threads per worker, number of codes in each group).
+
+    Returns:
+        dict: Returns the sum of the absolute and signed SHAP values for each code of each group in the chunk.
+    '''
+    path, start, end, n_threads, group_sizes = task
+    values = get_tree_shap_values(shap_model, shap_features[start:end], n_threads)
+    output = np.load(path, mmap_mode='r+')
+    output[start:end] = values
+    output.flush()
+    del output
+    return sum_chunk_by_group(values, start, end, group_sizes)
+
+def sum_chunk_by_group(values, start, end, group_sizes):
+    '''
+    Sum the absolute and signed SHAP values of rows start:end for each code of each group in shap_group_codes.
+
+    Returns:
+        dict: Returns a dictionary where the key is the group name and the value is a tuple of the absolute and signed
+        sums, each with one row per code and one column per feature.
+    '''
+    abs_values = np.abs(values[:, :-1])
+    sums = {}
+    for name, codes in shap_group_codes.items():
+        abs_sums = np.zeros((group_sizes[name], abs_values.shape[1]))
+        signed_sums = np.zeros((group_sizes[name], abs_values.shape[1]))
+        np.add.at(abs_sums, codes[start:end], abs_values)
+        np.add.at(signed_sums, codes[start:end], values[:, :-1])
+        sums[name] = (abs_sums, signed_sums)
+    return sums
+
+class ShapResults:
+    '''
+    Cached SHAP values and their aggregates. The values are only memory mapped when they're used, and the aggregates
+    are read from a small .npz file.
+    '''
+    def __init__(self, values_path, aggregates_path):
+        self.values_path = values_path
+        with np.load(aggregates_path, allow_pickle=False) as aggregates:
+            self.feature_columns = aggregates['feature_columns'].tolist()
+            self.aggregates = {name: aggregates[name] for name in aggregates.files if name != 'feature_columns'}
+
+    @property
+    def values(self):
+        '''
+        The SHAP values as a read only memory mapped array, with the expected value in the last column.
+        '''
+        return np.load(self.values_path, mmap_mode='r')
+
+    def get_mean_abs_shap(self):
+        '''
+        Get the mean |SHAP| of each feature over every loan, sorted from the most to the least important.
+        '''
+        totals = self.aggregates['all_abs'].sum(axis=0) / self.aggregates['all_counts'].sum()
+        return pd.Series(totals, index=self.feature_columns).sort_values(ascending=False)
+
+    def get_mean_abs_shap_by(self, group, signed=False):
+        '''
+        Get the mean SHAP value of each feature for every value of a group.
+
+        Args:
+            group (string): A group passed to compute_shap_values, for example 'grade' or 'issue_month'.
+            signed (bool): Average the signed SHAP values instead of the absolute values.
+
+        Returns:
+            DataFrame: Returns a dataframe indexed by the group's values with one column per feature.
+        '''
+        sums = self.aggregates[f'{group}_signed' if signed else f'{group}_abs']
+        counts = self.aggregates[f'{group}_counts']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts[:, None]
+        return pd.DataFrame(means, index=pd.Index(self.aggregates[f'{group}_labels'], name=group),
+                            columns=self.feature_columns)
+
+def get_group_codes(groups, num_rows):
+    '''
+    Convert each group's labels to integer codes. Every loan is also put in a group named 'all'.
+
+    Returns:
+        tuple: Returns a dictionary of codes for each group and a dictionary of the labels of each group.
+
+    Raises:
+        ValueError: If a group has a missing label, which would otherwise get code -1 and be summed into the last label.
+    '''
+    codes = {'all': np.zeros(num_rows, dtype='int64')}
+    labels = {'all': np.array(['all'])}
+    for name, values in groups.items():
+        values = pd.Series(values).reset_index(drop=True)
+        if values.isna().any():
+            raise ValueError(f'Group {name} has {values.isna().sum()} missing labels. Fill or drop them first.')
+        group_codes, group_labels = pd.factorize(values, sort=True)
+        codes[name] = group_codes.astype('int64')
+        labels[name] = np.asarray(group_labels)
+    return codes, labels
+
+def compute_shap_values(fit_model, X, groups=None, chunk_size=10000, processes=None, cache_directory=SHAP_DIRECTORY):
+    '''
+    Compute the SHAP values of every loan, or read them from the cache if this model has already explained these loans.
+
+    Args:
+        fit_model (varies): A trained tree model, for example an XGBRegressor.
+        X (dataframe): Dataframe of features to explain, for example X_test.
+        groups (dict or None): Dictionary where the key is a group name and the value is an array or series of labels
+            with one label per loan, for example {'grade': get_grade_labels(X_test), 'issue_month': issue_dates}. The
+            mean SHAP values of each label are saved with the values.
+        chunk_size (int): Number of rows each task explains.
+        processes (int or None): Number of worker processes. None uses every CPU, 1 runs in this process.
+        cache_directory (string): Folder to store the values and aggregates in.
+
+    Returns:
+        ShapResults: The memory mapped SHAP values and their aggregates.
+    '''
+    global shap_model, shap_features, shap_group_codes
+    groups = {} if groups is None else groups
+    feature_columns = [str(col) for col in X.columns]
+    features = np.ascontiguousarray(X, dtype='float32')
+    key = get_shap_key(fit_model, features, feature_columns)
+    # The groups change the aggregates but not the values, so they get their own file.
+    group_hash = hashlib.sha256()
+    for name in sorted(groups):
+        group_hash.update(name.encode())
+        group_hash.update(pd.util.hash_pandas_object(pd.Series(np.asarray(groups[name])), index=False).to_numpy())
+    group_key = group_hash.hexdigest()[:8]
+    values_path = os.path.join(cache_directory, f'{key}.npy')
+    aggregates_path = os.path.join(cache_directory, f'{key}-{group_key}.npz')
+    if os.path.exists(values_path) and os.path.exists(aggregates_path):
+        return ShapResults(values_path, aggregates_path)
+
+    os.makedirs(cache_directory, exist_ok=True)
+    shap_model = fit_model
+    shap_features = features
+    shap_group_codes, group_labels = get_group_codes(groups, len(features))
+    group_sizes = {name: len(labels) for name, labels in group_labels.items()}
+
+    starts = range(0, len(features), chunk_size)
+    if os.path.exists(values_path):
+        # The values are cached but these groups are new, so only the sums are computed, reading the cached values.
+        values = np.load(values_path, mmap_mode='r')
+        chunk_sums = [sum_chunk_by_group(values[start:start + chunk_size], start, start + chunk_size, group_sizes)
+                      for start in starts]
+        del values
+    else:
+        # Write to a temporary file first so a half written file is never read as a cache hit.
+        temp_path = values_path[:-len('.npy')] + '.tmp.npy'
+        np.lib.format.open_memmap(temp_path, mode='w+', dtype='float32', shape=(len(features), len(feature_columns) + 1))
+        processes, n_threads = get_cpu_budget(len(starts), processes=processes)
+        tasks = [(temp_path, start, min(start + chunk_size, len(features)), n_threads, group_sizes) for start in starts]
+        if processes == 1:
+            chunk_sums = [explain_chunk(task) for task in tasks]
+        else:
+            with mp.get_context('fork').Pool(processes=processes) as pool:
+                chunk_sums = pool.map(explain_chunk, tasks, chunksize=1)
+        os.replace(temp_path, values_path)
+
+    aggregates = {'feature_columns': np.array(feature_columns)}
+    for name in shap_group_codes:
+        aggregates[f'{name}_abs'] = sum(sums[name][0] for sums in chunk_sums)
+        aggregates[f'{name}_signed'] = sum(sums[name][1] for sums in chunk_sums)
+        aggregates[f'{name}_counts'] = np.bincount(shap_group_codes[name], minlength=group_sizes[name])
+        aggregates[f'{name}_labels'] = group_labels[name].astype(str)
+    temp_aggregates_path = aggregates_path[:-len('.npz')] + '.tmp.npz'
+    np.savez(temp_aggregates_path, **aggregates)
+    os.replace(temp_aggregates_path, aggregates_path)
+    return ShapResults(values_path, aggregates_path)
+
+if __name__ == '__main__':
+    X_test = pd.read_pickle('data/X_test.pkl.bz2', compression='bz2')
+    loans = pd.read_pickle('data/df_EDA.pkl.bz2', compression='bz2')
+    with open('data/model_xgb.pickle', 'rb') as f:
+        fit_model = pickle.load(f)
+    issue_months = loans.loc[X_test.index, 'issue_d'].dt.strftime('%Y-%m')
+    results = compute_shap_values(fit_model, X_test, {'grade': get_grade_labels(X_test), 'issue_month': issue_months})
+    print(results.get_mean_abs_shap().head(20))
+    print(results.get_mean_abs_shap_by('grade').T.head(20))
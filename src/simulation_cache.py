@@ -0,0 +1,150 @@
+'''
+This file contains a persistent cache for the results of simulate_loan_investment_portfolio. Re-running the simulation
+notebook recomputes every strategy even when the predictions and parameters haven't changed. Cached results are keyed by
+a fingerprint of the inputs and stored as small .npz files holding the dates, balances and ROI.
+
+The version of the simulator code is part of every cache key, so results are never reused after portfolio.py or any of
+the modules that decide what it buys and how results are computed changes.
+Entries from older versions of the code are deleted the next time a result is written to the cache.
+'''
+
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from src import portfolio
+
+# The modules whose code affects simulation results. They're hashed from their files, so payment_stream, which imports
+# boto3 through payments, doesn't have to be imported.
+SIMULATOR_MODULES = ('portfolio.py', 'allocation.py', 'portfolio_metrics.py', 'payment_stream.py')
+
+CACHE_DIRECTORY = 'data/simulation_cache'
+
+def get_simulator_code_version():
+    '''
+    Get a fingerprint of the simulator code. Any change to one of the SIMULATOR_MODULES produces a new version.
+
+    Returns:
+        string: Returns the first 16 characters of the SHA-256 hash of the SIMULATOR_MODULES.
+    '''
+    h = hashlib.sha256()
+    src_directory = os.path.dirname(portfolio.__file__)
+    for filename in SIMULATOR_MODULES:
+        h.update(filename.encode())
+        with open(os.path.join(src_directory, filename), 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()[:16]
+
+def hash_dataframe(df):
+    '''
+    Get a fingerprint of a dataframe's index, column names and values.
+
+    Args:
+        df (dataframe): The dataframe to hash, for example the predictions from modeling.create_dataframe_for_simulation.
+
+    Returns:
+        string: Returns the SHA-256 hash of the dataframe.
+    '''
+    h = hashlib.sha256()
+    h.update(json.dumps([str(col) for col in df.columns]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+def get_cache_key(predictions_hash, payments_version, start_date, end_date, starting_balance, investment_per_loan, min_roi):
+    '''
+    Combine everything that affects a simulation's result into one key.
+
+    Returns:
+        string: Returns the SHA-256 hash of the simulation inputs.
+    '''
+    inputs = {'predictions': predictions_hash, 'payments': payments_version, 'start_date': str(start_date),
+              'end_date': str(end_date), 'starting_balance': float(starting_balance),
+              'investment_per_loan': float(investment_per_loan), 'min_roi': float(min_roi)}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def remove_stale_entries(cache_directory, code_version, max_entries):
+    '''
+    Delete cached results from older versions of the simulator code, then delete the least recently used results until
+    at most max_entries are left.
+
+    Args:
+        cache_directory (string): Folder containing the cached results.
+        code_version (string): The current simulator code version from get_simulator_code_version.
+        max_entries (int): Maximum number of results to keep.
+    '''
+    entries = []
+    for filename in os.listdir(cache_directory):
+        # Temporary files belong to results that are still being written.
+        if not filename.endswith('.npz') or filename.endswith('.tmp.npz'):
+            continue
+        path = os.path.join(cache_directory, filename)
+        if not filename.startswith(code_version):
+            os.remove(path)
+        else:
+            entries.append((os.path.getmtime(path), path))
+    entries.sort()
+    for _, path in entries[:max(len(entries) - max_entries, 0)]:
+        os.remove(path)
+
+def clear_simulation_cache(cache_directory=CACHE_DIRECTORY):
+    '''
+    Delete every cached simulation result.
+
+    Args:
+        cache_directory (string): Folder containing the cached results.
+    '''
+    if not os.path.isdir(cache_directory):
+        return
+    for filename in os.listdir(cache_directory):
+        if filename.endswith('.npz'):
+            os.remove(os.path.join(cache_directory, filename))
+
+def cached_simulate_loan_investment_portfolio(all_payments, model_predictions, start_date, end_date, starting_balance,
+                                              investment_per_loan, min_roi, payments_version=None,
+                                              cache_directory=CACHE_DIRECTORY, max_entries=500):
+    '''
+    Same as portfolio.simulate_loan_investment_portfolio, except results are read from the cache when the same
+    simulation has already been run.
+
+    Args:
+        all_payments (dataframe): Payments for the testing loans with a multi-level index of payment date and loan ID.
+        model_predictions (dataframe): The dataframe created by modeling.create_dataframe_for_simulation.
+        start_date (datetime.date): The first month of the simulation.
+        end_date (datetime.date): The simulation stops before this month.
+        starting_balance (float): Starting cash balance of the portfolio.
+        investment_per_loan (float): Amount to invest in each loan.
+        min_roi (float): Minimum predicted ROI a loan needs for us to buy it.
+        payments_version (string or None): Name of the payments artifact, for example 'df_payments_testing_loans_201904'.
+            Change it whenever the payments data changes. If None the payments dataframe is hashed, which is slower for
+            the full payments history but always correct.
+        cache_directory (string): Folder to store cached results in.
+        max_entries (int): Maximum number of results to keep. The least recently used results are deleted first.
+
+    Returns:
+        tuple: Returns the dates, balances and annualized ROI of the simulated portfolio.
+    '''
+    if payments_version is None:
+        payments_version = hash_dataframe(all_payments)
+    code_version = get_simulator_code_version()
+    key = get_cache_key(hash_dataframe(model_predictions), payments_version, start_date, end_date, starting_balance,
+                        investment_per_loan, min_roi)
+    path = os.path.join(cache_directory, f'{code_version}-{key}.npz')
+
+    if os.path.exists(path):
+        # Touch the file so eviction knows it was used recently.
+        os.utime(path)
+        with np.load(path) as cached:
+            dates = list(cached['dates'].astype(object))
+            return dates, cached['balances'].tolist(), float(cached['roi'])
+
+    dates, balances, roi = portfolio.simulate_loan_investment_portfolio(all_payments, model_predictions, start_date, end_date,
+                                                                        starting_balance, investment_per_loan, min_roi)
+    os.makedirs(cache_directory, exist_ok=True)
+    # Write to a temporary file first so a half written file is never read as a cache hit.
+    temp_path = path[:-len('.npz')] + '.tmp.npz'
+    np.savez(temp_path, dates=np.array(dates, dtype='datetime64[D]'), balances=np.array(balances, dtype='float64'),
+             roi=np.float64(roi))
+    os.replace(temp_path, path)
+    remove_stale_entries(cache_directory, code_version, max_entries)
+    return dates, balances, roi
@@ -0,0 +1,90 @@
+'''
+This file contains functions for running the portfolio simulation over a grid of parameters. It's used to find the
+starting balance, investment per loan, and minimum ROI that offer the best returns for a model over the testing data.
+'''
+
+import itertools
+import multiprocessing as mp
+import pandas as pd
+from src.portfolio import (ArrayPortfolio, bucket_loans_by_month, bucket_payments_by_month, filter_payments_for_simulation,
+                           run_portfolio_simulation)
+
+# These are set by run_parameter_sweep before the process pool is created. The worker processes are forked, so they
+# inherit the preprocessed payments and predictions without them being pickled and copied to every worker.
+sweep_predictions = None
+sweep_monthly_payments = None
+
+def get_parameter_grid(starting_balances, investments_per_loan, min_rois):
+    '''
+    Create every combination of the parameters we want to simulate.
+
+    Args:
+        starting_balances (list or tuple of floats): Starting portfolio balances to simulate.
+        investments_per_loan (list or tuple of floats): Amounts to invest in each loan.
+        min_rois (list or tuple of floats): Minimum predicted ROI a loan needs for us to buy it.
+
+    Returns:
+        list: List of (starting_balance, investment_per_loan, min_roi) tuples.
+    '''
+    return list(itertools.product(starting_balances, investments_per_loan, min_rois))
+
+def simulate_parameters(params):
+    '''
+    Run one simulation of the sweep. This is the function mapped over the process pool, so it reads the predictions
+    and payments from the module level variables set up by run_parameter_sweep.
+
+    Args:
+        params (tuple): Tuple of (starting_balance, investment_per_loan, min_roi, start_date, end_date).
+
+    Returns:
+        tuple: Returns the dates, balances and annualized ROI of the simulated portfolio.
+    '''
+    starting_balance, investment_per_loan, min_roi, start_date, end_date = params
+    portfolio = ArrayPortfolio(starting_balance, investment_per_loan, start_date, sweep_predictions, sweep_monthly_payments,
+                               min_roi)
+    return run_portfolio_simulation(portfolio, end_date)
+
+def run_parameter_sweep(all_payments, model_predictions, start_date, end_date, starting_balances, investments_per_loan, min_rois,
+                        processes=None):
+    '''
+    Simulate the portfolio for every combination of starting balance, investment per loan and minimum ROI.
+
+    The payments are filtered and bucketed by month only once, using the smallest minimum ROI in the grid. Every other
+    minimum ROI selects a subset of those loans, and the simulation ignores payments from loans it doesn't own, so the
+    same payments can be reused for all of them.
+
+    Args:
+        all_payments (dataframe): Payments for the testing loans with a multi-level index of payment date and loan ID.
+        model_predictions (dataframe): The dataframe created by modeling.create_dataframe_for_simulation.
+        start_date (datetime.date): The first month of the simulation.
+        end_date (datetime.date): The simulation stops before this month.
+        starting_balances (list or tuple of floats): Starting portfolio balances to simulate.
+        investments_per_loan (list or tuple of floats): Amounts to invest in each loan.
+        min_rois (list or tuple of floats): Minimum predicted ROI a loan needs for us to buy it.
+        processes (int or None): Number of worker processes. None uses every CPU, 1 runs the sweep in this process.
+
+    Returns:
+        DataFrame: Returns a tidy dataframe with one row per simulated month of every parameter combination. Columns are
+        starting_balance, investment_per_loan, min_roi, date, balance and roi, where roi is the annualized ROI of that
+        combination's whole simulation.
+    '''
+    global sweep_predictions, sweep_monthly_payments
+    payments_filtered = filter_payments_for_simulation(all_payments, model_predictions, min(min_rois))
+    sweep_predictions = bucket_loans_by_month(model_predictions)
+    sweep_monthly_payments = bucket_payments_by_month(payments_filtered, sweep_predictions.ids)
+
+    grid = get_parameter_grid(starting_balances, investments_per_loan, min_rois)
+    tasks = [(starting_balance, investment_per_loan, min_roi, start_date, end_date)
+             for starting_balance, investment_per_loan, min_roi in grid]
+    if processes == 1:
+        results = [simulate_parameters(task) for task in tasks]
+    else:
+        with mp.get_context('fork').Pool(processes=processes) as pool:
+            results = pool.map(simulate_parameters, tasks)
+
+    rows = []
+    for (starting_balance, investment_per_loan, min_roi), (dates, balances, roi) in zip(grid, results):
+        for date, balance in zip(dates, balances):
+            rows.append({'starting_balance': starting_balance, 'investment_per_loan': investment_per_loan,
+                         'min_roi': min_roi, 'date': date, 'balance': balance, 'roi': roi})
+    return pd.DataFrame(rows)
@@ -0,0 +1,409 @@
+'''
+This file contains a generator of synthetic data shaped like Lending Club's, so the pipeline can be run and benchmarked
+without downloading the real files. It writes:
+    LoanStats_securev1_<year>Q<quarter>.csv   One file of loans per issue quarter with every column in columns.all_cols,
+                                              a line of notes above the header and 2 lines of totals at the end, and
+                                              the same formats as the real files: ' 36 months', '16.37%', '< 1 year',
+                                              'n/a' and 'Sep-2015'.
+    PMTHIST_INVESTOR_<yyyymm>.csv             The monthly payment history of every loan up to the as of date, with
+                                              dates like 'SEP2015'.
+    inflation_expectations.csv, MORTGAGE30US.csv and MPRIME.csv
+                                              Monthly rates in the format downloaded from FRED, covering every issue month.
+                                              feature_engineering reads these from data/, so they're written there, but
+                                              only if they don't exist yet so real downloaded rates are never replaced.
+
+The loans and payments are written to data/synthetic by default, so they're loaded by passing names like
+'synthetic/LoanStats_securev1_2016Q1.csv' to data_cleaning.load_loan_data_from_local_machine.
+
+Each loan is amortized at its interest rate. Every month a loan can default, with a chance that grows with its grade,
+pay off early, or pay extra principal, and charged off loans sometimes have a recovery payment months later. The
+loan_status, total_pymnt, last_pymnt_d and other payment columns of the loan files agree with the payment history.
+
+Loans are generated and written batch_size at a time, so memory use doesn't grow with the number of loans, and each
+batch has its own random generator seeded from the seed and batch number. The same arguments always produce the same
+files.
+'''
+
+import os
+import numpy as np
+import pandas as pd
+from src.columns import all_cols
+
+MONTHS = np.array(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])
+GRADES = np.array(['A', 'B', 'C', 'D', 'E', 'F', 'G'])
+GRADE_PROBABILITIES = np.array([0.18, 0.29, 0.28, 0.15, 0.07, 0.02, 0.01])
+# Interest rate of sub-grade 1 of each grade, the extra rate per sub-grade, and the yearly chance of default.
+GRADE_BASE_RATES = np.array([6.0, 9.5, 13.0, 17.0, 20.5, 24.5, 28.0])
+SUB_GRADE_RATE_STEP = 0.6
+GRADE_DEFAULT_RATES = np.array([0.02, 0.04, 0.065, 0.09, 0.12, 0.15, 0.18])
+# Monthly chances that a loan is paid off early or gets an extra principal payment.
+PREPAYMENT_RATE = 0.012
+EXTRA_PAYMENT_RATE = 0.02
+# A defaulted loan is charged off this many months after its last payment.
+CHARGE_OFF_MONTHS = 5
+
+EMPLOYMENT_LENGTHS = np.array(['< 1 year', '1 year', '2 years', '3 years', '4 years', '5 years', '6 years', '7 years',
+                               '8 years', '9 years', '10+ years', 'n/a'])
+HOME_OWNERSHIP = np.array(['MORTGAGE', 'RENT', 'OWN', 'ANY'])
+VERIFICATION_STATUSES = np.array(['Not Verified', 'Source Verified', 'Verified'])
+PURPOSES = np.array(['debt_consolidation', 'credit_card', 'other', 'home_improvement', 'major_purchase',
+                     'small_business', 'medical', 'car', 'vacation', 'moving', 'wedding', 'house', 'renewable_energy'])
+PURPOSE_PROBABILITIES = np.array([0.57, 0.22, 0.06, 0.065, 0.022, 0.012, 0.011, 0.01, 0.007, 0.007, 0.003, 0.004,
+                                  0.0007])
+STATES = np.array(['AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DC', 'DE', 'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS',
+                   'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC',
+                   'ND', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY'])
+JOB_TITLES = np.array(['Teacher', 'Manager', 'Registered Nurse', 'Owner', 'Supervisor', 'Sales', 'Driver', 'Engineer',
+                       'Project Manager', 'Office Manager', 'Director', 'Accountant', 'Technician', 'Analyst'])
+
+PAYMENT_COLUMNS = ('LOAN_ID', 'PBAL_BEG_PERIOD_INVESTORS', 'PRNCP_PAID_INVESTORS', 'INT_PAID_INVESTORS',
+                   'FEE_PAID_INVESTORS', 'DUE_AMT', 'RECEIVED_AMT_INVESTORS', 'RECEIVED_D', 'PERIOD_END_LSTAT', 'MONTH',
+                   'PBAL_END_PERIOD_INVESTORS', 'MOB', 'IssuedDate', 'InterestRate', 'term', 'grade')
+
+def get_month_ordinal(date):
+    date = pd.Timestamp(date)
+    return 12 * date.year + date.month - 1
+
+def format_loan_dates(months):
+    '''
+    Format month ordinals the way the loan files write dates, for example 'Sep-2015'.
+    '''
+    months = np.asarray(months, dtype='int64')
+    return np.char.add(np.char.add(MONTHS[months % 12], '-'), (months // 12).astype(str))
+
+def format_payment_dates(months):
+    '''
+    Format month ordinals the way the payment history writes dates, for example 'SEP2015'.
+    '''
+    months = np.asarray(months, dtype='int64')
+    return np.char.add(np.char.upper(MONTHS[months % 12]), (months // 12).astype(str))
+
+def get_monthly_payment(principal, monthly_rate, term):
+    return principal * monthly_rate / (1 - (1 + monthly_rate) ** -term)
+
+def generate_loan_terms(rng, num_loans):
+    '''
+    Draw the grade, interest rate, term and amount of each loan.
+
+    Returns:
+        dict: Dictionary of arrays with one value per loan.
+    '''
+    grades = rng.choice(len(GRADES), num_loans, p=GRADE_PROBABILITIES)
+    sub_grades = rng.integers(1, 6, num_loans)
+    int_rates = np.round(GRADE_BASE_RATES[grades] + SUB_GRADE_RATE_STEP * (sub_grades - 1) +
+                         rng.normal(0, 0.25, num_loans), 2).clip(5.31, 30.99)
+    terms = np.where(rng.random(num_loans) < 0.75, 36, 60)
+    loan_amounts = (np.round(rng.lognormal(9.45, 0.6, num_loans) / 25) * 25).clip(1000, 40000)
+    # Most loans are fully funded by investors, a few are funded a little short.
+    funded_inv = np.where(rng.random(num_loans) < 0.97, loan_amounts,
+                          np.round(loan_amounts * rng.uniform(0.9, 1, num_loans), 2))
+    installments = np.round(get_monthly_payment(loan_amounts, int_rates / 1200, terms), 2)
+    return {'grades': grades, 'sub_grades': sub_grades, 'int_rates': int_rates, 'terms': terms,
+            'loan_amounts': loan_amounts, 'funded_inv': funded_inv, 'installments': installments}
+
+def simulate_payment_histories(rng, loan_ids, issue_months, terms, as_of_month):
+    '''
+    Simulate the monthly payments of each loan up to the month before as_of_month.
+
+    Args:
+        rng (Generator): Random number generator for this batch.
+        loan_ids (array of ints): ID of each loan.
+        issue_months (array of ints): Month ordinal each loan was issued.
+        terms (dict): Dictionary from generate_loan_terms.
+        as_of_month (int): Month ordinal the data is as of. Payments are only made before it.
+
+    Returns:
+        tuple: Returns a dataframe of payments in the PMTHIST format sorted by loan and month, and a dictionary of
+        arrays with the status, totals and last payment of each loan.
+    '''
+    num_loans = len(loan_ids)
+    monthly_rates = terms['int_rates'] / 1200
+    investor_shares = terms['funded_inv'] / terms['loan_amounts']
+    monthly_default_rates = 1 - (1 - GRADE_DEFAULT_RATES[terms['grades']]) ** (1 / 12)
+    observed_months = as_of_month - issue_months - 1
+
+    balances = terms['loan_amounts'].astype('float64')
+    active = np.ones(num_loans, dtype=bool)
+    default_months = np.zeros(num_loans, dtype='int64')
+    total_principal = np.zeros(num_loans)
+    total_interest = np.zeros(num_loans)
+    last_payment_months = np.full(num_loans, -1, dtype='int64')
+    last_payment_amounts = np.zeros(num_loans)
+
+    batches = []
+    for month in range(1, terms['terms'].max() + 1):
+        observed = active & (month <= observed_months)
+        defaults = observed & (rng.random(num_loans) < monthly_default_rates)
+        default_months[defaults] = month
+        active &= ~defaults
+        paying = observed & ~defaults
+        if not paying.any():
+            if not active.any():
+                break
+            continue
+
+        interest = balances * monthly_rates
+        scheduled = np.minimum(terms['installments'], balances + interest)
+        paid_off = paying & ((rng.random(num_loans) < PREPAYMENT_RATE) | (month == terms['terms']))
+        extra = np.where(rng.random(num_loans) < EXTRA_PAYMENT_RATE, rng.uniform(0, 0.3, num_loans) * balances, 0)
+        payments = np.where(paid_off, balances + interest, np.minimum(scheduled + extra, balances + interest))
+        principal = np.minimum(payments - interest, balances)
+        rows = np.flatnonzero(paying)
+        new_balances = np.where(paid_off, 0, np.maximum(balances - principal, 0))
+        new_balances[new_balances < 0.01] = 0
+
+        share = investor_shares[rows]
+        batches.append(pd.DataFrame({
+            'LOAN_ID': loan_ids[rows], 'PBAL_BEG_PERIOD_INVESTORS': np.round(balances[rows] * share, 2),
+            'PRNCP_PAID_INVESTORS': np.round(principal[rows] * share, 2),
+            'INT_PAID_INVESTORS': np.round(interest[rows] * share, 2), 'FEE_PAID_INVESTORS': 0.0,
+            'DUE_AMT': np.round(terms['installments'][rows] * share, 2),
+            'RECEIVED_AMT_INVESTORS': np.round(payments[rows] * share, 2), 'RECEIVED_MONTH': issue_months[rows] + month,
+            'PERIOD_END_LSTAT': np.where(new_balances[rows] == 0, 'Fully Paid', 'Current'),
+            'PBAL_END_PERIOD_INVESTORS': np.round(new_balances[rows] * share, 2), 'MOB': month}))
+
+        total_principal[rows] += principal[rows]
+        total_interest[rows] += interest[rows]
+        last_payment_months[rows] = issue_months[rows] + month
+        last_payment_amounts[rows] = payments[rows]
+        balances[rows] = new_balances[rows]
+        active &= balances > 0
+
+    # Some charged off loans pay back part of their balance months after they're charged off.
+    defaulted = default_months > 0
+    charged_off = defaulted & (default_months + CHARGE_OFF_MONTHS <= observed_months)
+    recovery_months = default_months + CHARGE_OFF_MONTHS + rng.integers(1, 12, num_loans)
+    has_recovery = charged_off & (recovery_months <= observed_months) & (rng.random(num_loans) < 0.4)
+    recoveries = np.where(has_recovery, np.round(balances * rng.uniform(0.02, 0.2, num_loans), 2), 0)
+    rows = np.flatnonzero(has_recovery)
+    if len(rows) > 0:
+        batches.append(pd.DataFrame({
+            'LOAN_ID': loan_ids[rows], 'PBAL_BEG_PERIOD_INVESTORS': 0.0, 'PRNCP_PAID_INVESTORS': 0.0,
+            'INT_PAID_INVESTORS': 0.0, 'FEE_PAID_INVESTORS': 0.0, 'DUE_AMT': 0.0,
+            'RECEIVED_AMT_INVESTORS': np.round(recoveries[rows] * investor_shares[rows], 2),
+            'RECEIVED_MONTH': issue_months[rows] + recovery_months[rows], 'PERIOD_END_LSTAT': 'Charged Off',
+            'PBAL_END_PERIOD_INVESTORS': 0.0, 'MOB': recovery_months[rows]}))
+
+    if batches:
+        payments_df = pd.concat(batches, ignore_index=True)
+    else:
+        payments_df = pd.DataFrame(columns=['LOAN_ID', 'RECEIVED_MONTH', 'MOB'])
+    payments_df = payments_df.sort_values(['LOAN_ID', 'MOB'], kind='stable')
+    positions = np.searchsorted(loan_ids, payments_df['LOAN_ID'].to_numpy())
+    payments_df['RECEIVED_D'] = format_payment_dates(payments_df['RECEIVED_MONTH'])
+    payments_df['MONTH'] = payments_df['RECEIVED_D']
+    payments_df['IssuedDate'] = format_payment_dates(issue_months[positions])
+    payments_df['InterestRate'] = terms['int_rates'][positions] / 100
+    payments_df['term'] = terms['terms'][positions]
+    payments_df['grade'] = GRADES[terms['grades'][positions]]
+    payments_df = payments_df[list(PAYMENT_COLUMNS)]
+
+    statuses = np.where(balances == 0, 'Fully Paid', 'Current')
+    statuses = np.where(defaulted & ~charged_off, 'Late (31-120 days)', statuses)
+    statuses = np.where(charged_off, 'Charged Off', statuses)
+    summary = {'statuses': statuses, 'balances': np.where(charged_off, 0, balances),
+               'total_principal': total_principal, 'total_interest': total_interest, 'recoveries': recoveries,
+               'last_payment_months': last_payment_months, 'last_payment_amounts': last_payment_amounts}
+    return payments_df, summary
+
+def get_credit_history_value(rng, col, num_loans):
+    '''
+    Draw plausible values for one of the many credit history columns, based on what kind of value its name says it
+    holds. About 5% of the values are missing.
+    '''
+    if col.startswith(('mths_since', 'mo_sin')):
+        values = np.round(rng.exponential(40, num_loans))
+        missing_share = 0.5 if 'delinq' in col or 'derog' in col or 'record' in col else 0.05
+    elif col.endswith(('util', '_75')) or col.startswith('pct_'):
+        values = np.round(rng.uniform(0, 100, num_loans), 1)
+        missing_share = 0.05
+    elif col.startswith(('tot_', 'total_', 'avg_', 'max_bal', 'bc_open')) or col.endswith('_lim'):
+        values = np.round(rng.lognormal(10, 1, num_loans))
+        missing_share = 0.05
+    else:
+        values = rng.poisson(2.5, num_loans).astype('float64')
+        missing_share = 0.05
+    values[rng.random(num_loans) < missing_share] = np.nan
+    return values
+
+def generate_loan_stats_rows(rng, loan_ids, issue_months, as_of_month):
+    '''
+    Generate one batch of loans and their payment histories.
+
+    Returns:
+        tuple: Returns a dataframe of loans with the columns in columns.all_cols, formatted like the loan files, and a
+        dataframe of their payments in the PMTHIST format.
+    '''
+    num_loans = len(loan_ids)
+    terms = generate_loan_terms(rng, num_loans)
+    payments_df, summary = simulate_payment_histories(rng, loan_ids, issue_months, terms, as_of_month)
+    investor_shares = terms['funded_inv'] / terms['loan_amounts']
+    grades = GRADES[terms['grades']]
+    joint = rng.random(num_loans) < 0.05
+    annual_inc = np.round(rng.lognormal(11.1, 0.5, num_loans), -2)
+    fico_low = (np.round(rng.normal(700, 30, num_loans) / 5) * 5).clip(660, 845)
+    purposes = rng.choice(PURPOSES, num_loans, p=PURPOSE_PROBABILITIES / PURPOSE_PROBABILITIES.sum())
+    has_payment = summary['last_payment_months'] >= 0
+    total_paid = summary['total_principal'] + summary['total_interest'] + summary['recoveries']
+    current = np.isin(summary['statuses'], ('Current', 'Late (31-120 days)'))
+    # The oldest files write interest rates with a leading space.
+    rate_format = np.where(issue_months < 12 * 2012, ' ', '')
+
+    data = {
+        'id': loan_ids, 'member_id': np.nan, 'loan_amnt': terms['loan_amounts'], 'funded_amnt': terms['loan_amounts'],
+        'funded_amnt_inv': terms['funded_inv'], 'term': np.char.add(np.char.add(' ', terms['terms'].astype(str)), ' months'),
+        'int_rate': np.char.add(np.char.add(rate_format, np.char.mod('%.2f', terms['int_rates'])), '%'),
+        'installment': terms['installments'], 'grade': grades,
+        'sub_grade': np.char.add(grades, terms['sub_grades'].astype(str)),
+        'emp_title': np.where(rng.random(num_loans) < 0.07, None, rng.choice(JOB_TITLES, num_loans)),
+        'emp_length': rng.choice(EMPLOYMENT_LENGTHS, num_loans), 'home_ownership': rng.choice(HOME_OWNERSHIP, num_loans,
+                                                                                                p=[0.49, 0.4, 0.1, 0.01]),
+        'annual_inc': annual_inc, 'verification_status': rng.choice(VERIFICATION_STATUSES, num_loans),
+        'issue_d': format_loan_dates(issue_months), 'loan_status': summary['statuses'], 'pymnt_plan': 'n',
+        'url': np.char.add('https://lendingclub.com/browse/loanDetail.action?loan_id=', loan_ids.astype(str)),
+        'desc': None, 'purpose': purposes, 'title': np.char.title(np.char.replace(purposes, '_', ' ')),
+        'zip_code': np.char.add(rng.integers(10, 1000, num_loans).astype(str), 'xx'),
+        'addr_state': rng.choice(STATES, num_loans), 'dti': np.round(rng.gamma(4, 4.5, num_loans), 2),
+        'delinq_2yrs': rng.poisson(0.3, num_loans),
+        'earliest_cr_line': format_loan_dates(issue_months - 12 * rng.integers(3, 40, num_loans) -
+                                              rng.integers(0, 12, num_loans)),
+        'fico_range_low': fico_low, 'fico_range_high': fico_low + 4, 'inq_last_6mths': rng.poisson(0.7, num_loans),
+        'open_acc': rng.poisson(11, num_loans), 'pub_rec': rng.poisson(0.2, num_loans),
+        'revol_bal': np.round(rng.lognormal(9.3, 1, num_loans)),
+        'revol_util': np.char.add(np.char.mod('%.1f', np.round(rng.uniform(0, 100, num_loans), 1)), '%'),
+        'total_acc': rng.poisson(24, num_loans), 'initial_list_status': rng.choice(np.array(['w', 'f']), num_loans),
+        'out_prncp': np.round(np.where(current, summary['balances'], 0), 2),
+        'out_prncp_inv': np.round(np.where(current, summary['balances'] * investor_shares, 0), 2),
+        'total_pymnt': np.round(total_paid, 2), 'total_pymnt_inv': np.round(total_paid * investor_shares, 2),
+        'total_rec_prncp': np.round(summary['total_principal'], 2), 'total_rec_int': np.round(summary['total_interest'], 2),
+        'total_rec_late_fee': 0.0, 'recoveries': summary['recoveries'],
+        'collection_recovery_fee': np.round(summary['recoveries'] * 0.18, 2),
+        'last_pymnt_d': np.where(has_payment, format_loan_dates(summary['last_payment_months']), None),
+        'last_pymnt_amnt': np.round(summary['last_payment_amounts'], 2),
+        'next_pymnt_d': np.where(summary['statuses'] == 'Current', format_loan_dates(np.full(num_loans, as_of_month)),
+                                 None),
+        'last_credit_pull_d': format_loan_dates(np.full(num_loans, as_of_month - 1)),
+        'last_fico_range_high': fico_low + 4, 'last_fico_range_low': fico_low,
+        'collections_12_mths_ex_med': rng.poisson(0.02, num_loans), 'policy_code': 1,
+        'application_type': np.where(joint, 'Joint App', 'Individual'),
+        'annual_inc_joint': np.where(joint, annual_inc * 1.8, np.nan),
+        'dti_joint': np.where(joint, np.round(rng.gamma(4, 4, num_loans), 2), np.nan),
+        'verification_status_joint': np.where(joint, rng.choice(VERIFICATION_STATUSES, num_loans), None),
+        'acc_now_delinq': rng.poisson(0.005, num_loans), 'chargeoff_within_12_mths': rng.poisson(0.01, num_loans),
+        'delinq_amnt': 0.0, 'pub_rec_bankruptcies': rng.poisson(0.13, num_loans),
+        'tax_liens': rng.poisson(0.05, num_loans), 'hardship_flag': 'N', 'debt_settlement_flag': 'N',
+    }
+    for col in all_cols:
+        if col in data:
+            continue
+        if col.startswith('sec_app_') or col == 'revol_bal_joint':
+            data[col] = np.where(joint, get_credit_history_value(rng, col, num_loans), np.nan)
+        elif col.startswith(('hardship_', 'settlement_', 'debt_settlement', 'deferral', 'payment_plan', 'orig_projected')):
+            data[col] = None
+        else:
+            data[col] = get_credit_history_value(rng, col, num_loans)
+    loans_df = pd.DataFrame(data, columns=list(all_cols))
+    return loans_df, payments_df
+
+def write_fred_files(directory, first_month, last_month, seed=91):
+    '''
+    Write the 3 monthly interest rate files used by feature_engineering.add_supplemental_rate_data, as random walks
+    around realistic levels. Files that already exist are left alone.
+
+    Args:
+        directory (string): Folder to write the files to.
+        first_month (int): Month ordinal of the first month.
+        last_month (int): Month ordinal of the last month.
+        seed (int): Seed for the random number generator.
+    '''
+    rng = np.random.default_rng([seed, 0])
+    months = np.arange(first_month, last_month + 1)
+    dates = [f'{month // 12}-{month % 12 + 1:02d}-01' for month in months]
+    for filename, column, start, step, low in (('inflation_expectations.csv', 'MICH', 3.0, 0.15, 0.5),
+                                               ('MORTGAGE30US.csv', 'MORTGAGE30US', 4.5, 0.1, 2.5),
+                                               ('MPRIME.csv', 'MPRIME', 3.25, 0.08, 3.25)):
+        values = np.round(np.maximum(start + np.cumsum(rng.normal(0, step, len(months))), low), 2)
+        if os.path.exists(os.path.join(directory, filename)):
+            continue
+        pd.DataFrame({'DATE': dates, column: values}).to_csv(os.path.join(directory, filename), index=False)
+
+def get_loan_stats_filename(month):
+    return f'LoanStats_securev1_{month // 12}Q{month % 12 // 3 + 1}.csv'
+
+def finish_loan_stats_file(path, total_funded):
+    # The real files end with the total amount funded, which pandas reads as 2 rows with no issue_d.
+    with open(path, 'a') as f:
+        f.write('\n\n')
+        f.write(f'Total amount funded in policy code 1: {int(total_funded)}\n')
+        f.write('Total amount funded in policy code 2: 0\n')
+
+def generate_synthetic_data(directory='data/synthetic', num_loans=100000, start_date='2012-01-01',
+                            end_date='2018-12-01', as_of_date='2019-04-01', seed=91, batch_size=20000,
+                            rates_directory='data'):
+    '''
+    Generate synthetic loan files, a payment history and interest rate files.
+
+    Args:
+        directory (string): Folder to write the loan and payment files to.
+        num_loans (int): Number of loans to generate. They're spread evenly over the issue months.
+        start_date (string): First month loans are issued.
+        end_date (string): Last month loans are issued.
+        as_of_date (string): The date the data is as of. Payments are made up to the month before it.
+        seed (int): Seed for the random number generators.
+        batch_size (int): Number of loans generated and written at a time.
+        rates_directory (string): Folder to write the interest rate files to, if they aren't there already.
+
+    Returns:
+        dict: Returns the names of the loan files, the name of the payment history file, and the number of loans and
+        payments written.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    first_month = get_month_ordinal(start_date)
+    last_month = get_month_ordinal(end_date)
+    as_of_month = get_month_ordinal(as_of_date)
+    num_months = last_month - first_month + 1
+    os.makedirs(rates_directory, exist_ok=True)
+    write_fred_files(rates_directory, first_month - 12, as_of_month, seed)
+
+    payments_filename = f'PMTHIST_INVESTOR_{as_of_month // 12}{as_of_month % 12 + 1:02d}.csv'
+    payments_path = os.path.join(directory, payments_filename)
+    with open(payments_path, 'w') as f:
+        f.write(','.join(PAYMENT_COLUMNS) + '\n')
+
+    loan_files = []
+    total_funded = 0
+    num_payments = 0
+    for batch, start in enumerate(range(0, num_loans, batch_size)):
+        rng = np.random.default_rng([seed, 1, batch])
+        positions = np.arange(start, min(start + batch_size, num_loans))
+        issue_months = first_month + positions * num_months // num_loans
+        loan_ids = 1000000 + positions * 7 + rng.integers(0, 7, len(positions))
+        loans_df, payments_df = generate_loan_stats_rows(rng, loan_ids, issue_months, as_of_month)
+
+        # Loans are issued in order, so each quarter's file is finished before the next one is started.
+        filenames = np.array([get_loan_stats_filename(month) for month in issue_months])
+        for filename in pd.unique(filenames):
+            rows = filenames == filename
+            path = os.path.join(directory, filename)
+            if not loan_files or loan_files[-1] != filename:
+                if loan_files:
+                    finish_loan_stats_file(os.path.join(directory, loan_files[-1]), total_funded)
+                loan_files.append(filename)
+                total_funded = 0
+                with open(path, 'w') as f:
+                    f.write('Notes offered by Prospectus (https://www.lendingclub.com/info/prospectus.action)\n')
+                    loans_df.iloc[:0].to_csv(f, index=False)
+            loans_df[rows].to_csv(path, mode='a', header=False, index=False)
+            total_funded += loans_df.loc[rows, 'funded_amnt_inv'].sum()
+        payments_df.to_csv(payments_path, mode='a', header=False, index=False)
+        num_payments += len(payments_df)
+    if loan_files:
+        finish_loan_stats_file(os.path.join(directory, loan_files[-1]), total_funded)
+    return {'loan_files': loan_files, 'payments_file': payments_filename, 'num_loans': num_loans,
+            'num_payments': num_payments}
+
+if __name__ == '__main__':
+    import time
+    start = time.perf_counter()
+    print(generate_synthetic_data(num_loans=1000000))
+    print(f'Generated in {time.perf_counter() - start:.0f}s')
@@ -0,0 +1,146 @@
+'''
+This file contains low overhead instrumentation for the portfolio simulator. A SimulationTracer records how long each
+step of Portfolio.simulate_month takes, along with counts such as the number of active loans and payment rows touched.
+Traces can be exported in the Chrome trace format (open them at chrome://tracing or https://ui.perfetto.dev) or
+summarized as a dataframe.
+
+Portfolios use a disabled tracer by default. A disabled tracer hands back the same do-nothing span every time, so the
+cost of leaving the instrumentation in the simulator is a few function calls per month.
+'''
+
+import json
+import os
+import time
+import tracemalloc
+import pandas as pd
+
+class Span:
+    '''
+    Context manager that times one step of the simulation and adds it to its tracer's events when the step ends.
+    Counters can be added to the span's args while it's open.
+    '''
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if self.tracer.trace_allocations:
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        if self.tracer.trace_allocations:
+            self.args['allocated_bytes'] = tracemalloc.get_traced_memory()[0] - self.start_memory
+        self.tracer.events.append((self.name, self.start, end - self.start, self.args))
+        return False
+
+class NullSpan:
+    '''
+    The span returned by a disabled tracer. It does nothing and accepts any counters written to its args.
+    '''
+    def __init__(self):
+        self.args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.args.clear()
+        return False
+
+NULL_SPAN = NullSpan()
+
+class SimulationTracer:
+    '''
+    Records timed spans of the portfolio simulation. Pass an enabled tracer to simulate_loan_investment_portfolio or to
+    a portfolio to turn instrumentation on.
+
+    Args:
+        enabled (boolean): Whether spans are recorded.
+        trace_allocations (boolean): Whether each span also records the net bytes allocated while it was open. This uses
+            tracemalloc, which slows the simulation down considerably, so it's off by default.
+    '''
+    def __init__(self, enabled=True, trace_allocations=False):
+        self.enabled = enabled
+        self.trace_allocations = enabled and trace_allocations
+        self.events = []
+        self.started_tracemalloc = self.trace_allocations and not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+
+    def stop(self):
+        '''
+        Stop recording spans, and stop tracemalloc if this tracer started it.
+        '''
+        self.enabled = False
+        self.trace_allocations = False
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def get_events_table(self):
+        '''
+        Get every recorded span as a dataframe.
+
+        Returns:
+            DataFrame: Returns a dataframe with one row per span, containing its name, start time and duration in
+            milliseconds, along with one column for each counter recorded in the span's args.
+        '''
+        rows = []
+        for name, start, duration, args in self.events:
+            rows.append({'name': name, 'start_ms': start / 1e6, 'duration_ms': duration / 1e6, **args})
+        return pd.DataFrame(rows)
+
+    def get_monthly_table(self):
+        '''
+        Get one row per simulated month with its wall time, number of active loans, payment rows touched, loans bought
+        and, if allocations were traced, net bytes allocated.
+
+        Returns:
+            DataFrame: Returns a dataframe of the simulate_month spans.
+        '''
+        events = self.get_events_table()
+        if events.empty:
+            return events
+        return events.loc[events['name'] == 'simulate_month', :].drop(columns='name').reset_index(drop=True)
+
+    def get_summary_table(self):
+        '''
+        Summarize the time spent in each step of the simulation.
+
+        Returns:
+            DataFrame: Returns a dataframe indexed by span name with the number of calls, total, mean and maximum time in
+            milliseconds, and the percent of the total simulate_month time spent in each step.
+        '''
+        events = self.get_events_table()
+        if events.empty:
+            return events
+        summary = events.groupby('name')['duration_ms'].agg(['count', 'sum', 'mean', 'max'])
+        summary.columns = ['calls', 'total_ms', 'mean_ms', 'max_ms']
+        if 'simulate_month' in summary.index:
+            summary['pct_of_month'] = 100 * summary['total_ms'] / summary.loc['simulate_month', 'total_ms']
+        return summary.sort_values('total_ms', ascending=False)
+
+    def write_chrome_trace(self, filename):
+        '''
+        Write the recorded spans to a JSON file in the Chrome trace event format.
+
+        Args:
+            filename (string): Path of the JSON file to write.
+        '''
+        pid = os.getpid()
+        trace_events = [{'name': name, 'ph': 'X', 'ts': start / 1e3, 'dur': duration / 1e3, 'pid': pid, 'tid': 0,
+                         'args': args} for name, start, duration, args in self.events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+# Shared by every portfolio that isn't given a tracer.
+disabled_tracer = SimulationTracer(enabled=False)
@@ -0,0 +1,339 @@
+'''
+This file contains a NumPy-only evaluator for the tree ensembles trained in Modeling.ipynb. A trained XGBoost,
+LightGBM, CatBoost or scikit-learn tree model is compiled into flat node arrays:
+    feature        The feature each node splits on.
+    threshold      A row goes to the left child when its feature value is less than the threshold.
+    left           The left child of each node. The right child is always the node after it.
+    default_left   Whether rows missing the feature (NaN) go to the left child.
+    value          The amount each leaf adds to the prediction, with learning rates and averaging already applied.
+    roots          The first node of each tree.
+Every tree is walked at the same time, one level per step, for the depth of the deepest tree. Predictions only need
+NumPy, which is much lighter to import and ship than the libraries the models were trained with, and there's very
+little overhead per call for small batches.
+
+The libraries don't all split the same way. XGBoost sends a row left when value < threshold, but scikit-learn,
+LightGBM and CatBoost send it left when value <= threshold. Those thresholds are converted to the next representable
+number above them, in the precision the library compares features in, so every model can use the same rule.
+
+Only regression models with an identity link (squared error, the default for every model in Modeling.ipynb) are
+supported. Categorical splits are not.
+'''
+
+import json
+import os
+import time
+import numpy as np
+
+# The most (row, tree) pairs walked at once. Larger batches are split into chunks so memory use stays bounded.
+MAX_NODES_PER_CHUNK = 1 << 22
+
+class CompiledTrees:
+    '''
+    A tree ensemble compiled into flat node arrays.
+
+    Args:
+        arrays (dict): Dictionary of the arrays feature, threshold, left, default_left, value and roots.
+        base_score (float): Amount added to every prediction.
+        max_depth (int): Depth of the deepest tree.
+        feature_dtype (string): Precision features are compared in, 'float32' or 'float64'.
+    '''
+    def __init__(self, arrays, base_score, max_depth, feature_dtype='float32'):
+        self.arrays = arrays
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.left = arrays['left']
+        self.default_left = arrays['default_left']
+        self.value = arrays['value']
+        self.roots = arrays['roots']
+        self.base_score = base_score
+        self.max_depth = max_depth
+        self.feature_dtype = feature_dtype
+
+    def predict_chunk(self, features):
+        flat_features = features.ravel()
+        row_offsets = (np.arange(len(features)) * features.shape[1])[:, None]
+        has_missing = np.isnan(flat_features).any()
+        nodes = np.broadcast_to(self.roots, (len(features), len(self.roots)))
+        for _ in range(self.max_depth):
+            values = flat_features[row_offsets + self.feature[nodes]]
+            go_right = ~(values < self.threshold[nodes])
+            if has_missing:
+                go_right = np.where(np.isnan(values), self.default_left[nodes] == 0, go_right)
+            nodes = self.left[nodes] + go_right
+        return self.base_score + self.value[nodes].sum(axis=1)
+
+    def predict(self, X):
+        '''
+        Predict the ROI of loans.
+
+        Args:
+            X (dataframe or array): Features with the same columns, in the same order, the model was trained on.
+
+        Returns:
+            array: Returns one prediction per row.
+        '''
+        features = np.ascontiguousarray(X, dtype=self.feature_dtype)
+        predictions = np.empty(len(features))
+        chunk_size = max(MAX_NODES_PER_CHUNK // max(len(self.roots), 1), 1)
+        for start in range(0, len(features), chunk_size):
+            predictions[start:start + chunk_size] = self.predict_chunk(features[start:start + chunk_size])
+        return predictions
+
+def flatten_trees(trees, feature_dtype='float32'):
+    '''
+    Concatenate trees into one set of node arrays. Each tree's nodes are renumbered level by level so a node's
+    children are always next to each other, and only the left child needs to be stored.
+
+    Args:
+        trees (list of dicts): Each tree's node arrays (feature, threshold, left, right, default_left and value), with
+            children numbered within the tree and -1 as the left child of a leaf.
+        feature_dtype (string): Precision of the thresholds.
+
+    Returns:
+        tuple: Returns the dictionary of arrays and the depth of the deepest tree.
+    '''
+    arrays = {'feature': [], 'threshold': [], 'left': [], 'default_left': [], 'value': []}
+    roots = []
+    max_depth = 0
+    num_nodes = 0
+    for tree in trees:
+        left = np.asarray(tree['left'], dtype='int64')
+        right = np.asarray(tree['right'], dtype='int64')
+        is_leaf = left == -1
+
+        # order is the original node of each new position, and new_left the new position of each node's left child.
+        order = [0]
+        new_left = {}
+        level = [0]
+        depth = 0
+        while True:
+            next_level = []
+            for node in level:
+                if not is_leaf[node]:
+                    new_left[node] = len(order)
+                    order.extend((left[node], right[node]))
+                    next_level.extend((left[node], right[node]))
+            if not next_level:
+                break
+            level = next_level
+            depth += 1
+        max_depth = max(max_depth, depth)
+
+        order = np.array(order)
+        positions = np.arange(len(order))
+        leaves = is_leaf[order]
+        # Leaves compare against NaN, which always sends a row right, and their left child is the node before them.
+        # So a row that reaches a leaf stays there for the rest of the walk.
+        arrays['feature'].append(np.where(leaves, 0, np.asarray(tree['feature'])[order]).astype('int32'))
+        arrays['threshold'].append(np.where(leaves, np.nan, np.asarray(tree['threshold'])[order]).astype(feature_dtype))
+        arrays['left'].append((np.array([new_left.get(node, -1) for node in order]) +
+                               np.where(leaves, positions, 0) + num_nodes).astype('int32'))
+        arrays['default_left'].append(np.where(leaves, 0, np.asarray(tree['default_left'])[order]).astype('uint8'))
+        arrays['value'].append(np.where(leaves, np.asarray(tree['value'])[order], 0).astype('float64'))
+        roots.append(num_nodes)
+        num_nodes += len(order)
+
+    arrays = {name: np.concatenate(values) for name, values in arrays.items()}
+    arrays['roots'] = np.array(roots, dtype='int32')
+    return arrays, max_depth
+
+def convert_less_equal_thresholds(thresholds, dtype):
+    '''
+    Convert thresholds for the rule value <= threshold into thresholds for value < threshold, for values of the given
+    precision.
+
+    Args:
+        thresholds (array of floats): The thresholds of the <= rule.
+        dtype (string): Precision the features are compared in.
+
+    Returns:
+        array: Returns the thresholds for the < rule.
+    '''
+    thresholds = np.asarray(thresholds, dtype='float64')
+    # The largest value of this precision that is <= the threshold, then the next value above it.
+    converted = thresholds.astype(dtype)
+    converted = np.where(converted > thresholds, np.nextafter(converted, np.array(-np.inf, dtype=dtype)), converted)
+    return np.nextafter(converted.astype(dtype), np.array(np.inf, dtype=dtype))
+
+def compile_xgboost(fit_model):
+    booster = fit_model.get_booster() if hasattr(fit_model, 'get_booster') else fit_model
+    learner = json.loads(booster.save_raw('json'))['learner']
+    # Newer versions of XGBoost write the base score as a list, for example '[1.446997E0]'.
+    base_score = float(learner['learner_model_param']['base_score'].strip('[]'))
+    trees = []
+    for tree in learner['gradient_booster']['model']['trees']:
+        # Leaves store their value in split_conditions.
+        trees.append({'feature': tree['split_indices'], 'threshold': tree['split_conditions'],
+                      'left': tree['left_children'], 'right': tree['right_children'],
+                      'default_left': tree['default_left'], 'value': tree['split_conditions']})
+    arrays, max_depth = flatten_trees(trees)
+    return CompiledTrees(arrays, base_score, max_depth)
+
+def compile_lightgbm(fit_model):
+    booster = fit_model.booster_ if hasattr(fit_model, 'booster_') else fit_model
+    model = booster.dump_model()
+    trees = []
+    for tree_info in model['tree_info']:
+        nodes = []
+        children = []
+        # Number the nodes in depth-first order so children come after their parent.
+        stack = [(tree_info['tree_structure'], -1, False)]
+        while stack:
+            node, parent, is_right = stack.pop()
+            position = len(nodes)
+            nodes.append(node)
+            children.append([-1, -1])
+            if parent >= 0:
+                children[parent][1 if is_right else 0] = position
+            if 'leaf_value' not in node:
+                if node['decision_type'] != '<=':
+                    raise NotImplementedError('Categorical splits are not supported.')
+                if node['missing_type'] == 'Zero':
+                    raise NotImplementedError('Models trained with zero_as_missing are not supported.')
+                stack.append((node['right_child'], position, True))
+                stack.append((node['left_child'], position, False))
+
+        is_leaf = np.array(['leaf_value' in node for node in nodes])
+        thresholds = np.array([node.get('threshold', 0.0) for node in nodes], dtype='float64')
+        # Without a missing type LightGBM treats NaN as 0.
+        default_left = [node['default_left'] if node['missing_type'] == 'NaN' else 0.0 <= node['threshold']
+                        for node in nodes if 'leaf_value' not in node]
+        tree = {'feature': np.array([node.get('split_feature', 0) for node in nodes]),
+                'threshold': convert_less_equal_thresholds(thresholds, 'float64'),
+                'left': np.where(is_leaf, -1, [left for left, right in children]),
+                'right': np.where(is_leaf, -1, [right for left, right in children]),
+                'default_left': np.zeros(len(nodes), dtype='uint8'),
+                'value': np.array([node.get('leaf_value', 0.0) for node in nodes])}
+        tree['default_left'][~is_leaf] = default_left
+        trees.append(tree)
+    if model.get('average_output'):
+        for tree in trees:
+            tree['value'] = tree['value'] / len(trees)
+    arrays, max_depth = flatten_trees(trees, 'float64')
+    return CompiledTrees(arrays, 0.0, max_depth, 'float64')
+
+def compile_catboost(fit_model):
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'model.json')
+        fit_model.save_model(filename, format='json')
+        with open(filename) as f:
+            model = json.load(f)
+    float_features = {info['feature_index']: info for info in model['features_info']['float_features']}
+    scale, biases = model.get('scale_and_bias', [1.0, [0.0]])
+
+    trees = []
+    for oblivious_tree in model['oblivious_trees']:
+        # Expand the oblivious tree into a full binary tree where level k tests split k. A row's leaf is the sum of
+        # 2**k over the levels k where its value was greater than the border.
+        splits = oblivious_tree['splits']
+        depth = len(splits)
+        num_nodes = 2**(depth + 1) - 1
+        tree = {'feature': np.zeros(num_nodes, dtype='int32'), 'threshold': np.zeros(num_nodes),
+                'left': np.full(num_nodes, -1, dtype='int32'), 'right': np.full(num_nodes, -1, dtype='int32'),
+                'default_left': np.zeros(num_nodes, dtype='uint8'), 'value': np.zeros(num_nodes)}
+        for level, split in enumerate(splits):
+            if split['split_type'] != 'FloatFeature':
+                raise NotImplementedError('Categorical splits are not supported.')
+            info = float_features[split['float_feature_index']]
+            level_nodes = np.arange(2**level - 1, 2**(level + 1) - 1)
+            tree['feature'][level_nodes] = info['flat_feature_index']
+            tree['threshold'][level_nodes] = convert_less_equal_thresholds([split['border']], 'float32')[0]
+            tree['left'][level_nodes] = 2 * level_nodes + 1
+            tree['right'][level_nodes] = 2 * level_nodes + 2
+            tree['default_left'][level_nodes] = info.get('nan_value_treatment') != 'Max'
+        leaf_nodes = np.arange(2**depth - 1, num_nodes)
+        paths = leaf_nodes - (2**depth - 1)
+        # The first level decides the highest bit of the path but the lowest bit of the leaf index.
+        leaf_indexes = sum(((paths >> (depth - 1 - level)) & 1) << level for level in range(depth))
+        tree['value'][leaf_nodes] = scale * np.array(oblivious_tree['leaf_values'])[leaf_indexes]
+        trees.append(tree)
+    arrays, max_depth = flatten_trees(trees)
+    return CompiledTrees(arrays, float(np.sum(biases)), max_depth)
+
+def get_sklearn_tree(estimator, scale):
+    tree = estimator.tree_
+    missing_go_to_left = getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, dtype='uint8'))
+    return {'feature': tree.feature, 'threshold': convert_less_equal_thresholds(tree.threshold, 'float32'),
+            'left': tree.children_left, 'right': tree.children_right, 'default_left': missing_go_to_left,
+            'value': scale * tree.value[:, 0, 0]}
+
+def compile_sklearn(fit_model):
+    if hasattr(fit_model, 'tree_'):
+        trees = [get_sklearn_tree(fit_model, 1.0)]
+        base_score = 0.0
+    elif hasattr(fit_model, 'learning_rate'):
+        # Gradient boosting adds learning_rate times each tree to the initial prediction.
+        trees = [get_sklearn_tree(estimator, fit_model.learning_rate) for estimator in fit_model.estimators_[:, 0]]
+        base_score = 0.0 if fit_model.init_ == 'zero' else float(np.ravel(fit_model.init_.constant_)[0])
+    else:
+        # Random forests and extra trees average their trees.
+        trees = [get_sklearn_tree(estimator, 1 / len(fit_model.estimators_)) for estimator in fit_model.estimators_]
+        base_score = 0.0
+    arrays, max_depth = flatten_trees(trees)
+    return CompiledTrees(arrays, base_score, max_depth)
+
+def compile_tree_model(fit_model):
+    '''
+    Compile a trained tree model into flat node arrays.
+
+    Args:
+        fit_model (varies): A model returned by modeling.train_model. XGBoost, LightGBM and CatBoost regressors and
+            their boosters, and scikit-learn decision tree, random forest, extra trees and gradient boosting
+            regressors are supported.
+
+    Returns:
+        CompiledTrees: The compiled model.
+    '''
+    module = type(fit_model).__module__
+    if module.startswith('xgboost'):
+        return compile_xgboost(fit_model)
+    if module.startswith('lightgbm'):
+        return compile_lightgbm(fit_model)
+    if module.startswith('catboost'):
+        return compile_catboost(fit_model)
+    if module.startswith('sklearn'):
+        return compile_sklearn(fit_model)
+    raise TypeError(f'Compiling {type(fit_model).__name__} models is not supported.')
+
+def benchmark_tree_inference(fit_model, X, batch_sizes=(1, 10, 100, 1000, 10000, 100000, 1000000), min_seconds=0.2,
+                             seed=91):
+    '''
+    Compare the compiled model's prediction time to the model's own predict method.
+
+    Args:
+        fit_model (varies): A trained tree model supported by compile_tree_model.
+        X (dataframe or array): Features to sample rows from. Rows are sampled with replacement, so X can be smaller
+            than the largest batch.
+        batch_sizes (list or tuple of ints): Number of rows predicted per call.
+        min_seconds (float): Each batch size is predicted repeatedly for at least this long.
+        seed (int): Seed for sampling rows.
+
+    Returns:
+        DataFrame: Returns a dataframe indexed by batch size with the milliseconds per call of each method, the
+        speedup of the compiled model, and the largest difference between their predictions.
+    '''
+    import pandas as pd
+    compiled = compile_tree_model(fit_model)
+    features = np.ascontiguousarray(X, dtype='float32')
+    rng = np.random.default_rng(seed)
+
+    def time_calls(predict, batch):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            predictions = predict(batch)
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_seconds:
+                return 1000 * elapsed / calls, np.asarray(predictions, dtype='float64')
+
+    rows = []
+    for batch_size in batch_sizes:
+        batch = features[rng.integers(0, len(features), size=batch_size)]
+        native_ms, native_predictions = time_calls(fit_model.predict, batch)
+        compiled_ms, compiled_predictions = time_calls(compiled.predict, batch)
+        rows.append({'batch_size': batch_size, 'native_ms': native_ms, 'compiled_ms': compiled_ms,
+                     'speedup': native_ms / compiled_ms,
+                     'max_difference': float(np.abs(native_predictions - compiled_predictions).max())})
+    return pd.DataFrame(rows).set_index('batch_size')
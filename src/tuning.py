@@ -0,0 +1,303 @@
+'''
+This file contains a successive halving hyperparameter search that scores each configuration by the ROI of its
+simulated portfolio instead of the mean squared error used when tuning by hand in Model Tuning.ipynb.
+
+The configurations are only ever scored on the training loans. The loans issued in the last validation_months of the
+training window are held out as a validation period, and the testing loans are left untouched so the ROI of the chosen
+configuration on them is an unbiased final evaluation. Ranking configurations on the testing loans would choose
+hyperparameters on the same loans they're evaluated on and overstate the ROI.
+
+Every configuration is first trained with a small budget, a fraction of the loans before the validation period and the
+same fraction of the trees. The predictions for the validation loans are run through the portfolio simulation, and only
+the best 1 / eta of the configurations are trained again with eta times the budget. This repeats until the budget
+reaches the full training data and number of trees, so most of the time is spent on the configurations that look
+promising.
+
+The training and validation features are converted to float32 arrays once, the training rows are shuffled once so
+every budget trains on the first rows of the same order, and the validation loans' payments are bucketed by month once.
+All of these are kept in module level variables that forked worker processes share, so trials only train, predict and
+simulate.
+'''
+
+import math
+import multiprocessing as mp
+import time
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
+from src.backtesting import sort_loans_by_issue_date
+from src.model_zoo import get_cpu_budget
+from src.modeling import create_dataframe_for_simulation, split_data_into_labels_and_target
+from src.portfolio import ArrayPortfolio, bucket_loans_by_month, bucket_payments_by_month, run_portfolio_simulation
+
+# These are set by cache_tuning_data before the process pool is created. The worker processes are forked, so they
+# inherit the features, split and payments without them being pickled and copied to every worker.
+tuning_X_train = None
+tuning_y_train = None
+tuning_X_valid = None
+tuning_validation_loans = None
+tuning_monthly_payments = None
+tuning_model_factory = None
+tuning_simulation = None
+
+def get_xgb_search_space():
+    '''
+    Get the XGBoost parameters tuned in Model Tuning.ipynb and the values to try for each.
+
+    Returns:
+        dict: Dictionary where the key is a parameter of XGBRegressor and the value is a list of values to sample from.
+    '''
+    return {'learning_rate': [0.01, 0.03, 0.05, 0.1, 0.2, 0.3],
+            'max_depth': [3, 4, 5, 6, 8, 10],
+            'min_child_weight': [1, 3, 5, 10, 20],
+            'subsample': [0.5, 0.7, 0.85, 1.0],
+            'colsample_bytree': [0.5, 0.7, 0.85, 1.0],
+            'reg_lambda': [0.1, 1.0, 5.0, 10.0]}
+
+def xgb_model_factory(params, n_estimators, n_threads):
+    '''
+    Create the XGBoost model trained in Model Tuning.ipynb with one configuration of the search.
+
+    Args:
+        params (dict): Parameters of XGBRegressor, such as one configuration from get_random_configurations.
+        n_estimators (int): Number of trees for the current budget.
+        n_threads (int): Number of threads the model may use.
+
+    Returns:
+        XGBRegressor: Returns a new, untrained model.
+    '''
+    from xgboost import XGBRegressor
+    return XGBRegressor(objective='reg:squarederror', n_estimators=n_estimators, n_jobs=n_threads, random_state=91,
+                        **params)
+
+def get_random_configurations(search_space, num_configurations, seed=91):
+    '''
+    Sample configurations from a search space. Duplicate configurations are only kept once.
+
+    Args:
+        search_space (dict): Dictionary where the key is a parameter name and the value is a list of values to try.
+        num_configurations (int): Number of configurations to sample.
+        seed (int): Seed for the random number generator.
+
+    Returns:
+        list: List of parameter dictionaries.
+    '''
+    rng = np.random.default_rng(seed)
+    num_combinations = math.prod(len(values) for values in search_space.values())
+    num_configurations = min(num_configurations, num_combinations)
+    configurations = []
+    seen = set()
+    while len(configurations) < num_configurations:
+        choice = tuple(rng.integers(len(values)) for values in search_space.values())
+        if choice not in seen:
+            seen.add(choice)
+            configurations.append({name: values[i] for (name, values), i in zip(search_space.items(), choice)})
+    return configurations
+
+def get_budget_fractions(eta=3, min_fraction=1/27):
+    '''
+    Get the fraction of the full budget used at each rung of successive halving.
+
+    Args:
+        eta (int): Factor the budget grows by, and the number of configurations shrinks by, at each rung.
+        min_fraction (float): Fraction of the full budget used at the first rung.
+
+    Returns:
+        list: List of fractions, growing by eta and ending at 1.
+    '''
+    num_rungs = int(math.floor(math.log(1 / min_fraction, eta) + 1e-9)) + 1
+    return [float(eta) ** (rung - num_rungs + 1) for rung in range(num_rungs)]
+
+def split_validation_period(training_loans, validation_months=12):
+    '''
+    Hold out the loans issued in the last months of the training window to score configurations on.
+
+    Args:
+        training_loans (dataframe): The training loans, cleaned and prepared for modeling with issue_d and roi columns.
+        validation_months (int): Number of issue months at the end of the training window used for validation.
+
+    Returns:
+        tuple: Returns the loans to fit on and the validation loans, both sorted by issue date.
+    '''
+    loans = sort_loans_by_issue_date(training_loans)
+    issue_dates = pd.DatetimeIndex(loans['issue_d'])
+    months = np.asarray(12 * issue_dates.year + issue_dates.month - 1, dtype='int64')
+    first_validation_row = np.searchsorted(months, months[-1] - validation_months + 1, side='left')
+    return loans.iloc[:first_validation_row], loans.iloc[first_validation_row:]
+
+def cache_tuning_data(X_train, y_train, X_valid, validation_loans, all_payments, model_factory, simulation, seed=91):
+    '''
+    Prepare everything the trials share and store it in the module level variables read by run_trial.
+
+    Args:
+        X_train (dataframe): Dataframe of features of the loans to fit on.
+        y_train (series): The ROI of the loans to fit on.
+        X_valid (dataframe): Dataframe of validation features, with the same columns as X_train.
+        validation_loans (dataframe): The validation loans indexed by loan id, in the same order as X_valid and
+            containing issue_d and loan_amnt.
+        all_payments (dataframe): Payments for the validation loans with a multi-level index of payment date and
+            loan ID.
+        model_factory (function): Function taking (params, n_estimators, n_threads) that returns a new, untrained model.
+        simulation (dict): The start_date, end_date, starting_balance, investment_per_loan and min_roi of the
+            simulated portfolio.
+        seed (int): Seed used to shuffle the training rows.
+    '''
+    global tuning_X_train, tuning_y_train, tuning_X_valid, tuning_validation_loans, tuning_monthly_payments, \
+        tuning_model_factory, tuning_simulation
+    # Shuffling once means a budget of n rows is always the first n rows, so smaller budgets train on a subset of the
+    # rows of larger ones and no per-trial sampling or copying is needed.
+    order = np.random.default_rng(seed).permutation(len(X_train))
+    tuning_X_train = np.ascontiguousarray(np.asarray(X_train, dtype='float32')[order])
+    tuning_y_train = np.asarray(y_train, dtype='float32')[order]
+    tuning_X_valid = np.ascontiguousarray(X_valid, dtype='float32')
+    tuning_validation_loans = validation_loans[['issue_d', 'loan_amnt']]
+    # The payments of every validation loan are bucketed once. Loans under min_roi are never bought, so keeping their
+    # payments gives the same balances as filtering them for each trial.
+    tuning_monthly_payments = bucket_payments_by_month(all_payments, validation_loans.index.to_numpy())
+    tuning_model_factory = model_factory
+    tuning_simulation = simulation
+
+def simulate_predictions(predictions):
+    '''
+    Get the annualized ROI of a portfolio bought with a trial's predictions for the validation loans.
+
+    Args:
+        predictions (array): Predicted ROI of each validation loan, in the same order as X_valid.
+
+    Returns:
+        float: Returns the annualized ROI of the simulated portfolio.
+    '''
+    simulation = tuning_simulation
+    monthly_loans = bucket_loans_by_month(create_dataframe_for_simulation(tuning_validation_loans, predictions))
+    portfolio = ArrayPortfolio(simulation['starting_balance'], simulation['investment_per_loan'],
+                               simulation['start_date'], monthly_loans, tuning_monthly_payments, simulation['min_roi'])
+    dates, balances, roi = run_portfolio_simulation(portfolio, simulation['end_date'])
+    return roi
+
+def run_trial(task):
+    '''
+    Train one configuration with one budget and score it. This is the function mapped over the process pool, so it
+    reads the data from the module level variables set up by cache_tuning_data.
+
+    Args:
+        task (tuple): Tuple of (configuration number, params, budget fraction, n_estimators, threads per model).
+
+    Returns:
+        dict: Returns one row of the tuning results table.
+    '''
+    configuration, params, fraction, n_estimators, n_threads = task
+    training_rows = max(int(round(fraction * len(tuning_X_train))), 1)
+    model = tuning_model_factory(params, n_estimators, n_threads)
+
+    start = time.perf_counter()
+    fit_model = model.fit(tuning_X_train[:training_rows], tuning_y_train[:training_rows])
+    fit_seconds = time.perf_counter() - start
+
+    predictions = np.asarray(fit_model.predict(tuning_X_valid), dtype='float64')
+    start = time.perf_counter()
+    roi = simulate_predictions(predictions)
+    simulation_seconds = time.perf_counter() - start
+    return {'configuration': configuration, 'fraction': fraction, 'training_rows': training_rows,
+            'n_estimators': n_estimators, 'fit_seconds': fit_seconds, 'simulation_seconds': simulation_seconds,
+            'roi': roi, **params}
+
+def run_successive_halving(configurations, training_loans, all_payments, validation_months=12, simulation_months=36,
+                           starting_balance=50000, investment_per_loan=100, min_roi=10.0, model_factory=xgb_model_factory,
+                           max_estimators=500, eta=3, min_fraction=1/27, cpus=None, processes=None):
+    '''
+    Search for the configuration whose predictions give the highest simulated ROI on a validation period at the end of
+    the training window. The testing loans aren't used, so they can evaluate the chosen configuration afterwards.
+
+    Args:
+        configurations (list): List of parameter dictionaries passed to model_factory, for example from
+            get_random_configurations(get_xgb_search_space(), 81).
+        training_loans (dataframe): The training loans indexed by loan id, cleaned and prepared for modeling with
+            issue_d and roi columns. Never pass the testing loans here.
+        all_payments (dataframe): Payments for the training loans with a multi-level index of payment date and loan ID.
+            Only the validation loans' payments are used.
+        validation_months (int): Number of issue months at the end of the training window held out for validation.
+        simulation_months (int): Number of months to simulate, starting the month of the first validation loan.
+        starting_balance (float): Starting cash balance of every portfolio.
+        investment_per_loan (float): Amount to invest in each loan.
+        min_roi (float): Minimum predicted ROI a loan needs for us to buy it.
+        model_factory (function): Function taking (params, n_estimators, n_threads) that returns a new, untrained model.
+        max_estimators (int): Number of trees at the full budget. Each rung uses this times its budget fraction.
+        eta (int): Only the best 1 / eta of the configurations move on to the next rung, with eta times the budget.
+        min_fraction (float): Fraction of the training loans and trees used at the first rung.
+        cpus (int or None): Number of CPUs to use. None uses every CPU available.
+        processes (int or None): Number of configurations trained at the same time. See model_zoo.get_cpu_budget.
+
+    Returns:
+        tuple: Returns a dataframe with one row per trial, containing its rung, configuration number, budget, time
+        taken, simulated validation ROI and parameters, and the parameters of the configuration with the highest ROI
+        at the last rung it reached.
+    '''
+    fit_loans, validation_loans = split_validation_period(training_loans, validation_months)
+    X_train, y_train = split_data_into_labels_and_target(fit_loans)
+    X_valid, y_valid = split_data_into_labels_and_target(validation_loans)
+    start_date = validation_loans['issue_d'].iloc[0].date().replace(day=1)
+    end_date = start_date + relativedelta(months=simulation_months)
+    cache_tuning_data(X_train, y_train, X_valid, validation_loans, all_payments, model_factory,
+                      {'start_date': start_date, 'end_date': end_date, 'starting_balance': starting_balance,
+                       'investment_per_loan': investment_per_loan, 'min_roi': min_roi})
+    fractions = get_budget_fractions(eta, min_fraction)
+    processes, n_threads = get_cpu_budget(len(configurations), cpus, processes)
+
+    pool = mp.get_context('fork').Pool(processes=processes) if processes > 1 else None
+    try:
+        survivors = list(range(len(configurations)))
+        rung_results = []
+        for rung, fraction in enumerate(fractions):
+            # Later rungs have fewer configurations, so each one gets more of the CPUs.
+            rung_threads = get_cpu_budget(len(survivors), processes * n_threads, processes)[1]
+            n_estimators = max(int(round(fraction * max_estimators)), 1)
+            tasks = [(configuration, configurations[configuration], fraction, n_estimators, rung_threads)
+                     for configuration in survivors]
+            if pool is None:
+                results = [run_trial(task) for task in tasks]
+            else:
+                results = pool.map(run_trial, tasks, chunksize=1)
+            results = pd.DataFrame(results).assign(rung=rung)
+            rung_results.append(results)
+
+            if len(survivors) == 1:
+                break
+            ranked = results.sort_values(['roi', 'configuration'], ascending=[False, True], kind='stable')
+            survivors = ranked['configuration'].iloc[:max(len(survivors) // eta, 1)].tolist()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    results = pd.concat(rung_results, ignore_index=True)
+    results = results[['rung'] + [col for col in results.columns if col != 'rung']]
+    final_rung = rung_results[-1]
+    best = final_rung.sort_values(['roi', 'configuration'], ascending=[False, True], kind='stable').iloc[0]
+    return results, configurations[int(best['configuration'])]
+
+if __name__ == '__main__':
+    import datetime
+    import pickle
+    loans = pd.read_pickle('data/df_EDA.pkl.bz2', compression='bz2')
+    with open('data/loan_rois.pickle', 'rb') as handle:
+        loan_rois = pickle.load(handle)
+    loans['roi'] = pd.Series(loan_rois)
+    training_payments = pd.read_pickle('data/df_payments_training_loans.pkl.bz2', compression='bz2')
+    testing_payments = pd.read_pickle('data/df_payments_testing_loans.pkl.bz2', compression='bz2')
+    X_test = pd.read_pickle('data/X_test.pkl.bz2', compression='bz2')
+    X_train = pd.read_pickle('data/X_train.pkl.bz2', compression='bz2')
+    y_train = pd.read_pickle('data/y_train.pkl.bz2', compression='bz2')
+
+    configurations = get_random_configurations(get_xgb_search_space(), 81)
+    results, best_params = run_successive_halving(configurations, loans.loc[X_train.index], training_payments)
+    print(results.sort_values(['rung', 'roi'], ascending=[True, False]).to_string())
+    print(best_params)
+
+    # The testing loans are only used once, to evaluate the chosen configuration trained on every training loan.
+    from src.portfolio import simulate_loan_investment_portfolio
+    fit_model = xgb_model_factory(best_params, 500, -1).fit(X_train, y_train)
+    model_predictions = create_dataframe_for_simulation(loans.loc[X_test.index], fit_model.predict(X_test))
+    dates, balances, roi = simulate_loan_investment_portfolio(testing_payments, model_predictions,
+                                                              datetime.date(2017, 8, 1), datetime.date(2020, 7, 1),
+                                                              50000, 100, 10.0)
+    print('Testing ROI:', roi)
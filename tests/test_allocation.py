@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+from src.allocation import ConstrainedAllocator, TopKAllocator
+from src.portfolio import Portfolio
+
+def test_constrained_allocator_buys_lower_ranked_loans_that_fit_under_the_caps():
+    # 10 grade A loans ranked above 2 grade B loans. Only 3 grade A loans fit under the 30% cap, and the grade B loans
+    # must still be bought after the other grade A loans are skipped.
+    loans_df = pd.DataFrame({'id': np.arange(12), 'grade': ['A'] * 10 + ['B'] * 2})
+    allocator = ConstrainedAllocator({'grade': 0.3})
+    portfolio = SimpleNamespace(cash_balance=1000.0, investment_per_loan=100, principal_balances=np.zeros(0),
+                                loan_positions=np.zeros(0, dtype='int64'),
+                                bucket_codes=allocator.get_bucket_codes(loans_df, pd.Index(loans_df['id'])))
+    predicted_rois = np.linspace(20, 9, 12)
+    chosen, amounts = allocator.allocate(portfolio, predicted_rois, np.full(12, 1000.0), np.arange(12))
+    assert list(chosen) == [0, 1, 2, 10, 11]
+    assert amounts.sum() == 500
+
+def test_top_k_allocator_matches_get_top_loans_to_buy():
+    rng = np.random.default_rng(0)
+    loans_df = pd.DataFrame({'id': np.arange(200), 'predicted_roi': rng.normal(8, 6, 200),
+                             'loan_amnt': rng.choice([50.0, 1000.0], 200)})
+    for cash_balance in (0.0, 99.0, 100.0, 2550.0, 19999.0, 50000.0):
+        portfolio = SimpleNamespace(cash_balance=cash_balance, investment_per_loan=100)
+        expected = Portfolio.get_top_loans_to_buy(portfolio, loans_df)
+        chosen, amounts = TopKAllocator().allocate(portfolio, loans_df['predicted_roi'].values,
+                                                   loans_df['loan_amnt'].values, np.arange(200))
+        assert list(loans_df['id'].values[chosen]) == list(expected['id'])
+        np.testing.assert_array_equal(amounts, np.minimum(100, expected['loan_amnt'].values))
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from src.listing_features import ListingTransform, get_listing_transform_spec
+
+FEATURE_COLUMNS = ['loan_amnt', 'int_rate', 'emp_length', 'emp_length_missing', 'dti', 'dti_missing', 'grade_A',
+                   'grade_B', 'state_CA', 'state_NY', 'expected_inflation', 'int_minus_inflation', 'prime_rate',
+                   'int_minus_prime', 'mths_since_earliest_cr']
+
+def write_rates(directory):
+    for filename, column, rates in (('inflation_expectations.csv', 'MICH', (2.5, 2.75)),
+                                    ('MORTGAGE30US.csv', 'MORTGAGE30US', (4.0, 4.25)),
+                                    ('MPRIME.csv', 'MPRIME', (3.25, 3.5))):
+        with open(directory / filename, 'w') as f:
+            f.write(f'DATE,{column}\n2018-11-01,{rates[0]}\n2018-12-01,{rates[1]}\n')
+
+def get_transform(tmp_path):
+    write_rates(tmp_path)
+    return ListingTransform(get_listing_transform_spec(FEATURE_COLUMNS, rates_directory=str(tmp_path)))
+
+def test_raw_listing_gets_the_engineered_features(tmp_path):
+    listing = {'loan_amnt': 10000, 'int_rate': '12.5%', 'emp_length': '10+ years', 'dti': None, 'grade': 'B',
+               'addr_state': 'NY', 'issue_d': 'Dec-2018', 'earliest_cr_line': 'Dec-2008', 'zip_code': '100xx'}
+    features = get_transform(tmp_path).get_features([listing])[0]
+    expected = [10000, 12.5, 10, 0, -99, 1, 0, 1, 0, 1, 2.75, 9.75, 3.5, 9.0, 120]
+    np.testing.assert_allclose(features, expected)
+
+def test_engineered_listing_passes_through(tmp_path):
+    values = [5000, 9.5, -99, 1, 20.5, 0, 1, 0, 1, 0, 2.5, 7.0, 3.25, 6.25, 87]
+    features = get_transform(tmp_path).get_features([dict(zip(FEATURE_COLUMNS, values))])[0]
+    np.testing.assert_allclose(features, values)
+
+def test_bad_listings_raise_value_error(tmp_path):
+    transform = get_transform(tmp_path)
+    for listing in ('not a loan', {'issue_d': 'soon'}, {'dti': 'high'}):
+        with pytest.raises(ValueError):
+            transform.get_features([listing])
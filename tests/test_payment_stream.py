@@ -0,0 +1,51 @@
+import datetime
+import gc
+import numpy as np
+import pandas as pd
+import pytest
+from src.payment_stream import PrefetchingIterator, read_monthly_payment_batches, write_payment_batch
+
+def get_items(closed):
+    try:
+        for i in range(100):
+            yield i
+    finally:
+        closed.append(True)
+
+def test_close_stops_the_thread_and_closes_the_iterable():
+    closed = []
+    items = PrefetchingIterator(get_items(closed), lookahead=2, poll_seconds=0.01)
+    assert next(items) == 0
+    items.close()
+    assert not items.thread.is_alive()
+    assert closed == [True]
+
+def test_thread_stops_when_the_consumer_breaks_and_drops_the_iterator():
+    closed = []
+    items = PrefetchingIterator(get_items(closed), lookahead=2, poll_seconds=0.01)
+    for item in items:
+        if item == 3:
+            break
+    thread = items.thread
+    del items
+    gc.collect()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert closed == [True]
+
+def test_errors_are_raised_in_the_consumer():
+    def get_failing_items():
+        yield 1
+        raise KeyError('missing month')
+    items = PrefetchingIterator(get_failing_items())
+    assert next(items) == 1
+    with pytest.raises(KeyError):
+        next(items)
+
+def test_payment_amounts_keep_their_cents(tmp_path):
+    received = np.array([39999.99, 40000.01, 12345.67])
+    end_principal = np.array([39876.53, 0.01, 38000.07])
+    write_payment_batch(str(tmp_path), datetime.date(2018, 1, 1), [1, 2, 3], received, end_principal)
+    month, = read_monthly_payment_batches(str(tmp_path), [datetime.date(2018, 1, 1)], pd.Index([1, 2, 3]))
+    np.testing.assert_array_equal(month.received, received)
+    np.testing.assert_array_equal(month.end_principal, end_principal)
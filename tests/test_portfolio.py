@@ -0,0 +1,51 @@
+import datetime
+import numpy as np
+import pandas as pd
+from src.portfolio import Portfolio, simulate_loan_investment_portfolio
+
+def get_simulation_data(num_loans=300, seed=0):
+    '''
+    Make predictions and payments for loans issued in 2016. Some loans default partway through, some skip a month, and
+    some get 2 payments in one month.
+    '''
+    rng = np.random.default_rng(seed)
+    issue_dates = rng.choice(pd.date_range('2016-01-01', '2016-12-01', freq='MS'), num_loans)
+    loan_ids = np.arange(1000, 1000 + num_loans)
+    loan_amounts = rng.choice([1000.0, 5000.0, 10000.0, 75.0], num_loans)
+    predictions = pd.DataFrame({'id': loan_ids, 'loan_amnt': loan_amounts,
+                                'predicted_roi': rng.normal(8, 6, num_loans)},
+                               index=pd.DatetimeIndex(issue_dates, name='issue_d')).sort_index()
+    rows = []
+    for loan_id, issue_date, amount in zip(loan_ids, pd.DatetimeIndex(issue_dates), loan_amounts):
+        last_month = int(rng.integers(3, 37)) if rng.random() < 0.3 else 36
+        principal = amount
+        for month in range(1, last_month + 1):
+            if rng.random() < 0.05:
+                continue
+            paid = amount / 36 if month < 36 else principal
+            principal = max(principal - paid, 0.0)
+            date = issue_date + pd.DateOffset(months=month)
+            rows.append((date, loan_id, paid * 1.01, principal, issue_date))
+            if rng.random() < 0.05:
+                rows.append((date, loan_id, 1.0, principal, issue_date))
+    payments = pd.DataFrame(rows, columns=['RECEIVED_D', 'LOAN_ID', 'RECEIVED_AMT_INVESTORS',
+                                           'PBAL_END_PERIOD_INVESTORS', 'IssuedDate'])
+    return predictions, payments.set_index(['RECEIVED_D', 'LOAN_ID']).sort_index()
+
+def get_payments_for_current_month(self):
+    # Older pandas kept both index levels when a MultiIndex was looked up by a date string, which the original
+    # Portfolio relies on. This lookup keeps them on every version.
+    payments = self.all_payments_data
+    return payments.loc[payments.index.get_level_values(0) == pd.Timestamp(self.date)]
+
+def test_array_portfolio_matches_the_original_portfolio(monkeypatch):
+    monkeypatch.setattr(Portfolio, 'get_payments_for_current_month', get_payments_for_current_month)
+    predictions, payments = get_simulation_data()
+    args = (payments, predictions, datetime.date(2016, 3, 1), datetime.date(2019, 1, 1), 20000, 100, 8.0)
+    dates, balances, roi = simulate_loan_investment_portfolio(*args, vectorized=False)
+    array_dates, array_balances, array_roi = simulate_loan_investment_portfolio(*args)
+    assert array_dates == dates
+    np.testing.assert_allclose(array_balances, balances, rtol=1e-9)
+    assert np.isclose(array_roi, roi)
+    # The portfolio bought loans and received payments, so the comparison covered more than the starting balance.
+    assert len(set(np.round(balances, 2))) > 10
@@ -0,0 +1,24 @@
+import datetime
+import numpy as np
+from src.portfolio_metrics import get_max_drawdowns, get_xirr
+
+DATES = [datetime.date(2017, 1, 1), datetime.date(2018, 1, 1), datetime.date(2019, 1, 1)]
+
+def test_xirr_of_hand_computed_cash_flows():
+    # $1000 returned as $1100 a year later.
+    assert np.isclose(get_xirr([-1000, 1100], DATES[:2]), 10.0)
+    # 600 / (1 + r) + 600 / (1 + r)**2 = 1000 gives r = 1 / x - 1 with x = (-600 + sqrt(600**2 + 4 * 600 * 1000)) / 1200.
+    assert np.isclose(get_xirr([-1000, 600, 600], DATES), 13.0662386)
+    # $1000 shrinking to $250 over 2 years is half its value each year.
+    assert np.isclose(get_xirr([-1000, 0, 250], DATES), -50.0)
+
+def test_xirr_without_a_sign_change_is_nan():
+    assert np.isnan(get_xirr([-1000, -100, 0], DATES))
+    assert np.isnan(get_xirr([1000, 100, 50], DATES))
+
+def test_max_drawdowns_of_hand_computed_balances():
+    balances = np.array([[100, 120, 90, 130, 104],
+                         [100, 101, 102, 103, 104],
+                         [100, 50, 200, 20, 300]], dtype='float64')
+    # 120 -> 90 is 25%, and 130 -> 104 is only 20%. The last row drops 90% from its peak of 200.
+    np.testing.assert_allclose(get_max_drawdowns(balances), [25.0, 0.0, 90.0])
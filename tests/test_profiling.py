@@ -0,0 +1,33 @@
+import sys
+import time
+import types
+import numpy as np
+from src.profiling import profiling
+
+def allocate_a_lot():
+    values = np.ones(2**24)
+    time.sleep(0.05)
+    return float(values.sum())
+
+def allocate_a_little():
+    values = np.ones(1000)
+    time.sleep(0.05)
+    return float(values.sum())
+
+def test_each_stack_gets_its_own_peak_memory(monkeypatch):
+    stages = types.ModuleType('src.fake_stages')
+    stages.allocate_a_lot = allocate_a_lot
+    stages.allocate_a_little = allocate_a_little
+    for function in (allocate_a_lot, allocate_a_little):
+        monkeypatch.setattr(function, '__module__', 'src.fake_stages')
+    monkeypatch.setitem(sys.modules, 'src.fake_stages', stages)
+
+    with profiling(('src.fake_stages',)) as profiler:
+        stages.allocate_a_lot()
+        stages.allocate_a_little()
+    report = profiler.get_report()
+    assert report.loc['fake_stages.allocate_a_lot', 'peak_growth_mb'] > 100
+    assert report.loc['fake_stages.allocate_a_little', 'peak_growth_mb'] < 10
+    # The small stage ran after the big one freed its memory, so it doesn't inherit the big one's peak.
+    assert report.loc['fake_stages.allocate_a_little', 'peak_rss_mb'] < report.loc['fake_stages.allocate_a_lot',
+                                                                                 'peak_rss_mb'] - 100
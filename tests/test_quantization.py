@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from src.quantization import write_quantized_matrix
+from src.tree_inference import compile_tree_model
+
+def get_features(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame({'int_rate': rng.normal(12, 4, n), 'annual_inc': rng.lognormal(size=n) * 50000,
+                      'open_acc': rng.integers(0, 30, n).astype(float), 'grade_A': rng.integers(0, 2, n).astype(float),
+                      'dti': np.where(rng.random(n) < 0.2, -99, rng.random(n) * 40)})
+    X.loc[rng.random(n) < 0.05, 'int_rate'] = np.nan
+    y = X['int_rate'].fillna(12) * 0.5 - np.log(X['annual_inc']) + X['open_acc'] * 0.1 + X['grade_A'] + rng.random(n)
+    return X, y
+
+def test_code_predictions_match_float_predictions(tmp_path):
+    X, y = get_features()
+    matrix = write_quantized_matrix(X, str(tmp_path / 'features'), sample_rows=2000, chunk_size=700)
+    assert (matrix.quantize(X) == matrix.codes).all()
+
+    booster = xgb.train({'tree_method': 'hist', 'max_depth': 6, 'seed': 1, 'nthread': 1},
+                        matrix.get_quantile_dmatrix(y, chunk_size=900), 30)
+    code_trees = matrix.compile_trees_for_codes(compile_tree_model(booster))
+    # The booster predicting the float features each bin stands for.
+    features = xgb.DMatrix(matrix.dequantize(np.asarray(matrix.codes)), feature_names=matrix.feature_columns)
+    np.testing.assert_allclose(matrix.predict(code_trees, chunk_size=600), booster.predict(features), rtol=1e-5,
+                               atol=1e-4)
+    np.testing.assert_allclose(matrix.predict(code_trees, rows=slice(100, 200)), booster.predict(features)[100:200],
+                               rtol=1e-5, atol=1e-4)
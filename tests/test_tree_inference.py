@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+from catboost import CatBoostRegressor
+from lightgbm import LGBMRegressor
+from sklearn.ensemble import ExtraTreesRegressor, GradientBoostingRegressor, RandomForestRegressor
+from sklearn.tree import DecisionTreeRegressor
+from xgboost import XGBRegressor
+from src.tree_inference import compile_tree_model
+
+MODELS = {
+    'xgboost': lambda: XGBRegressor(n_estimators=30, max_depth=5, n_jobs=1),
+    'lightgbm': lambda: LGBMRegressor(n_estimators=30, verbose=-1, n_jobs=1),
+    'catboost': lambda: CatBoostRegressor(iterations=30, verbose=False, thread_count=1, allow_writing_files=False),
+    'decision_tree': lambda: DecisionTreeRegressor(max_depth=8, random_state=0),
+    'random_forest': lambda: RandomForestRegressor(n_estimators=10, max_depth=6, n_jobs=1, random_state=0),
+    'extra_trees': lambda: ExtraTreesRegressor(n_estimators=10, max_depth=6, n_jobs=1, random_state=0),
+    'gradient_boosting': lambda: GradientBoostingRegressor(n_estimators=20, random_state=0),
+}
+# GradientBoostingRegressor doesn't accept NaN, so it's trained and scored with the fill value instead.
+NO_MISSING_VALUES = {'gradient_boosting'}
+
+def get_features(n=2000, seed=0):
+    '''
+    Features with repeated values that land on split thresholds, the -99 fill value, and NaNs in one column.
+    '''
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame(rng.random((n, 8)), columns=[f'f{i}' for i in range(8)])
+    X['f5'] = rng.integers(0, 5, n).astype(float)
+    X.loc[X.index[::9], 'f7'] = -99
+    y = X['f0'] * 10 + X['f5'] * 2 + (X['f7'] > 0) * 3 + rng.random(n)
+    X.loc[X.index[::11], 'f2'] = np.nan
+    return X, y
+
+@pytest.mark.parametrize('name', MODELS)
+def test_compiled_trees_match_native_predict(name):
+    X, y = get_features()
+    if name in NO_MISSING_VALUES:
+        X = X.fillna(-99)
+    model = MODELS[name]().fit(X, y)
+    compiled = compile_tree_model(model)
+    np.testing.assert_allclose(compiled.predict(X), model.predict(X), rtol=1e-5, atol=1e-4)
+    if name in NO_MISSING_VALUES:
+        return
+    # Rows that are all NaN follow the missing value branch of every split.
+    missing = pd.DataFrame(np.nan, index=range(3), columns=X.columns)
+    np.testing.assert_allclose(compiled.predict(missing), model.predict(missing), rtol=1e-5, atol=1e-4)